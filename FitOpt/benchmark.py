@@ -0,0 +1,450 @@
+# ---------------------------------------------------------------------------------
+# Benchmarks of the FitOpt plugin.
+#
+# The structure bundled in FitOpt/test is replicated to build assemblies of
+# the requested number of atoms, and synthetic maps are simulated from them at
+# several resolutions. The suite times:
+#
+#   pdbio        reading and writing PDBs
+#   staging      staging of the inputs of a job (joined PDBs, cropped and
+#                filtered maps)
+#   command      building of the fitopt command line
+#   logs         parsing of the fitopt output (progress events)
+#   trajectory   indexing and reading of movies, PDB and binary
+#   fitting      complete fitting (only if the fitopt binary is present)
+#
+# The times (best of several runs, in seconds) are saved in a JSON file and can
+# be compared with the ones of a previous run: the benchmarks slower than the
+# baseline by more than the threshold are reported as regressions and the exit
+# code is 1.
+#
+#   python -m FitOpt.benchmark [atoms ...]
+#   python -m FitOpt.benchmark -o new.json --baseline old.json --threshold 0.2
+#
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Structure used by the benchmarks
+test_pdb = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test', 'adpEM0001.pdb')
+
+# Default sizes (atoms) of the assemblies
+default_sizes = (3855, 100000, 1000000)
+
+# Default resolutions (A) of the synthetic maps
+default_resolutions = (5.0, 10.0)
+
+# Benchmarks of the suite
+benchmarks = ('pdbio', 'staging', 'command', 'logs', 'trajectory', 'fitting')
+
+# Default relative slowdown over the baseline reported as a regression
+default_threshold = 0.2
+
+# Times under this (s) are too noisy to be reported as regressions
+min_seconds = 0.005
+
+# Number of command lines built, of fitopt output lines parsed and of atoms in
+# all the frames of the movies
+command_calls = 1000
+log_lines = 200000
+movie_atoms = 5000000
+
+# Version of the results file
+results_format = 1
+
+
+# ---------------------------------------------------------------------------------
+# Returns the atoms of the test structure replicated (and translated, so the
+# copies do not overlap) until the assembly has the given number of atoms
+#
+def replicated_atoms(natoms, path=test_pdb):
+
+    import numpy
+    from FitOpt.pdbio import read_pdb
+
+    atoms = read_pdb(path)
+    copies = -(-natoms // len(atoms))
+    side = int(numpy.ceil(copies ** (1.0 / 3)))
+    size = atoms['xyz'].max(axis=0) - atoms['xyz'].min(axis=0) + 5
+    parts = []
+    for c in range(copies):
+        a = atoms.copy()
+        i, j, k = c % side, (c // side) % side, c // (side * side)
+        a['xyz'] += size * (i, j, k)
+        a['chain'] = chr(ord('A') + c % 26)
+        parts.append(a)
+    assembly = numpy.concatenate(parts)[:natoms]
+    assembly['serial'] = numpy.arange(1, natoms + 1)
+    return assembly
+
+
+# ---------------------------------------------------------------------------------
+# Returns the seconds of the fastest of several calls to f
+#
+def best_time(f, repeat=3):
+
+    best = None
+    for r in range(repeat):
+        t0 = time.time()
+        f()
+        t = time.time() - t0
+        if best is None or t < best:
+            best = t
+    return best
+
+
+# ---------------------------------------------------------------------------------
+# Reads the coordinates of a PDB text line by line (reference for the
+# NumPy reader)
+#
+def parse_lines(data):
+
+    xyz = []
+    for line in data.split(b'\n'):
+        if line.startswith(b'ATOM') or line.startswith(b'HETATM'):
+            xyz.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+    return xyz
+
+
+# ---------------------------------------------------------------------------------
+# Times reading and writing PDBs of the given sizes.
+# Returns a list of dictionaries with the results.
+#
+def bench_pdbio(sizes=default_sizes, repeat=3):
+
+    from FitOpt.pdbio import format_pdb, parse_pdb
+
+    results = []
+    for n in sizes:
+        atoms = replicated_atoms(n)
+        data = format_pdb(atoms)
+        results.append({'atoms': n,
+                        'bytes': len(data),
+                        'parse_numpy': best_time(lambda: parse_pdb(data), repeat),
+                        'parse_lines': best_time(lambda: parse_lines(data), repeat),
+                        'write_numpy': best_time(lambda: format_pdb(atoms), repeat)})
+    return results
+
+
+# ---------------------------------------------------------------------------------
+# Writes a synthetic map of the atoms at a resolution (grid step of a third
+# of the resolution), with a padding around them. Returns its cut-off level.
+#
+def synthetic_map(atoms, resolution, path, padding):
+
+    import numpy
+    from FitOpt.density import Grid, atom_weights, simulate_map
+    from FitOpt.mrcmap import write_mrc
+
+    step = resolution / 3.0
+    lo = atoms['xyz'].min(axis=0) - padding
+    hi = atoms['xyz'].max(axis=0) + padding
+    shape = tuple(int(n) for n in numpy.ceil((hi - lo) / step)[::-1] + 1)
+    grid = Grid(lo, step, shape)
+    values = simulate_map(atoms['xyz'], grid, resolution, atom_weights(atoms))
+    write_mrc(path, values, grid, label='FitOpt benchmark %g A' % resolution)
+    return 0.1 * float(values.max())
+
+
+# ---------------------------------------------------------------------------------
+# Inputs of the benchmark jobs in a folder: an assembly split in a fitted and
+# a fixed PDB, and its synthetic map (padded so it can be cropped).
+# Returns the paths of the fitted and fixed PDBs, of the map and its cut-off.
+#
+def job_inputs(folder, natoms, resolution):
+
+    from FitOpt.cropping import crop_margin
+    from FitOpt.pdbio import write_pdb
+
+    atoms = replicated_atoms(natoms)
+    half = max(1, len(atoms) // 2)
+    fitted = os.path.join(folder, 'fitted_%d.pdb' % natoms)
+    fixed = os.path.join(folder, 'fixed_%d.pdb' % natoms)
+    if not os.path.exists(fitted):
+        write_pdb(fitted, atoms[:half])
+        write_pdb(fixed, atoms[half:])
+    map_path = os.path.join(folder, 'map_%d_%g.mrc' % (natoms, resolution))
+    cutoff = synthetic_map(atoms, resolution, map_path, 3 * crop_margin(resolution))
+    return fitted, fixed, map_path, cutoff
+
+
+# ---------------------------------------------------------------------------------
+# Times the staging of jobs: with the fitted models given as two PDBs to be
+# joined and the map cropped, and with the map also filtered from the
+# resolution to twice it
+#
+def bench_staging(folder, sizes, resolutions, repeat=3):
+
+    from FitOpt.fitjob import Fit_Job
+
+    results = []
+    for n in sizes:
+        for res in resolutions:
+            fitted, fixed, map_path, cutoff = job_inputs(folder, n, res)
+            cwd = os.path.join(folder, 'staging')
+            job = Fit_Job([fitted, fitted], [fixed], map_path, res, cutoff, cwd=cwd, crop=True)
+            results.append(('staging/crop/atoms=%d/res=%g' % (n, res), best_time(job.stage, repeat)))
+            job = Fit_Job([fitted], [fixed], map_path, 2 * res, cutoff, cwd=cwd, crop=True,
+                          map_resolution=res)
+            results.append(('staging/filter/atoms=%d/res=%g' % (n, res), best_time(job.stage, repeat)))
+    return results
+
+
+# ---------------------------------------------------------------------------------
+# Times building the fitopt command line of a multi-model job
+#
+def bench_command(folder, repeat=3):
+
+    from FitOpt.fitjob import Fit_Job
+
+    job = Fit_Job(['a.pdb', 'b.pdb'], ['c.pdb', 'd.pdb'], 'map.mrc', 10, 0.02, cwd=folder,
+                  adv_commands=['--iter', '100'])
+
+    def build():
+        for i in range(command_calls):
+            job.command()
+    return [('command/calls=%d' % command_calls, best_time(build, repeat))]
+
+
+# ---------------------------------------------------------------------------------
+# Synthetic fitopt output: messages, and for every model its header, time,
+# iterations and convergence lines
+#
+def fitopt_output(nlines, iterations=500):
+
+    lines = ['FitOpt synthetic output\n', 'Reading map and models...\n']
+    model = 0
+    while len(lines) < nlines:
+        model += 1
+        lines.append('  Iter   NMA_time     Score      RMSD   Modes\n')
+        lines.append('  Model %d time 0.%03d sec\n' % (model, model % 1000))
+        for i in range(iterations):
+            lines.append('%6d %10.3f %9.5f %9.4f %7d\n' % (i + 1, 0.01 * i, 0.5 + 0.4 * i / iterations, 0.01 * i, 40))
+        lines.append('  Convergence reached after %d iterations\n' % iterations)
+    return lines[:nlines]
+
+
+# ---------------------------------------------------------------------------------
+# Times parsing the fitopt output into progress events
+#
+def bench_logs(repeat=3):
+
+    from FitOpt.progress import Progress_Parser
+
+    lines = fitopt_output(log_lines)
+
+    def parse():
+        p = Progress_Parser()
+        for line in lines:
+            p.feed(line)
+    return [('logs/lines=%d' % len(lines), best_time(parse, repeat))]
+
+
+# ---------------------------------------------------------------------------------
+# Times opening movies (indexing their frames) and reading the coordinates of
+# all their frames, in the PDB and in the binary formats
+#
+def bench_trajectory(folder, sizes, repeat=3):
+
+    import numpy
+    from FitOpt.pdbio import atom_lines
+    from FitOpt.trajectory import Binary_Trajectory, Pdb_Trajectory, convert_pdb_trajectory
+
+    results = []
+    for n in sizes:
+        frames = max(2, min(50, movie_atoms // n))
+        atoms = replicated_atoms(n)
+        path = os.path.join(folder, 'movie_%d.pdb' % n)
+        out = open(path, 'wb')
+        records = atom_lines(atoms)
+        for f in range(frames):
+            out.write(('MODEL     %4d\n' % (f + 1)).encode('ascii'))
+            out.write(records.tobytes())
+            out.write(b'ENDMDL\n')
+        out.write(b'END\n')
+        out.close()
+
+        # Coordinates are copied, as the binary ones are views of the mapped file
+        def read(cls, path):
+            t = cls(path) if cls is Binary_Trajectory else cls(path, save_index=False)
+            for f in range(len(t)):
+                numpy.array(t.coordinates(f))
+            t.close()
+
+        name = '/atoms=%d/frames=%d' % (n, frames)
+        results.append(('trajectory/open' + name,
+                        best_time(lambda: Pdb_Trajectory(path, save_index=False).close(), repeat)))
+        results.append(('trajectory/read' + name, best_time(lambda: read(Pdb_Trajectory, path), repeat)))
+        bpath = convert_pdb_trajectory(path)
+        results.append(('trajectory/binary-read' + name, best_time(lambda: read(Binary_Trajectory, bpath), repeat)))
+        os.remove(path)
+        os.remove(bpath)
+    return results
+
+
+# ---------------------------------------------------------------------------------
+# Times a complete fitting of the test structure, translated, into its
+# synthetic map. Nothing is timed if the fitopt binary is not present.
+#
+def bench_fitting(folder, resolutions, fitopt=None):
+
+    from FitOpt.fitjob import Fit_Job, run
+    from FitOpt.pdbio import read_pdb, write_pdb
+
+    fitopt = Fit_Job.fitopt if fitopt is None else fitopt
+    if not os.access(fitopt, os.X_OK):
+        return []
+    results = []
+    atoms = read_pdb(test_pdb)
+    moved = atoms.copy()
+    moved['xyz'] += (2.0, 1.0, -1.0)
+    fitted = os.path.join(folder, 'fitting_start.pdb')
+    write_pdb(fitted, moved)
+    for res in resolutions:
+        map_path = os.path.join(folder, 'fitting_%g.mrc' % res)
+        cutoff = synthetic_map(atoms, res, map_path, 2 * res)
+        job = Fit_Job([fitted], [], map_path, res, cutoff, cwd=os.path.join(folder, 'fitting'), fitopt=fitopt)
+        t0 = time.time()
+        code = run(job, output=lambda line: None)
+        if code == 0:
+            results.append(('fitting/atoms=%d/res=%g' % (len(atoms), res), time.time() - t0))
+    return results
+
+
+# ---------------------------------------------------------------------------------
+# Runs benchmarks of the suite. Returns a list of (name, seconds).
+# folder: folder of the inputs (a temporary one, removed at the end, if None)
+#
+def run_suite(names=benchmarks, sizes=default_sizes, resolutions=default_resolutions, repeat=3,
+              folder=None, fitopt=None):
+
+    temporary = folder is None
+    if temporary:
+        folder = tempfile.mkdtemp(prefix='fitopt_benchmark_')
+    elif not os.path.isdir(folder):
+        os.makedirs(folder)
+    results = []
+    try:
+        for name in names:
+            if name == 'pdbio':
+                for r in bench_pdbio(sizes, repeat):
+                    for k in ('parse_numpy', 'parse_lines', 'write_numpy'):
+                        results.append(('pdbio/%s/atoms=%d' % (k, r['atoms']), r[k]))
+            elif name == 'staging':
+                results.extend(bench_staging(folder, sizes, resolutions, repeat))
+            elif name == 'command':
+                results.extend(bench_command(folder, repeat))
+            elif name == 'logs':
+                results.extend(bench_logs(repeat))
+            elif name == 'trajectory':
+                results.extend(bench_trajectory(folder, sizes, repeat))
+            elif name == 'fitting':
+                results.extend(bench_fitting(folder, resolutions, fitopt))
+            else:
+                raise ValueError('Unknown benchmark %s (%s)' % (name, ', '.join(benchmarks)))
+    finally:
+        if temporary:
+            shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+# ---------------------------------------------------------------------------------
+# Writes the results (list of (name, seconds)) in a JSON file
+#
+def save_results(path, results):
+
+    import platform
+    data = {'format': results_format,
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'results': dict(results)}
+    f = open(path, 'w')
+    json.dump(data, f, indent=1, sort_keys=True)
+    f.close()
+
+
+# ---------------------------------------------------------------------------------
+# Reads the results saved by save_results, as a dictionary name: seconds
+#
+def load_results(path):
+
+    f = open(path)
+    data = json.load(f)
+    f.close()
+    if data.get('format') != results_format:
+        raise ValueError('%s is not a FitOpt benchmark results file' % path)
+    return data['results']
+
+
+# ---------------------------------------------------------------------------------
+# Compares results with a baseline (dictionary name: seconds).
+# Returns a list of (name, seconds, baseline seconds or None, ratio or None,
+# True if it is a regression).
+#
+def compare_results(results, baseline, threshold=default_threshold):
+
+    rows = []
+    for name, t in results:
+        base = baseline.get(name)
+        if base is None or base <= 0:
+            rows.append((name, t, None, None, False))
+            continue
+        ratio = t / base
+        rows.append((name, t, base, ratio, ratio > 1 + threshold and t >= min_seconds))
+    return rows
+
+
+# ---------------------------------------------------------------------------------
+# Runs the benchmarks with the options given in the command line
+#
+def main(argv=None):
+
+    import argparse
+
+    p = argparse.ArgumentParser(prog='python -m FitOpt.benchmark', description='Benchmarks of the FitOpt plugin.')
+    p.add_argument('sizes', nargs='*', type=int, help='atoms of the assemblies (default %s)'
+                   % ' '.join('%d' % n for n in default_sizes))
+    p.add_argument('-b', dest='benchmarks', default=','.join(benchmarks),
+                   help='comma separated benchmarks (default %s)' % ','.join(benchmarks))
+    p.add_argument('--resolutions', default=','.join('%g' % r for r in default_resolutions),
+                   help='comma separated resolutions of the synthetic maps')
+    p.add_argument('--repeat', type=int, default=3, help='runs of every benchmark (the best one is kept)')
+    p.add_argument('--workdir', default=None, help='folder of the inputs (default a temporary one)')
+    p.add_argument('--fitopt', default=None, help='path of the fitopt process')
+    p.add_argument('-o', dest='output', default=None, help='save the results in this JSON file')
+    p.add_argument('--baseline', default=None, help='JSON results to compare with')
+    p.add_argument('--threshold', type=float, default=default_threshold,
+                   help='relative slowdown reported as a regression (default %g)' % default_threshold)
+    args = p.parse_args(argv)
+
+    names = [n.strip() for n in args.benchmarks.split(',') if n.strip()]
+    unknown = [n for n in names if n not in benchmarks]
+    if unknown:
+        p.error('unknown benchmarks %s' % ', '.join(unknown))
+    resolutions = [float(r) for r in args.resolutions.split(',') if r.strip()]
+    results = run_suite(names, args.sizes or default_sizes, resolutions, args.repeat, args.workdir, args.fitopt)
+    if args.output:
+        save_results(args.output, results)
+
+    baseline = load_results(args.baseline) if args.baseline else {}
+    rows = compare_results(results, baseline, args.threshold)
+    out = sys.stdout
+    out.write('%-50s %12s %12s %8s\n' % ('benchmark', 'time (s)', 'baseline', 'ratio'))
+    for name, t, base, ratio, regression in rows:
+        out.write('%-50s %12.4f %12s %8s%s\n' % (name, t, '-' if base is None else '%.4f' % base,
+                                                 '-' if ratio is None else '%.2f' % ratio,
+                                                 '  REGRESSION' if regression else ''))
+    regressions = [r for r in rows if r[4]]
+    if regressions:
+        out.write('%d regressions over %.0f%%\n' % (len(regressions), 100 * args.threshold))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
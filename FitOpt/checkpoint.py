@@ -0,0 +1,337 @@
+# ---------------------------------------------------------------------------------
+# Checkpoints of running fittings, and resuming them.
+#
+# fitopt writes the conformation of every iteration in its movie, so the state
+# of a running fitting can be saved without its help: every interval the
+# newest frame of the movie of the running stage is written in the job
+# workspace as the checkpoint coordinates (one PDB per fitted PDB, with the
+# atoms of the stage input), together with a JSON file with the stage, the
+# number of iterations done and the history of the scores. The checkpoint
+# also keeps the identity of the job (its input files and options), so it only
+# resumes the same fitting: the workspace may be shared by different jobs.
+#
+# A resumed job starts from the checkpoint coordinates, so the iterations done
+# are not repeated, and skips the preliminary stages which were completed
+# (see FitOpt.multires). The checkpoint is removed when the fitting finishes
+# successfully, and kept when it fails or it is cancelled.
+#
+#   python -m FitOpt.fitjob --resume --map map.mrc ... fitted.pdb
+#
+
+import copy
+import hashlib
+import json
+import os
+import time
+
+# Files of the checkpoint in the job workspace
+checkpoint_name = 'fitopt_checkpoint.json'
+coordinates_name = 'fitopt_checkpoint_%d.pdb'
+
+# Version of the checkpoint file
+checkpoint_format = 2
+
+
+# ---------------------------------------------------------------------------------
+# Path of the checkpoint of a workspace
+#
+def checkpoint_path(cwd):
+
+    return os.path.join(cwd, checkpoint_name)
+
+
+# ---------------------------------------------------------------------------------
+# Checkpoint of a workspace as a dictionary (None if there is none, or if it
+# can not be read or its coordinates are missing):
+#
+#   stage        stage running (0 for the first preliminary stage, the number
+#                of preliminary stages for the final one)
+#   coordinates  PDBs to start the stage from
+#   iterations   number of iterations done
+#   scores       [stage, model, iteration, score] of every iteration
+#   time         time (time.time()) when it was written
+#   job          identity of the job checkpointed (see job_identity)
+#
+# If a job is given, None is also returned when the checkpoint is of another job.
+#
+def load_checkpoint(cwd, job=None):
+
+    try:
+        f = open(checkpoint_path(cwd))
+        try:
+            checkpoint = json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+    if checkpoint.get('format') != checkpoint_format:
+        return None
+    if not all(os.path.exists(p) for p in checkpoint['coordinates']):
+        return None
+    if job is not None and checkpoint.get('job') != job_identity(job):
+        return None
+    return checkpoint
+
+
+# ---------------------------------------------------------------------------------
+# Identity of a job: a hash of its input files (path, size and modification
+# time, as FitOpt.server.file_key, so the inputs are not read) and of its
+# normalized options (as the Result_Cache key). Changing the models, the map
+# or the options gives another identity.
+#
+def job_identity(job):
+
+    from FitOpt.resultcache import job_options
+
+    h = hashlib.sha1()
+    for label, paths in (('fitted', job.fitted), ('fixed', job.fixed), ('map', [job.map_path])):
+        h.update(label.encode('ascii'))
+        for path in paths:
+            st = os.stat(path)
+            h.update(('%s %d %r\0' % (os.path.abspath(path), st.st_size, st.st_mtime)).encode('utf-8'))
+    h.update('\0'.join(job_options(job)).encode('utf-8'))
+    return h.hexdigest()
+
+
+# ---------------------------------------------------------------------------------
+# Job continuing a job from the checkpoint of its workspace (None if there is
+# no checkpoint, or if it is of a job with other inputs or options)
+#
+def resume_job(job):
+
+    try:
+        checkpoint = load_checkpoint(job.cwd, job)
+    except OSError:
+        # Missing input files
+        return None
+    if checkpoint is None:
+        return None
+    stage = checkpoint['stage'] - job.first_stage
+    if not 0 <= stage <= len(job.stages):
+        return None
+    r = copy.copy(job)
+    r.fitted = list(checkpoint['coordinates'])
+    r.stages = job.stages[stage:]
+    r.first_stage = checkpoint['stage']
+    r.resumed = checkpoint
+    return r
+
+
+# ---------------------------------------------------------------------------------
+# Writer of the checkpoints of a running job
+#
+class Checkpoint_Writer:
+
+    # -------------------------------------------------
+    # job: Fit_Job running (with its preliminary stages, if any)
+    # interval: minimum seconds between two checkpoints
+    #
+    def __init__(self, job, interval):
+
+        from FitOpt.progress import Progress_Parser
+
+        self.job = job
+        self.interval = interval
+        self.last_write = time.time()
+        self.parser = Progress_Parser()
+        resumed = job.resumed or {}
+        # A resumed job keeps the identity of the job it continues (its
+        # inputs are the checkpoint coordinates)
+        self.identity = resumed['job'] if 'job' in resumed else job_identity(job)
+        self.iterations = resumed.get('iterations', 0)
+        self.scores = [list(s) for s in resumed.get('scores', [])]
+        self.stage = None
+        # Stage job, its movie tail and the atoms of its input (read when needed)
+        self.stage_job = None
+        self.tail = None
+        self.atoms = None
+        # Coordinates of the last checkpoint
+        self.coordinates = None
+
+    # ---------------------------------------------------------------------------
+    # Sets the stage running: stage is its index in the stages of the job
+    # (counting the preliminary stages done before it was resumed), stage_job
+    # its Fit_Job
+    #
+    def set_stage(self, stage, stage_job):
+
+        from FitOpt.livemovie import Trajectory_Tail
+        from FitOpt.progress import Progress_Parser
+
+        if stage == self.stage:
+            return
+        self.stage = stage
+        self.stage_job = stage_job
+        self.tail = Trajectory_Tail(stage_job.movie_path())
+        self.atoms = None
+        self.coordinates = list(stage_job.fitted)
+        self.parser = Progress_Parser()
+
+    # ---------------------------------------------------------------------------
+    # Records the iterations of some output lines of the running stage
+    #
+    def feed(self, lines):
+
+        from FitOpt.progress import ITERATION
+
+        for line in lines:
+            e = self.parser.feed(line)
+            if e is not None and e.kind == ITERATION:
+                self.iterations += 1
+                self.scores.append([self.stage, e.model, e.iteration, e.score])
+
+    # ---------------------------------------------------------------------------
+    # Writes a checkpoint if the interval since the last one has passed
+    # (always with force)
+    #
+    def update(self, force=False):
+
+        if self.stage is None:
+            return
+        now = time.time()
+        if not force and now - self.last_write < self.interval:
+            return
+        self.last_write = now
+        self.read_coordinates()
+        self.write()
+
+    # ---------------------------------------------------------------------------
+    # Writes the newest frame of the movie of the stage as the checkpoint
+    # coordinates. Frames whose atoms are not the ones of the stage input
+    # (the movie of a coarse-grained model) are not used, and the stage then
+    # starts again from its input.
+    #
+    def read_coordinates(self):
+
+        from FitOpt.partition import split_models
+        from FitOpt.pdbio import read_pdb, write_pdb
+
+        frames = self.tail.poll(last_only=True)
+        if not frames:
+            return
+        if self.atoms is None:
+            self.atoms = read_pdb(self.stage_job.input_path())
+        xyz = frames[-1][1]
+        if len(xyz) != len(self.atoms):
+            return
+
+        atoms = self.atoms.copy()
+        atoms['xyz'] = xyz
+        paths = []
+        for i, part in enumerate(split_models(atoms, self.stage_job.fitted)):
+            path = os.path.join(self.job.cwd, coordinates_name % (i + 1))
+            # Written with another name and renamed, so it is never seen half written
+            write_pdb(path + '.tmp', part)
+            os.rename(path + '.tmp', path)
+            paths.append(path)
+        self.coordinates = paths
+
+    # ---------------------------------------------------------------------------
+    # Writes the checkpoint file
+    #
+    def write(self):
+
+        checkpoint = {'format': checkpoint_format, 'stage': self.stage, 'coordinates': self.coordinates,
+                      'iterations': self.iterations, 'scores': self.scores, 'time': time.time(),
+                      'job': self.identity}
+        path = checkpoint_path(self.job.cwd)
+        f = open(path + '.tmp', 'w')
+        json.dump(checkpoint, f)
+        f.close()
+        os.rename(path + '.tmp', path)
+
+    # ---------------------------------------------------------------------------
+    # Removes the checkpoint file (the job has finished successfully). The
+    # coordinates are kept, as they may be the inputs of the job.
+    #
+    def remove(self):
+
+        path = checkpoint_path(self.job.cwd)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# ---------------------------------------------------------------------------------
+# Process of a job writing its checkpoints, with the same interface as
+# Fit_Process. The checkpoints are written while the output is read.
+#
+class Checkpointed_Process:
+
+    # -------------------------------------------------
+    # process: process of the job (Fit_Process or multires.Staged_Process)
+    # job: Fit_Job of the process
+    # interval: minimum seconds between two checkpoints
+    #
+    def __init__(self, process, job, interval):
+
+        self.process = process
+        self.job = job
+        self.writer = Checkpoint_Writer(job, interval)
+        self.closed = False
+
+    def start(self):
+
+        self.process.start()
+
+    # ---------------------------------------------------------------------------
+    # Stage running and its Fit_Job
+    #
+    def current_stage(self):
+
+        p = self.process
+        if hasattr(p, 'jobs'):
+            return self.job.first_stage + p.current, p.jobs[p.current]
+        return self.job.first_stage, self.job
+
+    # ---------------------------------------------------------------------------
+    # Returns the lines produced by the process since the last call, writing a
+    # checkpoint when it is due
+    #
+    def new_lines(self, max_lines=None):
+
+        # The stage is read before the lines, which may start the next one
+        self.writer.set_stage(*self.current_stage())
+        lines = self.process.new_lines(max_lines)
+        self.writer.feed(lines)
+        if self.process.finished():
+            self.close()
+        elif not self.closed:
+            self.writer.update()
+        return lines
+
+    # ---------------------------------------------------------------------------
+    # When the process has finished, the checkpoint is written for the last
+    # time, or removed if the process has succeeded
+    #
+    def close(self):
+
+        if self.closed:
+            return
+        self.closed = True
+        if self.process.returncode() == 0:
+            self.writer.remove()
+        else:
+            self.writer.update(force=True)
+
+    def finished(self):
+
+        return self.process.finished()
+
+    def returncode(self):
+
+        return self.process.returncode()
+
+    def wait(self):
+
+        code = self.process.wait()
+        self.close()
+        return code
+
+    # ---------------------------------------------------------------------------
+    # Stops the process, writing a checkpoint of its last state
+    #
+    def cancel(self):
+
+        self.writer.set_stage(*self.current_stage())
+        self.writer.update(force=True)
+        self.process.cancel()
@@ -0,0 +1,301 @@
+# ---------------------------------------------------------------------------------
+# Steric clashes between the fitted models and the fixed ones.
+#
+# Two atoms clash when their Van der Waals spheres overlap more than
+# clash_overlap (as in the Chimera Find Clashes tool), and they interpenetrate
+# when they overlap more than penetration_overlap (the fitted chain has been
+# pushed through the fixed model). The fixed models do not move, so they are
+# indexed once (FitOpt.spatial.Cell_Index) and every conformation of the fitted
+# models (the fitted result or a frame of the movie) is checked with one
+# vectorized neighbor search.
+#
+#   python -m FitOpt.clashes fitopt_fitted.pdb fixed1.pdb [fixed2.pdb ...]
+#
+
+import sys
+
+import numpy
+
+# Van der Waals radii (A) of the elements (Bondi), and of the unknown ones
+vdw_radii = {b'H': 1.1, b'C': 1.7, b'N': 1.55, b'O': 1.52, b'P': 1.8, b'S': 1.8, b'SE': 1.9,
+             b'MG': 1.73, b'ZN': 1.39, b'FE': 1.8, b'CA': 1.7}
+default_radius = 1.7
+
+# Overlap (A) of two atoms which clash and which interpenetrate
+clash_overlap = 0.6
+penetration_overlap = 1.5
+
+
+# ---------------------------------------------------------------------------------
+# Van der Waals radii of atoms read with FitOpt.pdbio
+#
+def atom_radii(atoms):
+
+    elements = numpy.char.upper(numpy.char.strip(atoms['element']))
+    radii = numpy.full(len(atoms), default_radius)
+    for e, r in vdw_radii.items():
+        radii[elements == e] = r
+    return radii
+
+
+# ---------------------------------------------------------------------------------
+# Finds the clashes of conformations of some atoms with fixed atoms
+#
+class Clash_Detector:
+
+    # -------------------------------------------------
+    # fixed: atoms of the fixed models (FitOpt.pdbio array)
+    # models: index of the fixed model of every atom (None if there is one)
+    #
+    def __init__(self, fixed, models=None):
+
+        from FitOpt.spatial import Cell_Index
+
+        self.fixed = fixed
+        # PDBs of the fixed models (if they were read with from_files)
+        self.paths = None
+        self.models = numpy.zeros(len(fixed), int) if models is None else numpy.asarray(models)
+        self.radii = atom_radii(fixed)
+        # Atoms further than this can not clash
+        self.distance = 2 * max(vdw_radii.values()) - clash_overlap
+        self.index = Cell_Index(fixed['xyz'], 0.5 * self.distance)
+        if len(fixed) > 0:
+            self.lo = fixed['xyz'].min(axis=0) - self.distance
+            self.hi = fixed['xyz'].max(axis=0) + self.distance
+
+    # ---------------------------------------------------------------------------
+    # Detector of the fixed models of a list of PDBs
+    #
+    @classmethod
+    def from_files(cls, paths):
+
+        from FitOpt.pdbio import read_pdb
+        parts = [read_pdb(p) for p in paths]
+        detector = cls(numpy.concatenate(parts), model_indices(parts))
+        detector.paths = list(paths)
+        return detector
+
+    # ---------------------------------------------------------------------------
+    # Clashing pairs of atoms as arrays: moving atom indices, fixed atom indices
+    # and overlaps (A)
+    # xyz: (atoms, 3) coordinates, radii: their Van der Waals radii
+    #
+    def clashes(self, xyz, radii):
+
+        xyz = numpy.asarray(xyz, numpy.float64)
+        none = numpy.zeros(0, int), numpy.zeros(0, int), numpy.zeros(0)
+        if len(self.fixed) == 0 or len(xyz) == 0:
+            return none
+        # Only the atoms around the fixed models are searched
+        near = numpy.flatnonzero(((xyz >= self.lo) & (xyz <= self.hi)).all(axis=1))
+        if len(near) == 0:
+            return none
+        pairs = self.index.neighbors(xyz[near], self.distance)
+        i, j = near[pairs[:, 0]], pairs[:, 1]
+        d = xyz[i] - self.fixed['xyz'][j]
+        overlap = radii[i] + self.radii[j] - numpy.sqrt((d * d).sum(axis=1))
+        clash = overlap >= clash_overlap
+        return i[clash], j[clash], overlap[clash]
+
+    # ---------------------------------------------------------------------------
+    # Clash_Report of some atoms (FitOpt.pdbio array), in their coordinates or
+    # in the ones given
+    # models: index of the moving model of every atom (None if there is one)
+    #
+    def report(self, atoms, xyz=None, models=None):
+
+        if xyz is None:
+            xyz = atoms['xyz']
+        i, j, overlap = self.clashes(xyz, atom_radii(atoms))
+        return Clash_Report(atoms, self.fixed, i, j, overlap,
+                            numpy.zeros(len(atoms), int) if models is None else numpy.asarray(models),
+                            self.models)
+
+
+# ---------------------------------------------------------------------------------
+# Clashes of the fitted models with the fixed ones
+#
+class Clash_Report:
+
+    # -------------------------------------------------
+    # fitted, fixed: atoms (FitOpt.pdbio arrays)
+    # i, j, overlap: clashing pairs (fitted, fixed atom indices) and overlaps
+    # fitted_models, fixed_models: index of the model of every atom
+    #
+    def __init__(self, fitted, fixed, i, j, overlap, fitted_models, fixed_models):
+
+        self.fitted = fitted
+        self.fixed = fixed
+        self.i = i
+        self.j = j
+        self.overlap = overlap
+        self.fitted_models = fitted_models
+        self.fixed_models = fixed_models
+
+    def __len__(self):
+
+        return len(self.i)
+
+    # ---------------------------------------------------------------------------
+    # Number of interpenetrating pairs of atoms
+    #
+    def penetrations(self):
+
+        return int((self.overlap >= penetration_overlap).sum())
+
+    # ---------------------------------------------------------------------------
+    # Largest overlap (A), 0 if there are no clashes
+    #
+    def max_overlap(self):
+
+        return float(self.overlap.max()) if len(self.overlap) else 0.0
+
+    # ---------------------------------------------------------------------------
+    # Number of clashes and of interpenetrating pairs and largest overlap of
+    # every (fitted model, fixed model) pair with clashes, sorted by model
+    #
+    def model_pairs(self):
+
+        if len(self) == 0:
+            return []
+        a, b = self.fitted_models[self.i], self.fixed_models[self.j]
+        result = []
+        for m1, m2 in sorted(set(zip(a.tolist(), b.tolist()))):
+            sel = (a == m1) & (b == m2)
+            o = self.overlap[sel]
+            result.append((m1, m2, int(sel.sum()), int((o >= penetration_overlap).sum()), float(o.max())))
+        return result
+
+    # ---------------------------------------------------------------------------
+    # Clashing residues (model, chain, number, insertion code) of the fitted
+    # atoms and of the fixed ones
+    #
+    def fitted_residues(self):
+
+        return residue_keys(self.fitted, self.fitted_models, self.i)
+
+    def fixed_residues(self):
+
+        return residue_keys(self.fixed, self.fixed_models, self.j)
+
+    # ---------------------------------------------------------------------------
+    # Clashing pairs of residues, sorted, as (fitted residue, fixed residue,
+    # fitted atom index, fixed atom index): the residues as given by
+    # fitted_residues and fixed_residues, and the pair of atoms of the two
+    # residues with the largest overlap
+    #
+    def residue_pairs(self):
+
+        if len(self) == 0:
+            return []
+        fitted = residue_key_list(self.fitted, self.fitted_models, self.i)
+        fixed = residue_key_list(self.fixed, self.fixed_models, self.j)
+        worst = {}
+        for k in numpy.argsort(-self.overlap, kind='stable').tolist():
+            pair = (fitted[k], fixed[k])
+            if pair not in worst:
+                worst[pair] = (int(self.i[k]), int(self.j[k]))
+        return [(r1, r2) + worst[(r1, r2)] for r1, r2 in sorted(worst)]
+
+    # ---------------------------------------------------------------------------
+    # Text of the report, one line per pair of models with clashes
+    # names: names of the fitted and of the fixed models (numbers if None)
+    #
+    def summary(self, fitted_names=None, fixed_names=None):
+
+        if len(self) == 0:
+            return 'No clashes with the fixed models'
+        lines = ['%d clashes (%d interpenetrating), max overlap %.2f A'
+                 % (len(self), self.penetrations(), self.max_overlap())]
+        for m1, m2, n, p, o in self.model_pairs():
+            lines.append('  %s - %s: %d clashes, %d interpenetrating, max overlap %.2f A'
+                         % (model_name(fitted_names, m1), model_name(fixed_names, m2), n, p, o))
+        return '\n'.join(lines)
+
+
+# ---------------------------------------------------------------------------------
+# Unique residues (model, chain, number, insertion code) of some atoms
+#
+def residue_keys(atoms, models, indices):
+
+    if len(indices) == 0:
+        return []
+    return sorted(set(residue_key_list(atoms, models, numpy.unique(indices))))
+
+
+# ---------------------------------------------------------------------------------
+# Residues (model, chain, number, insertion code) of some atoms, one per index
+#
+def residue_key_list(atoms, models, indices):
+
+    keys = zip(models[indices].tolist(), atoms['chain'][indices].tolist(),
+               atoms['resseq'][indices].tolist(), atoms['icode'][indices].tolist())
+    return [(m, c.strip().decode(), r, i.strip().decode()) for m, c, r, i in keys]
+
+
+def model_name(names, k):
+
+    return names[k] if names is not None and k < len(names) else '#%d' % (k + 1)
+
+
+# ---------------------------------------------------------------------------------
+# Index of the model of every fitted atom: by model number if there is one per
+# fitted model, otherwise by the number of atoms of every fitted PDB
+#
+def fitted_model_indices(atoms, paths):
+
+    from FitOpt.partition import split_models
+    parts = split_models(atoms, paths)
+    if sum(len(p) for p in parts) != len(atoms):
+        return numpy.zeros(len(atoms), int)
+    return model_indices(parts)
+
+
+# ---------------------------------------------------------------------------------
+# Index of the part of every atom of a list of atom arrays
+#
+def model_indices(parts):
+
+    return numpy.concatenate([numpy.full(len(p), k, int) for k, p in enumerate(parts)])
+
+
+# ---------------------------------------------------------------------------------
+# Clash report of the results of a Fit_Job
+#
+def job_report(job, detector=None):
+
+    from FitOpt.pdbio import read_pdb
+    if detector is None:
+        detector = Clash_Detector.from_files(job.fixed)
+    atoms = read_pdb(job.fitted_path())
+    return detector.report(atoms, models=fitted_model_indices(atoms, job.fitted))
+
+
+# ---------------------------------------------------------------------------------
+# Reports the clashes of a fitted PDB with fixed PDBs given in the command line
+#
+def main(argv=None):
+
+    import os
+    from FitOpt.pdbio import read_pdb
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) < 2:
+        sys.stderr.write('Usage: python -m FitOpt.clashes fitted.pdb fixed.pdb [fixed.pdb ...]\n')
+        return 2
+    detector = Clash_Detector.from_files(argv[1:])
+    atoms = read_pdb(argv[0])
+    numbers = sorted(set(atoms['model'].tolist()))
+    models = numpy.searchsorted(numbers, atoms['model'])
+    report = detector.report(atoms, models=models)
+    out = sys.stdout
+    out.write(report.summary(['%s #%d' % (os.path.basename(argv[0]), n) for n in numbers],
+                             [os.path.basename(p) for p in argv[1:]]) + '\n')
+    for m, chain, number, icode in report.fitted_residues():
+        out.write('  fitted #%d %s %d%s\n' % (numbers[m], chain, number, icode))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
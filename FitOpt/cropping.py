@@ -0,0 +1,105 @@
+# ---------------------------------------------------------------------------------
+# Cropping of the map around the fitted and fixed models.
+#
+# FitOpt only uses the density around the models, so the map given to fitopt is
+# cut to the bounding box of the models plus a margin which depends on the
+# resolution (the simulated density spreads about one resolution around the
+# atoms, and the models move during the fitting). The cropped map keeps the
+# grid spacing and the position of the original one (its origin is the one of
+# the first grid point kept), so the fitted coordinates are in the frame of the
+# original map.
+#
+
+import os
+
+import numpy
+
+# Margin around the models: margin_resolutions * resolution + margin_minimum (A)
+margin_resolutions = 2.0
+margin_minimum = 10.0
+
+# Maps are only cropped if the cropped map has less than this fraction of the
+# original grid points
+max_fraction = 0.9
+
+
+# ---------------------------------------------------------------------------------
+# Margin (A) around the models for a map resolution
+#
+def crop_margin(resolution):
+
+    return margin_resolutions * float(resolution) + margin_minimum
+
+
+# ---------------------------------------------------------------------------------
+# Bounding box (min and max x, y, z) of the atoms of several PDBs
+#
+def model_bounds(paths):
+
+    from FitOpt.pdbio import parse_coordinates
+
+    lo, hi = None, None
+    for path in paths:
+        f = open(path, 'rb')
+        xyz = parse_coordinates(f.read(), numpy.float64)
+        f.close()
+        if len(xyz) == 0:
+            continue
+        pmin, pmax = xyz.min(axis=0), xyz.max(axis=0)
+        lo = pmin if lo is None else numpy.minimum(lo, pmin)
+        hi = pmax if hi is None else numpy.maximum(hi, pmax)
+    return lo, hi
+
+
+# ---------------------------------------------------------------------------------
+# Box of grid points (ijk_min, ijk_max as x, y, z, the maximum not included) of
+# a FitOpt.density.Grid around the given bounds (plus the margin), clipped to
+# the grid. Returns None if there are no bounds or if the box does not reduce
+# the grid enough.
+#
+def crop_box(grid, bounds, margin):
+
+    lo, hi = bounds
+    if lo is None:
+        return None
+    size = numpy.array(grid.shape[::-1])
+    ijk_min = numpy.floor((lo - margin - grid.origin) / grid.step).astype(int)
+    ijk_max = numpy.ceil((hi + margin - grid.origin) / grid.step).astype(int) + 1
+    ijk_min = numpy.clip(ijk_min, 0, size)
+    ijk_max = numpy.clip(ijk_max, ijk_min, size)
+    points = int(numpy.prod(ijk_max - ijk_min))
+    if points == 0 or points > max_fraction * int(numpy.prod(size)):
+        return None
+    return tuple(ijk_min.tolist()), tuple(ijk_max.tolist())
+
+
+# ---------------------------------------------------------------------------------
+# Writes the box of an MRC map around the given bounds (plus the margin).
+# Returns the number of grid points of the cropped and of the original map,
+# or None if the map is not an MRC / CCP4 map or cropping does not reduce it
+# enough (then nothing is written).
+#
+def crop_map(map_path, bounds, margin, output):
+
+    from FitOpt.mrcmap import Mrc_Map, is_mrc, write_mrc
+
+    if bounds[0] is None or not is_mrc(map_path):
+        return None
+    m = Mrc_Map(map_path)
+    try:
+        box = crop_box(m.grid(), bounds, margin)
+        if box is None:
+            return None
+        region = m.region(*box)
+        write_mrc(output, region, m.region_grid(*box), label=crop_label(map_path))
+        return region.size, int(numpy.prod(m.size))
+    finally:
+        m.close()
+
+
+# ---------------------------------------------------------------------------------
+# Label of a cropped map
+#
+def crop_label(map_path):
+
+    return 'FitOpt cropped %s' % os.path.basename(map_path)
@@ -0,0 +1,242 @@
+# ---------------------------------------------------------------------------------
+# Simulated density maps of atomic models.
+#
+# The atoms are spread with trilinear weights on the grid of the target map and
+# the result is convolved with a Gaussian of the map resolution, like the
+# Chimera molmap command (sigma = 0.225 * resolution). The Gaussian is separable,
+# so the convolution is done axis by axis with FFTs, slab after slab to bound
+# the memory used. Only the box around the atoms is convolved.
+#
+# Grids follow the Chimera volume conventions: origin and step are x, y, z and
+# arrays are indexed [z, y, x].
+#
+
+import numpy
+
+# Gaussian width / resolution (as molmap)
+sigma_factor = 1 / (numpy.pi * numpy.sqrt(2))
+
+# The Gaussian is truncated at this many sigmas (as molmap)
+cutoff_range = 5
+
+# Maximum number of grid points transformed at once
+max_chunk = 1 << 23
+
+# Atomic numbers used as atom weights (other elements weigh as carbon)
+element_weights = {b'H': 1, b'C': 6, b'N': 7, b'O': 8, b'P': 15, b'S': 16, b'SE': 34,
+                   b'MG': 12, b'ZN': 30, b'FE': 26, b'CA': 20}
+
+
+# ---------------------------------------------------------------------------------
+# Grid of a map: origin and step (x, y, z) and shape (z, y, x)
+#
+class Grid:
+
+    def __init__(self, origin, step, shape):
+
+        self.origin = numpy.array(origin, numpy.float64)
+        self.step = numpy.array(step, numpy.float64) * numpy.ones(3)
+        self.shape = tuple(int(s) for s in shape)
+
+    # ---------------------------------------------------------------------------
+    # Grid of a Chimera volume
+    #
+    @classmethod
+    def from_volume(cls, volume):
+
+        return cls.from_data(volume.data)
+
+    # ---------------------------------------------------------------------------
+    # Grid of a Chimera VolumeData grid
+    #
+    @classmethod
+    def from_data(cls, data):
+
+        xsize, ysize, zsize = data.size
+        return cls(data.origin, data.step, (zsize, ysize, xsize))
+
+    # ---------------------------------------------------------------------------
+    # Grid indices (x, y, z) of points, as floats
+    #
+    def ijk(self, xyz):
+
+        return (numpy.asarray(xyz, numpy.float64) - self.origin) / self.step
+
+
+# ---------------------------------------------------------------------------------
+# Weights of atoms read with FitOpt.pdbio (atomic numbers)
+#
+def atom_weights(atoms):
+
+    elements = numpy.char.upper(numpy.char.strip(atoms['element']))
+    weights = numpy.full(len(atoms), 6, numpy.float32)
+    for e, w in element_weights.items():
+        weights[elements == e] = w
+    return weights
+
+
+# ---------------------------------------------------------------------------------
+# Simulated density of atoms on a grid, as a float32 array indexed [z, y, x].
+# xyz: (atoms, 3) coordinates, weights: atom weights (1 if None)
+#
+def simulate_map(xyz, grid, resolution, weights=None):
+
+    out = numpy.zeros(grid.shape, numpy.float32)
+    box, lo = simulate_box(xyz, grid, resolution, weights)
+    if box is not None:
+        out[box_slices(box, lo)] = box
+    return out
+
+
+# ---------------------------------------------------------------------------------
+# Simulated density in the box of the grid around the atoms (the density is
+# zero out of it). Returns the box array, indexed [z, y, x], and the grid
+# indices (x, y, z) of its first point (None, None if the atoms are out of the grid).
+#
+def simulate_box(xyz, grid, resolution, weights=None):
+
+    sigma = sigma_factor * resolution / grid.step
+    radius = numpy.ceil(cutoff_range * sigma).astype(int)
+    ijk = grid.ijk(xyz)
+    if len(ijk) == 0:
+        return None, None
+
+    # Box (x, y, z) of grid points that can get density
+    size = numpy.array(grid.shape[::-1])
+    lo = numpy.maximum(numpy.floor(ijk.min(axis=0)).astype(int) - radius, 0)
+    hi = numpy.minimum(numpy.floor(ijk.max(axis=0)).astype(int) + radius + 2, size)
+    if (hi <= lo).any():
+        return None, None
+
+    box = splat(ijk - lo, tuple(hi - lo), weights)
+    for axis in range(3):
+        # Array axis 2 is x
+        convolve_axis(box, gaussian_kernel(sigma[axis], radius[axis]), 2 - axis)
+    return box, lo
+
+
+# ---------------------------------------------------------------------------------
+# Slices of a grid array covered by a box starting at the grid indices lo (x, y, z)
+#
+def box_slices(box, lo):
+
+    nz, ny, nx = box.shape
+    return (slice(lo[2], lo[2] + nz), slice(lo[1], lo[1] + ny), slice(lo[0], lo[0] + nx))
+
+
+# ---------------------------------------------------------------------------------
+# Spreads weighted points to the 8 grid points around them (trilinear weights).
+# ijk: (points, 3) float grid indices (x, y, z), size: grid size (x, y, z).
+# Returns a float32 array indexed [z, y, x]. Points outside the grid are ignored.
+# The weights are summed in double precision by slabs of at most max_chunk
+# grid points, so only the float32 array has the size of the grid.
+#
+def splat(ijk, size, weights=None):
+
+    nx, ny, nz = size
+    base = numpy.floor(ijk).astype(numpy.int64)
+    frac = ijk - base
+    if weights is None:
+        weights = numpy.ones(len(ijk))
+
+    # Grid point (flat index) and weight of the 8 corners of each point
+    flats, ws = [], []
+    for corner in range(8):
+        offset = numpy.array(((corner >> 0) & 1, (corner >> 1) & 1, (corner >> 2) & 1))
+        c = base + offset
+        w = weights * numpy.prod(numpy.where(offset, frac, 1 - frac), axis=1)
+        inside = ((c >= 0) & (c < size)).all(axis=1)
+        flats.append((c[inside, 2] * ny + c[inside, 1]) * nx + c[inside, 0])
+        ws.append(w[inside])
+    flat = numpy.concatenate(flats)
+    w = numpy.concatenate(ws)
+    order = numpy.argsort(flat, kind='stable')
+    flat, w = flat[order], w[order]
+
+    out = numpy.zeros(nx * ny * nz, numpy.float32)
+    step = max(1, max_chunk // (nx * ny)) * nx * ny
+    for start in range(0, len(out), step):
+        stop = min(start + step, len(out))
+        i, j = numpy.searchsorted(flat, (start, stop))
+        if i < j:
+            out[start:stop] = numpy.bincount(flat[i:j] - start, w[i:j], stop - start)
+    return out.reshape((nz, ny, nx))
+
+
+# ---------------------------------------------------------------------------------
+# Normalized 1D Gaussian sampled at -radius ... radius grid points
+#
+def gaussian_kernel(sigma, radius):
+
+    x = numpy.arange(-radius, radius + 1)
+    k = numpy.exp(-0.5 * (x / sigma) ** 2)
+    return k / k.sum()
+
+
+# ---------------------------------------------------------------------------------
+# Convolves an array in place with a 1D kernel (of odd length) along one axis.
+# The zero padded FFTs are computed in slabs of at most max_chunk points.
+#
+def convolve_axis(a, kernel, axis):
+
+    rfft, irfft = fft_functions()
+    n = a.shape[axis]
+    radius = len(kernel) // 2
+    nfft = fft_size(n + len(kernel) - 1)
+    shape = [1, 1, 1]
+    shape[axis] = nfft // 2 + 1
+    kf = rfft(kernel.astype(a.dtype), nfft).reshape(shape)
+
+    # Slabs along the first axis which is not the convolved one
+    other = 1 if axis == 0 else 0
+    per_slab = max(1, max_chunk // (nfft * a.size // (n * a.shape[other])))
+    index = [slice(None)] * 3
+    for s in range(0, a.shape[other], per_slab):
+        index[other] = slice(s, s + per_slab)
+        slab = a[tuple(index)]
+        c = irfft(rfft(slab, nfft, axis=axis) * kf, nfft, axis=axis)
+        a[tuple(index)] = numpy.take(c, numpy.arange(radius, radius + n), axis=axis)
+
+
+# ---------------------------------------------------------------------------------
+# Smallest size >= n with only 2, 3 and 5 as prime factors (fast FFT sizes)
+#
+def fft_size(n):
+
+    best = 1
+    while best < n:
+        best *= 2
+    p5 = 1
+    while p5 < 2 * n:
+        p35 = p5
+        while p35 < 2 * n:
+            m = p35
+            while m < n:
+                m *= 2
+            best = min(best, m)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+# ---------------------------------------------------------------------------------
+# Real FFT functions: the SciPy ones if available (single precision and
+# multithreaded), otherwise the NumPy ones
+#
+def fft_functions():
+
+    try:
+        import scipy.fft
+    except ImportError:
+        return numpy.fft.rfft, numpy.fft.irfft
+
+    import os
+    workers = os.cpu_count() if hasattr(os, 'cpu_count') else 1
+
+    def rfft(a, n, axis=-1):
+        return scipy.fft.rfft(a, n, axis=axis, workers=workers)
+
+    def irfft(a, n, axis=-1):
+        return scipy.fft.irfft(a, n, axis=axis, workers=workers)
+
+    return rfft, irfft
@@ -0,0 +1,525 @@
+# ---------------------------------------------------------------------------------
+# FitOpt jobs without Chimera.
+#
+# A Fit_Job keeps the specification of a fitting (PDBs to be fitted and fixed,
+# map, resolution, cut-off level and FitOpt options) and builds the command line
+# of the fitopt process. It is used by the Chimera dialog and it can be run from
+# batch scripts or from the command line:
+#
+#   python -m FitOpt.fitjob --map map.mrc --resolution 10 --cutoff 0.02 \
+#       --fixed fixed1.pdb --fixed fixed2.pdb fitted1.pdb fitted2.pdb
+#
+#   python -m FitOpt.fitjob --map map.mrc --resolution 10 --cutoff 0.02 \
+#       --stages "3x:0 1.5x:1" fitted.pdb
+#
+
+import os
+import sys
+
+from FitOpt import timing
+from FitOpt.fitprocess import Fit_Process
+
+
+# ---------------------------------------------------------------------------------
+# Specification of a FitOpt fitting
+#
+class Fit_Job:
+
+    # Default path of the FitOpt process (next to this module)
+    fitopt = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fitopt')
+
+    # Name of the staged PDB with the models to be fitted
+    input_name = "fitopt_input.pdb"
+    # Name of the staged PDB with the models to be fixed
+    fixed_name = "fitopt_fixed.pdb"
+    # Name of the fitted pdb generated after FitOpt process
+    fitted_name = "fitopt_fitted.pdb"
+    # Name of the trajectory movie
+    movie_name = "fitopt_movie.pdb"
+    # Name of the staged map cropped around the models
+    cropped_map_name = "fitopt_map.mrc"
+    # Name of the staged map filtered to the job resolution
+    filtered_map_name = "fitopt_filtered.mrc"
+    # Name of the timing trace of the run (see FitOpt.timing)
+    trace_name = "fitopt_trace.json"
+    # Seconds between two checkpoints of the running fitting (None for no
+    # checkpoints, see FitOpt.checkpoint)
+    checkpoint_interval = 60.0
+    # Maximum number of processes of the partition groups running at the same
+    # time (None for one per core). The queues running the job set it to
+    # their share of the processes.
+    max_running = None
+
+    # ---------------------------
+    # FitOpt Chimera Commands
+
+    # More PDBs
+    fitopt_chimera_morepdbs = "--morepdbs"
+
+    # PDB Reference (the PDBs to be fixed)
+    fitopt_chimera_pdb_ref = "--pdb_ref"
+
+    # Trajectory (movie)
+    fitopt_chimera_t = "-t"
+
+    # Fixing diagonalization
+    fitopt_chimera_r = "-r"
+
+    # Rediagonalization
+    fitopt_chimera_re = "--rediag"
+
+    # Coarse-grained model
+    fitopt_chimera_m = "-m"
+
+    # Modes range
+    fitopt_chimera_n = "-n"
+
+    # -------------------------------------------------
+    # fitted: paths of the PDBs to be fitted
+    # fixed: paths of the PDBs to be fixed
+    # map_path: path of the density map
+    # resolution, cutoff: resolution and cut-off level of the map
+    # model: coarse-grained model ("0" CA, "1" 3BB2R, "2" full atom)
+    # modes: fraction (<= 1) or number of modes
+    # fixing: fraction of fixed degrees of freedom
+    # rediag: rediagonalization threshold
+    # adv_commands: advanced commands appended to the command line
+    # cwd: workspace where the process is executed and its results written
+    # fitopt: path of the FitOpt process
+    # crop: give FitOpt the map cropped around the fitted and fixed models
+    # crop_margin: margin (A) around the models (by default, it depends on the resolution)
+    # stages: (resolution, model) of the preliminary stages of a multi-stage
+    #         fitting (see FitOpt.multires)
+    # map_resolution: resolution of the map, if it is better than the job
+    #                 resolution (the map is low-pass filtered to the job resolution)
+    # partition: fit the groups of distant models in parallel (see FitOpt.partition)
+    # map_cache: FitOpt.server.Map_Cache preparing the cropped and filtered maps
+    #            from the maps kept in memory (None to prepare them from the files)
+    #
+    def __init__(self, fitted, fixed, map_path, resolution, cutoff,
+                 model="2", modes="0.05", fixing="0", rediag="0",
+                 adv_commands=(), cwd=None, fitopt=None, crop=False, crop_margin=None,
+                 stages=(), map_resolution=None, partition=False, map_cache=None):
+
+        self.fitted = list(fitted)
+        self.fixed = list(fixed)
+        self.map_path = map_path
+        self.resolution = str(resolution)
+        self.cutoff = str(cutoff)
+        self.model = str(model)
+        self.modes = str(modes)
+        self.fixing = str(fixing)
+        self.rediag = str(rediag)
+        self.adv_commands = list(adv_commands)
+        self.cwd = os.getcwd() if cwd is None else cwd
+        if fitopt is not None:
+            self.fitopt = fitopt
+        self.crop = crop
+        self.crop_margin = crop_margin
+        # Cropped map staged in the workspace (None if the whole map is used)
+        self.cropped_map = None
+        self.stages = list(stages)
+        self.map_resolution = map_resolution
+        # Filtered map staged in the workspace and its cut-off level (None if
+        # the map is not filtered)
+        self.filtered_map = None
+        self.map_cutoff = None
+        self.partition = partition
+        self.map_cache = map_cache
+        # Preliminary stages done before the job was resumed, and the
+        # checkpoint it was resumed from (see FitOpt.checkpoint.resume_job)
+        self.first_stage = 0
+        self.resumed = None
+
+    # ---------------------------------------------------------------------------
+    # Path of the PDB given to FitOpt with the models to be fitted. When there
+    # are several models they are staged together in the workspace.
+    #
+    def input_path(self):
+
+        if len(self.fitted) == 1:
+            return self.fitted[0]
+        return os.path.join(self.cwd, self.input_name)
+
+    # ---------------------------------------------------------------------------
+    # Path of the PDB given to FitOpt with the models to be fixed
+    # (None if there are no fixed models)
+    #
+    def fixed_path(self):
+
+        if len(self.fixed) == 0:
+            return None
+        if len(self.fixed) == 1:
+            return self.fixed[0]
+        return os.path.join(self.cwd, self.fixed_name)
+
+    # ---------------------------------------------------------------------------
+    # Path of the map given to FitOpt: the filtered or the cropped one if they
+    # were staged
+    #
+    def map_input_path(self):
+
+        if self.filtered_map is not None:
+            return self.filtered_map
+        if self.cropped_map is not None:
+            return self.cropped_map
+        return self.map_path
+
+    # ---------------------------------------------------------------------------
+    # Cut-off level given to FitOpt: the one of the filtered map if it was
+    # staged (see multires.equivalent_cutoff)
+    #
+    def map_input_cutoff(self):
+
+        if self.filtered_map is not None and self.map_cutoff is not None:
+            return self.map_cutoff
+        return self.cutoff
+
+    # ---------------------------------------------------------------------------
+    # Paths of the results written by FitOpt in the workspace
+    #
+    def fitted_path(self):
+
+        return os.path.join(self.cwd, self.fitted_name)
+
+    def movie_path(self):
+
+        return os.path.join(self.cwd, self.movie_name)
+
+    def trace_path(self):
+
+        return os.path.join(self.cwd, self.trace_name)
+
+    # ---------------------------------------------------------------------------
+    # Removes the results of previous runs from the workspace. They may be links
+    # to cached results, which must not be overwritten.
+    #
+    def clear_results(self):
+
+        from FitOpt.trajectory import Pdb_Trajectory, binary_path
+        movie = self.movie_path()
+        for path in (self.fitted_path(), movie, movie + Pdb_Trajectory.index_suffix, binary_path(movie)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # ---------------------------------------------------------------------------
+    # Returns the full command to perform the fitting: fitopt + arguments
+    #
+    def command(self):
+
+        cmd = [self.fitopt, self.input_path(), self.map_input_path(), self.resolution, self.map_input_cutoff(),
+               self.fitopt_chimera_m, self.model,
+               self.fitopt_chimera_t,
+               self.fitopt_chimera_r, self.fixing,
+               self.fitopt_chimera_re, self.rediag,
+               self.fitopt_chimera_morepdbs,
+               self.fitopt_chimera_n, self.modes]
+        fixed = self.fixed_path()
+        if fixed is not None:
+            cmd += [self.fitopt_chimera_pdb_ref, fixed]
+        return cmd + self.adv_commands
+
+    # ---------------------------------------------------------------------------
+    # Creates the workspace and writes on it the PDBs given to FitOpt when
+    # several models have to be joined in one file, and the cropped and
+    # filtered maps
+    #
+    def stage(self):
+
+        with timing.span('stage'):
+            if not os.path.isdir(self.cwd):
+                os.makedirs(self.cwd)
+            self.clear_results()
+            if len(self.fitted) > 1:
+                write_models(self.fitted, self.input_path())
+            if len(self.fixed) > 1:
+                write_models(self.fixed, self.fixed_path())
+            if self.map_cache is not None:
+                with timing.span('prepare map'):
+                    self.map_cache.stage_maps(self)
+                return
+            if self.crop:
+                with timing.span('crop map'):
+                    self.stage_cropped_map()
+            if self.filtering():
+                with timing.span('filter map'):
+                    self.stage_filtered_map()
+
+    # ---------------------------------------------------------------------------
+    # True if the map is filtered to the job resolution
+    #
+    def filtering(self):
+
+        return self.map_resolution is not None and float(self.map_resolution) < float(self.resolution)
+
+    # ---------------------------------------------------------------------------
+    # Writes in the workspace the map cropped around the fitted and fixed
+    # models. The whole map is used if it can not be cropped (not an MRC map,
+    # or the models cover most of it).
+    #
+    def stage_cropped_map(self):
+
+        from FitOpt import cropping
+
+        path = os.path.join(self.cwd, self.cropped_map_name)
+        if os.path.exists(path):
+            os.remove(path)
+        margin = self.crop_margin
+        if margin is None:
+            margin = cropping.crop_margin(self.resolution)
+        bounds = cropping.model_bounds(self.fitted + self.fixed)
+        self.cropped_map = path if cropping.crop_map(self.map_path, bounds, margin, path) else None
+
+    # ---------------------------------------------------------------------------
+    # Writes in the workspace the map low-pass filtered from the map resolution
+    # to the job resolution (only MRC / CCP4 maps can be filtered). The
+    # smoothing lowers the map values, so the cut-off level is changed to keep
+    # the same fraction of the map over it.
+    #
+    def stage_filtered_map(self):
+
+        from FitOpt.mrcmap import is_mrc
+        from FitOpt.multires import filter_map, filtered_cutoff
+
+        self.filtered_map = self.map_cutoff = None
+        source = self.map_input_path()
+        path = os.path.join(self.cwd, self.filtered_map_name)
+        if os.path.exists(path):
+            os.remove(path)
+        if is_mrc(source):
+            filter_map(source, self.map_resolution, self.resolution, path)
+            self.filtered_map = path
+            self.map_cutoff = filtered_cutoff(source, path, self.cutoff)
+
+
+# ---------------------------------------------------------------------------------
+# Joins several PDBs in one file, every PDB as a different model
+#
+def write_models(paths, output):
+
+    from numpy import concatenate
+    from FitOpt.pdbio import read_pdb, write_pdb
+
+    models = []
+    for i, path in enumerate(paths):
+        atoms = read_pdb(path)
+        atoms['model'] = i + 1
+        models.append(atoms)
+    write_pdb(output, concatenate(models))
+
+
+# ---------------------------------------------------------------------------------
+# Stages the job and launches its FitOpt process in background.
+# Returns the running process: a Prepared_Process staging the job in a worker
+# thread (cropping, filtering and partitioning may take long for big maps), so
+# it can be polled from the Tk event loop at once, and then running the
+# process of the job (see job_process).
+#
+def start(job):
+
+    from FitOpt.fitprocess import Prepared_Process
+
+    process = Prepared_Process(lambda: job_process(job))
+    with timing.span('launch'):
+        process.start()
+    return process
+
+
+# ---------------------------------------------------------------------------------
+# Stages the job and returns its process, not started yet: a Fit_Process, a
+# multires.Staged_Process running the stages one after another for multi-stage
+# jobs, or a partition.Partitioned_Process running the groups of distant models
+# concurrently for partitioned jobs. Unless the job is partitioned, the process
+# writes checkpoints of the fitting in the workspace
+# (checkpoint.Checkpointed_Process).
+#
+def job_process(job):
+
+    groups = None
+    if job.partition and len(job.fitted) > 1:
+        from FitOpt.partition import job_groups
+        with timing.span('partition'):
+            groups = job_groups(job)
+
+    if groups is not None and len(groups) > 1:
+        from FitOpt.partition import Partitioned_Process
+        process = Partitioned_Process(job, groups, job.max_running)
+    elif job.stages:
+        from FitOpt.multires import Staged_Process, stage_jobs
+        process = Staged_Process(stage_jobs(job))
+    else:
+        job.stage()
+        process = Fit_Process(job.command(), job.cwd)
+    if job.checkpoint_interval is not None and (groups is None or len(groups) <= 1):
+        from FitOpt.checkpoint import Checkpointed_Process
+        process = Checkpointed_Process(process, job, job.checkpoint_interval)
+    return process
+
+
+# ---------------------------------------------------------------------------------
+# Runs the job until it is finished and returns the exit code of FitOpt.
+# Every line of the process output is passed to the output function
+# (by default, it is written in the standard output).
+# If a Result_Cache is given, the results are restored from it when the same
+# job was already run, and saved on it otherwise.
+# launch: function starting the process of the job (by default, start)
+#
+def run(job, output=None, interval=0.1, cache=None, launch=None):
+
+    import time
+
+    if output is None:
+        output = sys.stdout.write
+    if cache is not None and cache.restore(job):
+        output('FitOpt results restored from cache in %s\n' % job.cwd)
+        return 0
+
+    timer = timing.timer()
+    parser = None
+    if timer.enabled:
+        from FitOpt.progress import Progress_Parser
+        parser = Progress_Parser()
+    span = timing.span('fitopt process')
+    process = (start if launch is None else launch)(job)
+    try:
+        while not process.finished():
+            lines = process.new_lines()
+            for line in lines:
+                output(line)
+                if parser is not None:
+                    timer.progress(parser.feed(line))
+            if not lines:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        # fitopt runs in its own process group, so it does not get the interrupt
+        process.cancel()
+        process.wait()
+        raise
+    process.wait()
+    span.end()
+    if process.returncode() == 0 and cache is not None:
+        cache.store(job)
+    return process.returncode()
+
+
+# ---------------------------------------------------------------------------------
+# Command line arguments parser
+#
+def argument_parser():
+
+    import argparse
+    p = argparse.ArgumentParser(prog='python -m FitOpt.fitjob',
+                                description='Flexible fitting optimization through FitOpt algorithm.')
+    p.add_argument('fitted', nargs='+', help='PDBs to be fitted')
+    p.add_argument('--fixed', action='append', default=[], help='PDB to be fixed (can be repeated)')
+    p.add_argument('--map', required=True, dest='map_path', help='density map')
+    p.add_argument('--resolution', required=True, help='map resolution')
+    p.add_argument('--cutoff', required=True, help='map cut-off level')
+    p.add_argument('-m', dest='model', default='2', choices=['0', '1', '2'],
+                   help='coarse-grained model: 0 CA, 1 3BB2R, 2 full atom (default 2)')
+    p.add_argument('-n', dest='modes', default='0.05', help='fraction or number of modes (default 0.05)')
+    p.add_argument('-r', dest='fixing', default='0', help='fraction of fixed degrees of freedom (default 0)')
+    p.add_argument('--rediag', default='0', help='rediagonalization threshold (default 0)')
+    p.add_argument('--adv', default='', help='advanced commands given to fitopt')
+    p.add_argument('--crop', action='store_true', help='give fitopt the map cropped around the models')
+    p.add_argument('--crop-margin', type=float, default=None, metavar='A',
+                   help='margin around the models of the cropped map (default 2 * resolution + 10)')
+    p.add_argument('--stages', default='', metavar='SCHEDULE',
+                   help='preliminary stages as resolution:model pairs, e.g. "3x:0 1.5x:1" '
+                        '(x: multiple of the map resolution)')
+    p.add_argument('--partition', action='store_true',
+                   help='fit the groups of distant models as parallel fitopt processes')
+    p.add_argument('--workdir', default=None, help='workspace (default current directory)')
+    p.add_argument('--fitopt', default=None, help='path of the fitopt process')
+    p.add_argument('--cache', default=None, metavar='FOLDER',
+                   help='restore/save the results in this result cache')
+    p.add_argument('--cache-size', type=float, default=None, metavar='GB', help='size limit of the result cache')
+    p.add_argument('--checkpoint', type=float, default=Fit_Job.checkpoint_interval, metavar='SECONDS',
+                   help='seconds between checkpoints of the fitting (default %g, 0 for none)'
+                        % Fit_Job.checkpoint_interval)
+    p.add_argument('--resume', action='store_true',
+                   help='resume the fitting from the checkpoint of the workspace')
+    p.add_argument('--server', nargs='?', const='', default=None, metavar='SOCKET',
+                   help='run the fitting on the local FitOpt server (see FitOpt.server)')
+    p.add_argument('--trace', action='store_true',
+                   help='save a timing trace of the run (Chrome trace format) in the workspace')
+    p.add_argument('--dry-run', action='store_true', help='only print the fitopt command')
+    return p
+
+
+# ---------------------------------------------------------------------------------
+# Builds a job from the command line arguments
+#
+def job_from_arguments(args):
+
+    # fitopt is executed in the workspace, so relative paths are made absolute
+    from FitOpt.multires import parse_schedule
+
+    path = os.path.abspath
+    job = Fit_Job([path(p) for p in args.fitted], [path(p) for p in args.fixed], path(args.map_path),
+                   args.resolution, args.cutoff,
+                   model=args.model, modes=args.modes, fixing=args.fixing, rediag=args.rediag,
+                   adv_commands=args.adv.split(),
+                   cwd=None if args.workdir is None else path(args.workdir),
+                   fitopt=None if args.fitopt is None else path(args.fitopt),
+                   crop=args.crop, crop_margin=args.crop_margin,
+                   stages=parse_schedule(args.stages, args.resolution), partition=args.partition)
+    job.checkpoint_interval = args.checkpoint if args.checkpoint > 0 else None
+    return job
+
+
+# ---------------------------------------------------------------------------------
+# Console entry point
+#
+def main(argv=None):
+
+    args = argument_parser().parse_args(argv)
+    job = job_from_arguments(args)
+    if args.resume:
+        from FitOpt.checkpoint import resume_job
+        resumed = resume_job(job)
+        if resumed is None:
+            sys.stderr.write('There is no checkpoint of this job to resume in %s\n' % job.cwd)
+            return 1
+        sys.stdout.write('Resuming FitOpt from the checkpoint of %s (%d iterations done)\n'
+                         % (job.cwd, resumed.resumed['iterations']))
+        job = resumed
+    if args.dry_run:
+        if job.partition and len(job.fitted) > 1:
+            from FitOpt.partition import job_groups
+            for i, (fitted, fixed) in enumerate(job_groups(job)):
+                sys.stdout.write('group %d: fitted %s, fixed %s\n'
+                                 % (i + 1, ' '.join('%d' % (k + 1) for k in fitted) or '-',
+                                    ' '.join('%d' % (k + 1) for k in fixed) or '-'))
+        if job.stages:
+            from FitOpt.multires import stage_jobs
+            for s in stage_jobs(job):
+                sys.stdout.write('[%s] %s\n' % (s.cwd, ' '.join(s.command())))
+        else:
+            sys.stdout.write(' '.join(job.command()) + '\n')
+        return 0
+    cache = None
+    if args.cache is not None:
+        from FitOpt.resultcache import Result_Cache
+        max_bytes = None if args.cache_size is None else int(args.cache_size * 1024 ** 3)
+        cache = Result_Cache(args.cache, max_bytes)
+    launch = None
+    if args.server is not None:
+        from FitOpt.server import start_remote
+        launch = lambda job: start_remote(job, args.server or None)
+    if not args.trace:
+        return run(job, cache=cache, launch=launch)
+
+    timer = timing.Timer()
+    timing.set_timer(timer)
+    try:
+        code = run(job, cache=cache, launch=launch)
+    finally:
+        timing.set_timer(None)
+    timer.save(job.trace_path())
+    sys.stdout.write('Timings: %s\nTrace saved in %s\n' % (timer.summary(), job.trace_path()))
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
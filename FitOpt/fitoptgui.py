@@ -5,6 +5,7 @@
 import chimera
 from chimera.baseDialog import ModelessDialog
 import FitOpt
+from FitOpt import timing
 
 
 # ---------------------------------------------------------------------------------
@@ -16,7 +17,7 @@ class FitOpt_Dialog(ModelessDialog):
     # Name of FitOpt plugin
     name = 'FitOpt'
     # Buttons of FitOpt GUI
-    buttons = ('Fit', 'Results', 'Close')
+    buttons = ('Fit', 'Resume', 'Queue', 'Cancel', 'Options', 'Results', 'Close')
     # Path of help guide of FitOpt plugin
     help = ('fitopt.html', FitOpt)
     # Name of the folder where FitOpt plugin is located
@@ -28,43 +29,94 @@ class FitOpt_Dialog(ModelessDialog):
     # Name of the fitted pdb generated after FitOpt process
     fitted_molecule = "fitopt_fitted.pdb"
     # Name of the trajectory movie
-    imovie = plugin_folder + "fitopt_movie.pdb"
+    imovie = "fitopt_movie.pdb"
+    # Folder (inside the plugin folder) where the workspaces of the queued jobs are created
+    jobs_folder = "jobs"
 
     # ---------------------------
-    # FitOpt Chimera Commands
-
-    # FitOpt in Chimera indicator
-    fitopt_chimera_opt = "--chimera"
-
-    # More PDBs
-    fitopt_chimera_morepdbs = "--morepdbs"
-
-    # PDB Reference
-    fitopt_chimera_pdb_ref = "--pdb_ref"
-    fitopt_chimera_pdb_ref_val = None
-
-    # Trajectory (movie)
-    fitopt_chimera_t = "-t"
+    # FitOpt Chimera Commands values
+    # (the command line is built by FitOpt.fitjob.Fit_Job)
 
     # Fixing diagonalization
-    fitopt_chimera_r = "-r"
     fitopt_chimera_r_val = "0"
 
     # Rediagonalization
-    fitopt_chimera_re = "--rediag"
     fitopt_chimera_re_val = "0"
 
     # Coarse-grained model
-    fitopt_chimera_m = "-m"
     fitopt_chimera_m_val = "2"
 
     # Modes range
-    fitopt_chimera_n = "-n"
     fitopt_chimera_n_val = "0.05"
 
     # Advanced commands
     fitopt_chimera_adv_commands = []
 
+    # Milliseconds between two consecutive checks of the FitOpt process output
+    poll_interval = 100
+    # Maximum number of output lines read from the process per check
+    poll_max_lines = 100000
+    # Minimum seconds between two refreshes of the process log
+    log_refresh_interval = 0.25
+    # FitOpt process running in background (None if there is no fitting running)
+    fit_process = None
+    # True when the running fitting has been cancelled
+    fit_cancelled = False
+
+    # Molecules fitted and fixed in the results shown in the Results panel
+    fitted_models = []
+    fixed_models = []
+    # (molecule, original coordinate set, fitted coordinate set) of every
+    # fitted molecule. The fitted coordinates are read once, as an additional
+    # coordinate set, when the fitted molecules are shown for first time.
+    coord_sets = None
+
+    # Cache of FitOpt results (created when it is used for first time)
+    cache = None
+    # Fit_Job performed by the Fit button, and its fitted and fixed molecules
+    running_job = None
+    running_models = None
+    # Fit_Job whose results are shown in the Results panel
+    results_job = None
+    # Map_Scorer of the last scored results (reused while their map, resolution
+    # and cut-off do not change)
+    scorer = None
+    # Clash_Detector of the fixed models of the results (reused for the frames
+    # of the movie and while the fixed models do not change)
+    clash_detector = None
+    # Clash_Report of the results (or of the movie frame) shown
+    clash_report = None
+    # (trigger set, handler) checking the clashes of the frames of the Movie
+    # dialog opened from the results (None if there is none)
+    movie_handler = None
+    # Pseudobond group joining the clashing residues (None if it is not
+    # shown), and the (fitted, fixed) residue pairs it joins
+    clash_group = None
+    clash_pairs = None
+    clash_group_name = 'FitOpt clashes'
+    # FitOpt.timing.Timer of the results shown (None for queued jobs, which
+    # are not timed), and the Timer of the running fitting and the span of its
+    # process. Spans are only recorded in the Timer of the running fitting
+    # while its own code runs (see FitOpt.timing.using).
+    timer = None
+    fit_timer = None
+    process_span = None
+    # FitOpt.livemovie.Live_Preview of the running fitting (None if it is not
+    # previewed), the original coordinates of the molecules it moves, and the
+    # pairs (atom, index in the movie atoms) of the movie
+    preview = None
+    preview_coords = None
+    preview_atoms = None
+
+    # Queue of concurrent FitOpt jobs (created with the first queued job)
+    job_queue = None
+    # Number of jobs queued in this session
+    job_count = 0
+    # Milliseconds between two consecutive checks of the job queue
+    jobs_poll_interval = 500
+    # True while the job queue is checked periodically
+    jobs_polling = False
+
     import tkFont
     arialF = tkFont.Font(family='Arial', size=8)
     arialBondF = tkFont.Font(family='Arial', size=7, weight=tkFont.BOLD)
@@ -137,6 +189,138 @@ class FitOpt_Dialog(ModelessDialog):
         self.pdbs.columnconfigure(0, weight=1)
         row += 1
 
+        # Options panel
+        op = Hybrid.Popup_Panel(parent)
+        opf = op.frame
+        opf.grid(row=row, column=0, sticky='news')
+        opf.grid_remove()
+        opf.columnconfigure(0, weight=1)
+        self.options_panel = op.panel_shown_variable
+        row += 1
+
+        cb = op.make_close_button(opf)
+        cb.grid(row=0, column=1, sticky='e')
+
+        # Coarse-grained model
+        mt = Hybrid.Option_Menu(opf, 'Model ', 'Full atom', '3BB2R', 'CA')
+        mt.frame.grid(row=0, column=0, sticky='w')
+        mt.variable.set('Full atom')
+        self.model_type = mt.variable
+
+        # Modes range (percentage or number of modes)
+        mf = Tkinter.Frame(opf)
+        mf.grid(row=1, column=0, sticky='w')
+        nm = Hybrid.Entry(mf, 'Modes ', 6, '5')
+        nm.frame.grid(row=0, column=0, sticky='w')
+        self.number_models = nm.variable
+        mp = Hybrid.Checkbutton(mf, '%', True)
+        mp.button.grid(row=0, column=1, sticky='w')
+        self.mode_percentage = mp.variable
+
+        # Fixing diagonalization
+        fx = Hybrid.Option_Menu(opf, 'Fix DoF ', 'None', '50%', '75%', '90%')
+        fx.frame.grid(row=2, column=0, sticky='w')
+        fx.variable.set('None')
+        self.fixing = fx
+
+        # Rediagonalization
+        rd = Hybrid.Option_Menu(opf, 'Rediagonalization ', 'None', '0.1', '0.5', '1')
+        rd.frame.grid(row=3, column=0, sticky='w')
+        rd.variable.set('None')
+        self.rediag = rd
+
+        # Advanced commands
+        ac = Hybrid.Entry(opf, 'Advanced commands ', 30)
+        ac.frame.grid(row=4, column=0, sticky='w')
+        self.adv_commands = ac.variable
+
+        # Cache of results
+        uc = Hybrid.Checkbutton(opf, 'Restore results of identical fittings from cache', True)
+        uc.button.grid(row=5, column=0, sticky='w')
+        self.use_cache = uc.variable
+
+        # Map cropping
+        cm = Hybrid.Checkbutton(opf, 'Crop the map around the models', True)
+        cm.button.grid(row=6, column=0, sticky='w')
+        self.crop_map = cm.variable
+
+        # Preliminary stages of a coarse-to-fine fitting (resolution:model pairs)
+        sf = Tkinter.Frame(opf)
+        sf.grid(row=7, column=0, sticky='w')
+        st = Hybrid.Entry(sf, 'Preliminary stages ', 16)
+        st.frame.grid(row=0, column=0, sticky='w')
+        self.stages = st.variable
+        sl = Tkinter.Label(sf, text='resolution:model, e.g. 3x:0 1.5x:1', font=self.arialF)
+        sl.grid(row=0, column=1, sticky='w')
+
+        # Parallel fitting of distant models
+        pm = Hybrid.Checkbutton(opf, 'Fit distant models in parallel', False)
+        pm.button.grid(row=8, column=0, sticky='w')
+        self.partition = pm.variable
+
+        # Timing trace of every fitting
+        tt = Hybrid.Checkbutton(opf, 'Record timing trace', False)
+        tt.button.grid(row=9, column=0, sticky='w')
+        self.trace_timings = tt.variable
+
+        # Live preview of the movie while FitOpt is running
+        lp = Hybrid.Checkbutton(opf, 'Preview the fitting movie while FitOpt is running', False)
+        lp.button.grid(row=10, column=0, sticky='w')
+        self.live_preview = lp.variable
+
+        # Fittings run by the local FitOpt server (see FitOpt.server)
+        us = Hybrid.Checkbutton(opf, 'Run the fittings on the FitOpt server when it is running', True)
+        us.button.grid(row=11, column=0, sticky='w')
+        self.use_server = us.variable
+
+        # Results panel
+        rp = Hybrid.Popup_Panel(parent)
+        rpf = rp.frame
+        rpf.grid(row=row, column=0, sticky='news')
+        rpf.grid_remove()
+        rpf.columnconfigure(0, weight=1)
+        self.results_panel = rp.panel_shown_variable
+        row += 1
+
+        cb = rp.make_close_button(rpf)
+        cb.grid(row=0, column=1, sticky='e')
+
+        # Frame where the results components are placed
+        self.mmf = Tkinter.Frame(rpf)
+        self.mmf.grid(row=0, column=0, sticky='w')
+
+        # Jobs panel
+        jp = Hybrid.Popup_Panel(parent)
+        jpf = jp.frame
+        jpf.grid(row=row, column=0, sticky='news')
+        jpf.grid_remove()
+        jpf.columnconfigure(0, weight=1)
+        self.jobs_panel = jp.panel_shown_variable
+        row += 1
+
+        cb = jp.make_close_button(jpf)
+        cb.grid(row=0, column=1, sticky='ne')
+
+        # Status of the queued jobs
+        jlf = Tkinter.Frame(jpf)
+        jlf.grid(row=0, column=0, sticky='news')
+        jlf.columnconfigure(0, weight=1)
+        js = Tkinter.Scrollbar(jlf)
+        js.grid(row=0, column=1, sticky='ns')
+        jl = Tkinter.Listbox(jlf, height=6, width=70, font=self.arialF, yscrollcommand=js.set)
+        jl.grid(row=0, column=0, sticky='news')
+        js.config(command=jl.yview)
+        self.jobs_list = jl
+
+        jbf = Tkinter.Frame(jpf)
+        jbf.grid(row=1, column=0, sticky='w')
+        b = Tkinter.Button(jbf, text="Show results", font=self.arialBondF, height=1, command=self.show_job_results)
+        b.grid(row=0, column=0, sticky='w')
+        b = Tkinter.Button(jbf, text="Clear finished", font=self.arialBondF, height=1, command=self.clear_jobs)
+        b.grid(row=0, column=1, sticky='w')
+
+        self.options_button = self.buttonWidgets['Options']
+
         # Disable Results panel at first
         self.results_button = self.buttonWidgets['Results']
         self.results_button['state'] = 'disabled'
@@ -225,6 +409,52 @@ class FitOpt_Dialog(ModelessDialog):
     #
     def Fit(self):
 
+        self.fit()
+
+    # ---------------------------------------------------------------------------
+    # Performs the FitOpt process starting from the checkpoint of the last
+    # fitting (the same models and options have to be chosen)
+    #
+    def Resume(self):
+
+        self.fit(resume=True)
+
+    def fit(self, resume=False):
+
+        # Spans of this fitting are recorded if the timing trace is enabled
+        self.fit_timer = timing.Timer(self.trace_timings.get())
+        self.running_job = None
+        self.fit_cancelled = False
+        with timing.using(self.fit_timer), timing.span('Fit'):
+            job = self.start_fit(resume)
+        # Not started: the trace is complete
+        if job is None:
+            self.end_trace()
+            return
+
+        cache = self.result_cache()
+        if cache is None:
+            self.launch_fit(job)
+            return
+
+        # The input files are hashed to look for the results in the cache,
+        # which takes long for big maps, by a worker thread
+        self.message('Looking for FitOpt results in the cache...')
+        span = self.fit_timer.span('hash inputs')
+
+        def hashed(job):
+            span.end()
+            self.launch_fit(job)
+
+        self.hash_inputs(cache, job, hashed)
+
+    # ---------------------------------------------------------------------------
+    # Checks the user selection and options and makes the Fit_Job of the
+    # fitting. Returns None if the fitting can not be performed.
+    #
+    def start_fit(self, resume=False):
+
+        from chimera import replyobj
         from chimera.replyobj import info
 
         models = self.modelList.getvalue()
@@ -246,131 +476,430 @@ class FitOpt_Dialog(ModelessDialog):
                 info('\n')
                 info('    - ' + m.name)
             info('\n')
-        # # If a fitting is performed when Results panel is active, close it
-        # for widget in self.mmf.winfo_children():
-        #     widget.destroy()
-        # self.results_panel.set(False)
-        #
-        # # Validation of the parameters introduced by the user
-        # if self.check_models() is False:
-        #     return
-        #
-        # # Disable Fit, and Close buttons when FitOpt process is performed
-        # self.disable_process_buttons()
-        #
-        # # Retrieve the full plugin path
-        # self.plugin_path = __file__[:__file__.index(self.plugin_folder)]
-        #
-        # # -----------------------
-        # # Calling FitOpt process
-        # # -----------------------
-        # from subprocess import STDOUT, PIPE, Popen
-        # import os, sys
-        #
-        # # Get the full path of FitOpt process
-        # command = self.plugin_path + self.fitopt
-        # # Set the workspace
-        # self.cwd = self.plugin_path + self.plugin_folder
-        #
-        # # PDB selected in the menu
-        # pdbSelected = self.object_menu.getvalue()
-        # # Map selected in the menu
-        # mapSelected = self.map_menu.volume()
-        #
-        # # Get options values
-        # self.get_options_chimera()
-        #
-        # # Retrieve the full command to perform the fitting: fitopt + arguments
-        # cmd = [command, pdbSelected.openedAs[0], mapSelected.openedAs[0], self.resolution.get(), self.cutoff.get(),
-        #        self.fitopt_chimera_m, self.fitopt_chimera_m_val,
-        #        self.fitopt_chimera_t,
-        #        self.fitopt_chimera_r, self.fitopt_chimera_r_val,
-        #        self.fitopt_chimera_re, self.fitopt_chimera_re_val,
-        #        self.fitopt_chimera_morepdbs,
-        #        self.fitopt_chimera_n, self.fitopt_chimera_n_val] + self.fitopt_chimera_adv_commands
-        #
-        # # Execute the command with the respective arguments creating pipes between the process and Chimera
-        # # Pipes will be associated to the standard output and standard error required to show the process log
-        # # in the window
-        # from chimera.replyobj import info
-        # info('\n')
-        # info('Executing the FitOpt command:')
-        # info('\n')
-        # info(' '.join(cmd))
-        # fitopt_process = Popen(cmd, stdout=PIPE, stderr=PIPE, cwd=self.cwd, universal_newlines=True)
-        #
-        # # Text widget for process log that will showthe standard output of the process
-        # from Tkinter import *
-        # root = Tk()
-        # root.wm_title("FitOpt Process Log")
-        # S = Scrollbar(root)
-        # T = Text(root, height=30, width=85)
-        # S.pack(side=RIGHT, fill=Y)
-        # T.pack(side=LEFT, fill=Y)
-        # S.config(command=T.yview)
-        # T.config(yscrollcommand=S.set)
-        #
-        # # Read first line
-        # line = fitopt_process.stdout.readline()
-        # # Variables to check the process status and show its output in a friendly format to the user
-        # iter = False
-        # model_iter = False
-        # index_before_last_print = None
-        # first_ite_sec = True
-        #
-        # # Continue reading the standard output until FitOpt is finished
-        # # If the current line is an iteration for a model, replace in the widget the last showed
-        # # If it is a new model or is part of the FitOpt process, inserts the line at the end of the widget
-        # while line:
-        #     if len(line.strip()) == 0:
-        #         line = fitopt_process.stdout.readline()
-        #         continue
-        #     if iter is False or (iter is True and 'NMA' in line):
-        #         T.insert(END, line)
-        #         model_iter = True
-        #     elif iter is True and 'sec' in line:
-        #         if first_ite_sec is True:
-        #             T.insert(END, line)
-        #             model_iter = True
-        #         else:
-        #             T.delete(index_before_last_print + "-1c linestart", index_before_last_print)
-        #             T.insert(END, line)
-        #             first_ite_sec = False
-        #     elif model_iter is True:
-        #         index_before_last_print = T.index(END)
-        #         T.insert(END, line)
-        #         model_iter = False
-        #     elif iter is True and 'sec' not in line:
-        #         T.delete(index_before_last_print + "-1c linestart", index_before_last_print)
-        #         T.insert(END, line)
-        #     T.update()
-        #     T.yview(END)
-        #     line = fitopt_process.stdout.readline()
-        #     if ('NMA_time' in line and 'Score' in line):
-        #         iter = True
-        #     if 'sec' in line and iter is True:
-        #         first_ite_sec = True
-        #         model_iter = True
-        #         if index_before_last_print is not None:
-        #             T.delete(index_before_last_print + "-1c linestart", index_before_last_print)
-        #         index_before_last_print = T.index(END)
-        #     if 'Convergence' in line:
-        #         iter = False
-        #
-        # T.insert(END, "\n\n --> FitOpt Process has finished. Check 'Results' button to visualize solution. <--\n")
-        # T.update()
-        # T.yview(END)
-        #
-        # # When FitOpt process is finished, the results are set into the Results panel...
-        # self.fill_results()
-        # # and the plugin buttons are enabled again
-        # self.enable_process_buttons()
+
+        # If a fitting is performed when Results panel is active, close it
+        self.clear_results()
+
+        # Validation of the parameters introduced by the user
+        if self.check_models() is False:
+            return
+
+        # Disable Fit, and Close buttons when FitOpt process is performed
+        self.disable_process_buttons()
+
+        # Retrieve the fitting to be performed in the workspace: fitopt + arguments
+        job = self.fit_job(models, models1, self.plugin_path() + self.plugin_folder)
+        if resume:
+            from FitOpt.checkpoint import resume_job
+            resumed = resume_job(job)
+            if resumed is None:
+                self.message('There is no checkpoint of a fitting with these models, map and options to resume.')
+                self.enable_process_buttons()
+                self.results_button['state'] = 'disabled'
+                return
+            info('\n')
+            info('Resuming FitOpt from its last checkpoint (%d iterations done)' % resumed.resumed['iterations'])
+            job = resumed
+        self.running_job = job
+        self.running_models = (models, models1)
+        return job
+
+    # ---------------------------------------------------------------------------
+    # Restores the results of the fitting from the cache, or launches its
+    # FitOpt process. The trace of the fitting is saved if it is not launched.
+    #
+    def launch_fit(self, job):
+
+        with timing.using(self.fit_timer), timing.span('launch'):
+            self.launch_process(job)
+        if self.fit_process is None:
+            self.end_trace()
+
+    def launch_process(self, job):
+
+        from chimera.replyobj import info
+
+        if self.fit_cancelled:
+            # Cancelled while the inputs were hashed
+            self.message('FitOpt process was cancelled.')
+            self.enable_process_buttons()
+            self.results_button['state'] = 'disabled'
+            return
+
+        # The same fitting was already performed: its results are restored
+        cache = self.result_cache()
+        if cache is not None and cache.restore(job):
+            info('\n')
+            info('FitOpt results restored from cache')
+            self.message('FitOpt results restored from cache.')
+            self.show_fit_results()
+            self.enable_process_buttons()
+            return
+
+        info('\n')
+        info('Executing the FitOpt command:')
+        info('\n')
+        info(' '.join(job.command()))
+
+        # Text widget for process log that will show the standard output of the process
+        self.open_process_log()
+
+        # Execute the command in background. Its output is read by a worker thread
+        # and checked periodically from the Tk event loop, so Chimera stays responsive
+        self.process_span = timing.span('fitopt process')
+        try:
+            self.fit_process = self.start_process(job)
+        except (IOError, OSError) as e:
+            self.process_span.end()
+            self.message('FitOpt could not be executed: %s' % e)
+            self.enable_process_buttons()
+            self.results_button['state'] = 'disabled'
+            return
+        if self.live_preview.get():
+            self.start_preview(job)
+        self.message('FitOpt is running...')
+        self.toplevel_widget.after(self.poll_interval, self.poll_fit)
+
+    # ---------------------------------------------------------------------------
+    # Starts the process of a job: on the FitOpt server if it is running (it
+    # keeps the maps in memory, so they are not read and prepared again),
+    # otherwise as a local process
+    #
+    def start_process(self, job):
+
+        from FitOpt import fitjob, server
+
+        if self.use_server.get() and server.server_running():
+            from chimera.replyobj import info
+            info('\n')
+            info('Running FitOpt on the server ' + server.default_socket)
+            return server.start_remote(job)
+        return fitjob.start(job)
+
+    # ---------------------------------------------------------------------------
+    # Hashes the input files of a job (the key of its results in the cache) in
+    # a worker thread, and calls then with the job from the Tk event loop when
+    # they are hashed. The results are then looked up without reading them.
+    #
+    def hash_inputs(self, cache, job, then):
+
+        import threading
+        thread = threading.Thread(target=hash_job_inputs, args=(cache, job))
+        thread.daemon = True
+        thread.start()
+        self.toplevel_widget.after(self.poll_interval, self.poll_hashing, thread, job, then)
+
+    def poll_hashing(self, thread, job, then):
+
+        if thread.is_alive():
+            self.toplevel_widget.after(self.poll_interval, self.poll_hashing, thread, job, then)
+            return
+        then(job)
+
+    # ---------------------------------------------------------------------------
+    # Returns the cache of FitOpt results (None if it is not used)
+    #
+    def result_cache(self):
+
+        if not self.use_cache.get():
+            return None
+        if self.cache is None:
+            from FitOpt.resultcache import Result_Cache
+            self.cache = Result_Cache()
+        return self.cache
+
+    # ---------------------------------------------------------------------------
+    # Retrieves the full path of the folder containing the plugin
+    #
+    def plugin_path(self):
+
+        return __file__[:__file__.index(self.plugin_folder)]
+
+    # ---------------------------------------------------------------------------
+    # Returns the Fit_Job to fit the models into the map selected in the menu
+    # with the options introduced by the user
+    #
+    def fit_job(self, models, models1, cwd):
+
+        from FitOpt.fitjob import Fit_Job
+        from FitOpt.multires import parse_schedule
+
+        # Map selected in the menu
+        mapSelected = self.map_menu.volume()
+
+        # Get options values
+        self.get_options_chimera()
+
+        return Fit_Job([m.openedAs[0] for m in models], [m.openedAs[0] for m in models1],
+                       mapSelected.openedAs[0], self.resolution.get(), self.cutoff.get(),
+                       model=self.fitopt_chimera_m_val, modes=self.fitopt_chimera_n_val,
+                       fixing=self.fitopt_chimera_r_val, rediag=self.fitopt_chimera_re_val,
+                       adv_commands=self.fitopt_chimera_adv_commands,
+                       cwd=cwd, fitopt=self.plugin_path() + self.fitopt, crop=self.crop_map.get(),
+                       stages=parse_schedule(self.stages.get(), self.resolution.get()),
+                       partition=self.partition.get())
+
+    # ---------------------------------------------------------------------------
+    # Adds a fitting with the current selection and options to the job queue.
+    # Queued jobs are executed concurrently, each one in its own workspace.
+    #
+    def Queue(self):
+
+        models = self.modelList.getvalue()
+        models1 = self.modelList1.getvalue()
+        if not models or not models1:
+            self.message('Choose PDBs to be fitted and fixed.')
+            return
+        if self.check_models() is False:
+            return
+
+        if self.job_queue is None:
+            from FitOpt.jobqueue import Job_Queue
+            self.job_queue = Job_Queue()
+        cache = self.job_queue.cache = self.result_cache()
+
+        import os
+        self.job_count += 1
+        name = 'job_%d' % self.job_count
+        cwd = os.path.join(self.plugin_path() + self.plugin_folder, self.jobs_folder, name)
+        name += '  %s -> %s' % (', '.join([m.name for m in models]), self.map_menu.volume().name)
+        job = self.fit_job(models, models1, cwd)
+
+        def submit(job):
+            queued = self.job_queue.submit(name, job)
+            queued.models = models
+            queued.fixed_models = models1
+            self.jobs_panel.set(True)
+            self.update_jobs()
+
+        # The queue looks for the results in the cache when the job is started,
+        # so its input files are hashed first in a worker thread
+        if cache is None:
+            submit(job)
+        else:
+            self.hash_inputs(cache, job, submit)
+
+    # ---------------------------------------------------------------------------
+    # Updates the job queue and shows the status of its jobs in the Jobs panel.
+    # While there are jobs not finished, the queue is checked periodically from
+    # the Tk event loop.
+    #
+    def update_jobs(self):
+
+        from Tkinter import END
+
+        q = self.job_queue
+        q.update()
+        self.jobs_list.delete(0, END)
+        for job in q.jobs:
+            self.jobs_list.insert(END, job.status())
+
+        if not q.done() and not self.jobs_polling:
+            self.jobs_polling = True
+            self.toplevel_widget.after(self.jobs_poll_interval, self.poll_jobs)
+
+    # ---------------------------------------------------------------------------
+    # Periodic check of the job queue
+    #
+    def poll_jobs(self):
+
+        self.jobs_polling = False
+        self.update_jobs()
+
+    # ---------------------------------------------------------------------------
+    # Shows in the Results panel the results of the job selected in the Jobs panel
+    #
+    def show_job_results(self):
+
+        from FitOpt.jobqueue import FINISHED
+
+        sel = self.jobs_list.curselection()
+        if not sel:
+            self.message('Choose a job.')
+            return
+        job = self.job_queue.jobs[int(sel[0])]
+        if job.state != FINISHED:
+            self.message('Job %s has not finished successfully.' % job.name.split()[0])
+            return
+
+        self.clear_results()
+        self.cwd = job.cwd
+        self.fitted_models = job.models
+        self.fixed_models = job.fixed_models
+        self.results_job = job.job
+        # Queued jobs are not timed
+        self.timer = None
+        self.fill_results()
+        # The Results button is enabled again when the running fitting finishes
+        if self.fit_process is None:
+            self.results_button['state'] = 'normal'
+        self.results_panel.set(True)
+        self.message('')
+
+    # ---------------------------------------------------------------------------
+    # Removes the finished jobs from the Jobs panel
+    #
+    def clear_jobs(self):
+
+        if self.job_queue is not None:
+            self.job_queue.clear_done()
+            self.update_jobs()
+
+    # ---------------------------------------------------------------------------
+    # Creates the window with the process log
+    #
+    def open_process_log(self):
+
+        import Tkinter
+        from Tkinter import RIGHT, LEFT, Y
+        root = Tkinter.Toplevel(self.toplevel_widget)
+        root.wm_title("FitOpt Process Log")
+        S = Tkinter.Scrollbar(root)
+        T = Tkinter.Text(root, height=30, width=85)
+        S.pack(side=RIGHT, fill=Y)
+        T.pack(side=LEFT, fill=Y)
+        S.config(command=T.yview)
+        T.config(yscrollcommand=S.set)
+        self.log_text = T
+
+        # The output of the process is parsed into progress events, which are
+        # shown in the log at a fixed refresh rate
+        from FitOpt.progress import Progress_Parser, Throttled_Log
+        self.log_parser = Progress_Parser()
+        self.log = Throttled_Log(T, self.log_refresh_interval)
+
+    # ---------------------------------------------------------------------------
+    # Checks the new output of the FitOpt process and shows it in the process
+    # log. It is called periodically from the Tk event loop until the process
+    # is finished.
+    #
+    def poll_fit(self):
+
+        p = self.fit_process
+        with timing.using(self.fit_timer):
+            span = timing.span('log')
+            for line in p.new_lines(self.poll_max_lines):
+                event = self.log_parser.feed(line)
+                self.log.add(event)
+                self.fit_timer.progress(event)
+            span.end()
+
+        if not p.finished():
+            self.log.refresh()
+            if self.preview is not None:
+                self.preview.update()
+            self.show_progress()
+            self.toplevel_widget.after(self.poll_interval, self.poll_fit)
+            return
+
+        self.fit_process = None
+        self.process_span.end()
+        self.stop_preview()
+        if p.returncode() != 0:
+            if self.fit_cancelled:
+                self.log.write("\n\n --> FitOpt Process was cancelled. Check 'Resume' button to continue it. <--")
+                self.message('FitOpt process was cancelled.')
+            else:
+                self.log.write("\n\n --> FitOpt Process has failed (exit code %s). <--" % p.returncode())
+                self.message('FitOpt process has failed.')
+            self.log.refresh(force=True)
+            self.enable_process_buttons()
+            self.results_button['state'] = 'disabled'
+            self.end_trace()
+            return
+
+        self.log.write("\n\n --> FitOpt Process has finished. Check 'Results' button to visualize solution. <--")
+        self.log.refresh(force=True)
+        self.message('')
+
+        # Results are saved in the cache to be restored if the same fitting is repeated
+        cache = self.result_cache()
+        if cache is not None:
+            cache.store(self.running_job)
+
+        # When FitOpt process is finished, the results are set into the Results panel...
+        with timing.using(self.fit_timer):
+            self.show_fit_results()
+        # and the plugin buttons are enabled again
+        self.enable_process_buttons()
+        self.end_trace()
+
+    # ---------------------------------------------------------------------------
+    # Shows in the Results panel the results of the fitting performed by the
+    # Fit button (the results of a queued job may have been shown meanwhile)
+    #
+    def show_fit_results(self):
+
+        self.clear_results()
+        job = self.running_job
+        self.cwd = job.cwd
+        self.fitted_models, self.fixed_models = self.running_models
+        self.results_job = job
+        self.timer = self.fit_timer
+        self.fill_results()
+
+    # ---------------------------------------------------------------------------
+    # Starts the live preview of the movie of a running job: the fitted
+    # molecules are moved to the newest frame while FitOpt is running
+    #
+    def start_preview(self, job):
+
+        from FitOpt.livemovie import Live_Preview
+        self.preview_coords = [(a, a.coord()) for m in self.running_models[0] for a in m.atoms]
+        self.preview_atoms = None
+        self.preview = Live_Preview(job.movie_path(), self.show_preview_frame)
+
+    # ---------------------------------------------------------------------------
+    # Moves the fitted molecules to a frame of the movie. The atoms of the
+    # movie are paired with the ones of the molecules with the first frame.
+    #
+    def show_preview_frame(self, atoms, frame, xyz):
+
+        from chimera import Point
+        if self.preview_atoms is None:
+            self.preview_atoms = fitted_atom_indices(self.running_models[0], atoms)
+        xyz = xyz.tolist()
+        for a, i in self.preview_atoms:
+            if i < len(xyz):
+                a.setCoord(Point(*xyz[i]))
+
+    # ---------------------------------------------------------------------------
+    # Ends the live preview and shows again the original coordinates of the
+    # fitted molecules (the fitted ones are shown from the Results panel)
+    #
+    def stop_preview(self):
+
+        if self.preview is None:
+            return
+        for a, xyz in self.preview_coords:
+            a.setCoord(xyz)
+        self.preview = None
+        self.preview_coords = None
+        self.preview_atoms = None
+
+    # ---------------------------------------------------------------------------
+    # Shows the last iteration of the FitOpt process in the dialog
+    #
+    def show_progress(self):
+
+        e = self.log_parser.last_iteration
+        if e is None:
+            return
+        text = 'FitOpt is running... model %d, iteration %d' % (e.model, e.iteration)
+        if e.score is not None:
+            text += ', score %.4f' % e.score
+        if self.preview is not None and self.preview.frame is not None:
+            text += ', movie frame %d' % (self.preview.frame + 1)
+        if text != self.message_label['text']:
+            self.message(text)
 
     # ---------------------------------------------------------------------------
     # Fill the Results panel with the corresponding components
     #
     def fill_results(self):
 
+        span = timing.span('results')
+
         # Button to switch between the original molecule and the fitted one with FitOpt
         import Tkinter
         self.save_button = Tkinter.Button(self.mmf, text="Show fitted molecule", command=self.switch_original_fitted)
@@ -385,94 +914,466 @@ class FitOpt_Dialog(ModelessDialog):
         self.open_md_movie = Tkinter.Button(self.mmf, text="Open movie", command=self.open_movie)
         self.open_md_movie.grid(row=1, column=0, sticky='w')
 
+        # Button to save the movie in the compact binary format
+        self.save_binary_movie = Tkinter.Button(self.mmf, text="Save binary movie", command=self.binary_movie)
+        self.save_binary_movie.grid(row=1, column=1, sticky='w')
+
+        # Scores of the molecules before and after the fitting
+        self.scores_label = Tkinter.Label(self.mmf, anchor='w', justify='left', font=self.arialF)
+        self.scores_label.grid(row=2, column=0, columnspan=2, sticky='w')
+        self.show_scores()
+
+        # Clashes of the fitted molecules with the fixed ones
+        self.clashes_label = Tkinter.Label(self.mmf, anchor='w', justify='left', font=self.arialF)
+        self.clashes_label.grid(row=3, column=0, columnspan=2, sticky='w')
+        self.show_clashes()
+        span.end()
+
+        # Timings of the fitting (if they are recorded)
+        self.timings_label = Tkinter.Label(self.mmf, anchor='w', justify='left', font=self.arialF,
+                                           wraplength=500)
+        self.timings_label.grid(row=4, column=0, columnspan=2, sticky='w')
+        self.show_timings()
+
+        # Switches between the original and fitted coordinates of every molecule
+        sf = Tkinter.Frame(self.mmf)
+        sf.grid(row=5, column=0, columnspan=2, sticky='w')
+        Tkinter.Label(sf, text='Fitted:', font=self.arialF).grid(row=0, column=0, sticky='w')
+        self.model_switches = []
+        for k, m in enumerate(self.fitted_models):
+            v = Tkinter.IntVar()
+            cb = Tkinter.Checkbutton(sf, text=m.name, variable=v, font=self.arialF,
+                                     command=lambda k=k: self.switch_model(k))
+            cb.grid(row=k // 4, column=1 + k % 4, sticky='w')
+            self.model_switches.append(v)
+
+    # ---------------------------------------------------------------------------
+    # Shows in the Results panel the fitting criteria (cross-correlation and
+    # Laplacian filtered cross-correlation over the cut-off level) of the
+    # molecules before and after the fitting. They are computed by a worker
+    # thread (the norms of the map are computed reading all of it), which is
+    # checked periodically from the Tk event loop.
+    #
+    def show_scores(self):
+
+        import threading
+
+        job = self.results_job
+        if job is None:
+            return
+        self.scores_label['text'] = 'Computing scores...'
+        result = {}
+        thread = threading.Thread(target=compute_scores,
+                                  args=(job, self.cwd, self.fitted_molecule, self.scorer, result))
+        thread.daemon = True
+        thread.start()
+        self.toplevel_widget.after(self.poll_interval, self.poll_scores, thread, result, self.scores_label)
+
+    # ---------------------------------------------------------------------------
+    # Checks the worker thread computing the scores shown in a label
+    #
+    def poll_scores(self, thread, result, label):
+
+        from FitOpt.scoring import LAPLACIAN, LINEAR
+
+        if thread.is_alive():
+            self.toplevel_widget.after(self.poll_interval, self.poll_scores, thread, result, label)
+            return
+        if 'scorer' in result:
+            self.scorer = result['scorer']
+        if not label.winfo_exists():
+            return
+        if 'error' in result:
+            label['text'] = 'Scores not available: %s' % result['error']
+            return
+        before, after = result['before'], result['after']
+        label['text'] = ('Cross-correlation: %.4f -> %.4f\nLaplacian cross-correlation: %.4f -> %.4f'
+                         % (before[LINEAR], after[LINEAR], before[LAPLACIAN], after[LAPLACIAN]))
+
+    # ---------------------------------------------------------------------------
+    # Shows in the Results panel the summary of the timing spans of the fitting
+    #
+    def show_timings(self):
+
+        t = self.timer
+        label = getattr(self, 'timings_label', None)
+        if t is None or not t.enabled or not t.spans or label is None or not label.winfo_exists():
+            return
+        label['text'] = 'Timings: %s' % t.summary()
+
+    # ---------------------------------------------------------------------------
+    # Saves the timing trace of the fitting performed by the Fit button when it
+    # has finished (or it has been restored or not started)
+    #
+    def end_trace(self):
+
+        t = self.fit_timer
+        self.fit_timer = None
+        if self.running_job is not None:
+            self.save_trace(t, self.running_job)
+
+    # ---------------------------------------------------------------------------
+    # Saves the timing trace of a job in its workspace (if it is recorded)
+    #
+    def save_trace(self, t, job):
+
+        if t is None or not t.enabled:
+            return
+        try:
+            t.save(job.trace_path())
+        except (IOError, OSError) as e:
+            self.message('Timing trace could not be saved: %s' % e)
+            return
+        self.show_timings()
+
+    # ---------------------------------------------------------------------------
+    # Shows in the Results panel the clashes of the fitted molecules with the
+    # fixed ones and joins the clashing residues with pseudobonds
+    #
+    def show_clashes(self):
+
+        import os
+        from FitOpt.clashes import Clash_Detector, job_report
+
+        job = self.results_job
+        if job is None:
+            return
+        try:
+            d = self.clash_detector
+            if d is None or d.paths != list(job.fixed):
+                d = self.clash_detector = Clash_Detector.from_files(job.fixed)
+            report = job_report(job, d)
+        except (IOError, OSError, ValueError) as e:
+            self.clashes_label['text'] = 'Clashes not available: %s' % e
+            return
+
+        self.clash_report = report
+        self.clashes_label['text'] = report.summary([m.name for m in self.fitted_models],
+                                                    [os.path.basename(p) for p in job.fixed])
+        self.draw_clashes(report, self.fitted_models)
+
+    # ---------------------------------------------------------------------------
+    # Joins every pair of clashing residues of a Clash_Report, in the fitted
+    # molecules (or the molecule of the movie) and the fixed ones, with a
+    # pseudobond between their most overlapping atoms (as the Chimera Find
+    # Clashes tool). The selection of the user is not changed, and the
+    # pseudobonds are only drawn again when the clashing residues change, so
+    # the frames of the movie can be played.
+    #
+    def draw_clashes(self, report, fitted_models):
+
+        pairs = report.residue_pairs()
+        key = [(r1, r2) for r1, r2, i, j in pairs]
+        if key == self.clash_pairs and self.clash_group is not None and not self.clash_group.__destroyed__:
+            return
+        self.clash_pairs = key
+
+        import chimera
+        from chimera.misc import getPseudoBondGroup
+        g = self.clash_group
+        if g is None or g.__destroyed__:
+            g = self.clash_group = getPseudoBondGroup(self.clash_group_name)
+            g.color = chimera.MaterialColor(1.0, 1.0, 0.0)
+            g.lineWidth = 3
+        g.deleteAll()
+        fitted = chimera_residues(fitted_models, [r1 for r1, r2 in key])
+        fixed = chimera_residues(self.fixed_models, [r2 for r1, r2 in key])
+        for r1, r2, i, j in pairs:
+            if r1 in fitted and r2 in fixed:
+                a1 = fitted[r1].findAtom(atom_name(report.fitted['name'][i]))
+                a2 = fixed[r2].findAtom(atom_name(report.fixed['name'][j]))
+                if a1 is not None and a2 is not None:
+                    g.newPseudoBond(a1, a2)
+
+    # ---------------------------------------------------------------------------
+    # Removes the pseudobonds of the clashes
+    #
+    def remove_clashes(self):
+
+        g, self.clash_group = self.clash_group, None
+        self.clash_pairs = None
+        if g is not None and not g.__destroyed__:
+            from chimera import openModels
+            openModels.close([g])
+
+    # ---------------------------------------------------------------------------
+    # Checks the clashes of every frame shown by the Movie dialog
+    #
+    def watch_movie_clashes(self, movie_dialog, ensemble):
+
+        import numpy
+        from Movie.gui import MovieDialog
+        from FitOpt.pdbio import parse_pdb
+
+        # Only the last movie opened is checked
+        self.unwatch_movie_clashes()
+        detector = self.clash_detector
+        if detector is None:
+            return
+        trajectory = ensemble.trajectory
+        atoms = parse_pdb(b'\n'.join(trajectory.atom_records(0)))
+        models = numpy.zeros(len(atoms), int)
+        label = self.clashes_label
+
+        def frame_changed(trigger_name, data, frame):
+            if not label.winfo_exists():
+                return
+            report = detector.report(atoms, trajectory.coordinates(frame - 1), models)
+            self.clash_report = report
+            label['text'] = 'Frame %d: %s' % (frame, report.summary([ensemble.name]))
+            self.draw_clashes(report, [ensemble.molecule])
+
+        triggers = movie_dialog.triggers
+        handler = triggers.addHandler(MovieDialog.NEW_FRAME_NUMBER, frame_changed, None)
+        self.movie_handler = (triggers, handler)
+
+        # The handler is removed when the Movie dialog is closed
+        def movie_closed(event):
+            if self.movie_handler is not None and self.movie_handler[1] is handler:
+                self.unwatch_movie_clashes()
+        movie_dialog.uiMaster().bind('<Destroy>', movie_closed, add='+')
+
+    # ---------------------------------------------------------------------------
+    # Stops checking the clashes of the frames of the Movie dialog
+    #
+    def unwatch_movie_clashes(self):
+
+        if self.movie_handler is None:
+            return
+        from Movie.gui import MovieDialog
+        triggers, handler = self.movie_handler
+        self.movie_handler = None
+        triggers.deleteHandler(MovieDialog.NEW_FRAME_NUMBER, handler)
+
+    # ---------------------------------------------------------------------------
+    # Closes the Results panel, showing again the original molecules if the
+    # fitted ones were shown
+    #
+    def clear_results(self):
+
+        self.unwatch_movie_clashes()
+        self.remove_clashes()
+        self.remove_coord_sets()
+        for widget in self.mmf.winfo_children():
+            widget.destroy()
+        self.results_panel.set(False)
+
     # ---------------------------------------------------------------------------
     # Switchs between the original molecule and the fitted one with FitOpt
     #
     def switch_original_fitted(self):
 
-        if self.save_button["text"] == "Show fitted molecule":
-            # Show fitted molecule
-            self.show_fitted_molecule(True)
+        self.show_fitted_molecule(self.save_button["text"] == "Show fitted molecule")
+
+    # ---------------------------------------------------------------------------
+    # Shows the fitted or the original coordinates of all the fitted molecules
+    #
+    def show_fitted_molecule(self, fitted):
+
+        self.load_coord_sets()
+        for m, original, fitted_set in self.coord_sets:
+            m.activeCoordSet = fitted_set if fitted else original
+        for v in self.model_switches:
+            v.set(fitted)
+        self.update_switch_buttons()
+
+        from chimera.replyobj import info
+        info('\n')
+        info('Showing %s molecules' % ('fitted' if fitted else 'original'))
+
+    # ---------------------------------------------------------------------------
+    # Shows the fitted or the original coordinates of one molecule, as chosen
+    # with its switch
+    #
+    def switch_model(self, k):
+
+        self.load_coord_sets()
+        m, original, fitted_set = self.coord_sets[k]
+        m.activeCoordSet = fitted_set if self.model_switches[k].get() else original
+        self.update_switch_buttons()
+
+    # ---------------------------------------------------------------------------
+    # Updates the Results buttons with the coordinates shown: all the
+    # molecules can be switched to the fitted coordinates unless all of them
+    # are already fitted, and fitted molecules can be copied
+    #
+    def update_switch_buttons(self):
+
+        shown = [v.get() for v in self.model_switches]
+        if shown and all(shown):
             self.save_button["text"] = "Show original molecule"
-            self.save_fitted['state'] = 'normal'
         else:
-            # Show original molecule
-            self.show_fitted_molecule(False)
             self.save_button["text"] = "Show fitted molecule"
-            self.save_fitted['state'] = 'disabled'
+        self.save_fitted['state'] = 'normal' if any(shown) else 'disabled'
 
     # ---------------------------------------------------------------------------
-    # Reads the coordinates of the fitted molecule and updates the original
-    # molecule position to show the fitting made by FitOpt
+    # Reads the fitted coordinates and adds them to every fitted molecule as a
+    # new coordinate set, so switching between the original and the fitted
+    # coordinates only changes the active coordinate set. Atoms which are not
+    # in the fitted PDB keep their original coordinates.
     #
-    def show_fitted_molecule(self, pdb_name):
+    def load_coord_sets(self):
 
-        from chimera.replyobj import info
-        info('\n')
-        info('Showing fitted ' + pdb_name + ' molecule')
+        import os
+        from chimera import Point
+        from FitOpt.pdbio import read_pdb
+
+        if self.coord_sets is not None:
+            return
+        atoms = read_pdb(os.path.join(self.cwd, self.fitted_molecule))
+        fitted = dict(fitted_atom_coordinates(self.fitted_models, atoms))
+        self.coord_sets = []
+        for m in self.fitted_models:
+            original = m.activeCoordSet
+            cs = m.newCoordSet(max(m.coordSets.keys()) + 1)
+            for a in m.atoms:
+                xyz = fitted.get(a)
+                a.setCoord(a.coord() if xyz is None else Point(*xyz), cs)
+            self.coord_sets.append((m, original, cs))
 
     # ---------------------------------------------------------------------------
-    # Makes a copy to the Model Panel of the fitted molecule
+    # Shows again the original coordinates and removes the fitted coordinate
+    # sets (of the molecules which are still open)
     #
-    def save_fitted_molecule(self):
+    def remove_coord_sets(self):
 
-        # Get opened molecule (the one selected in the menu)
-        m = self.object_menu.getvalue()
+        if self.coord_sets is None:
+            return
+        for m, original, fitted_set in self.coord_sets:
+            if getattr(m, '__destroyed__', False):
+                continue
+            m.activeCoordSet = original
+            m.deleteCoordSet(fitted_set)
+        self.coord_sets = None
+
+    # ---------------------------------------------------------------------------
+    # Makes a copy to the Model Panel of the molecules shown with their fitted
+    # coordinates. Chimera molecules can not share their atoms, so the copies
+    # only keep the fitted coordinate set.
+    #
+    def save_fitted_molecule(self):
 
         # Make copy using the copy_molecule native functionality from Chimera
         from Molecule import copy_molecule
-        mc = copy_molecule(m)
-
-        # Set copy name
-        mc.name = m.name.split('.')[0] + '_fitopt.pdb'
 
-        # Add copy to list of open models
-        chimera.openModels.add([mc])
+        copies = []
+        for (m, original, fitted_set), v in zip(self.coord_sets, self.model_switches):
+            if not v.get():
+                continue
+            mc = copy_molecule(m)
+            # Only the active (fitted) coordinates are kept
+            for cs in list(mc.coordSets.values()):
+                if cs is not mc.activeCoordSet:
+                    mc.deleteCoordSet(cs)
+            # Set copy name
+            mc.name = m.name.split('.')[0] + '_fitopt.pdb'
+            copies.append(mc)
+
+        # Add copies to list of open models
+        chimera.openModels.add(copies)
 
     # ---------------------------------------------------------------------------
     # Opens the MD movie created by iMODTFIT with the model trajectories
     #
     def open_movie(self):
 
+        if self.timer is None:
+            self.open_movie_dialog()
+            return
+        with self.timer.span('open movie'):
+            self.open_movie_dialog()
+        self.save_trace(self.timer, self.results_job)
+
+    def open_movie_dialog(self):
+
         # Import the native dialog MovieDialog from Chimera
         from Movie.gui import MovieDialog
-        # import the loadEnsemble native functionality from Chimera to load the movie
-        from Trajectory.formats.Pdb import loadEnsemble
+        # The movie is read lazily: frames are decoded when the Movie dialog shows them
+        from FitOpt.trajectory import open_trajectory, Trajectory_Ensemble
 
-        # Load the movie created by FitOpt
-        movie = self.plugin_path + self.imovie
-        loadEnsemble(("single", movie), None, None, MovieDialog)
+        # Load the movie created by FitOpt (its binary version if it was saved)
+        import os
+        movie = os.path.join(self.cwd, self.imovie)
+        ensemble = Trajectory_Ensemble(open_trajectory(movie), self.imovie)
+        ensemble.addMolecule()
+        md = MovieDialog(ensemble, keepLongBonds=True)
+        self.watch_movie_clashes(md, ensemble)
 
     # ---------------------------------------------------------------------------
-    # Disables the the FitOpt GUI Fit, Close and Results buttons
+    # Converts the movie created by FitOpt to the binary trajectory format.
+    # Once it is saved, Open movie loads the binary version.
+    #
+    def binary_movie(self):
+
+        import os
+        from FitOpt.trajectory import convert_pdb_trajectory
+        movie = os.path.join(self.cwd, self.imovie)
+        self.message('Saving binary movie...')
+        path = convert_pdb_trajectory(movie)
+        self.message('Binary movie saved in %s (%.1f MB)' % (os.path.basename(path), os.path.getsize(path) / 1e6))
+
+    # ---------------------------------------------------------------------------
+    # Stops the running FitOpt process (its last checkpoint is kept, so it
+    # can be resumed)
+    #
+    def Cancel(self):
+
+        self.fit_cancelled = True
+        if self.fit_process is None:
+            # The inputs are being hashed: the process will not be launched
+            return
+        self.fit_process.cancel()
+        self.message('Cancelling FitOpt...')
+
+    # ---------------------------------------------------------------------------
+    # Disables the the FitOpt GUI Fit, Resume, Close and Results buttons (and
+    # enables the Cancel button)
     #
     def disable_process_buttons(self):
 
         self.fit_button = self.buttonWidgets['Fit']
         self.fit_button['state'] = 'disabled'
+        self.buttonWidgets['Resume']['state'] = 'disabled'
+        self.buttonWidgets['Cancel']['state'] = 'normal'
         self.options_button['state'] = 'disabled'
         self.close_ch_button = self.buttonWidgets['Close']
         self.close_ch_button['state'] = 'disabled'
         self.results_button['state'] = 'disabled'
 
     # ---------------------------------------------------------------------------
-    # Enables the the FitOpt GUI Fit, Close and Results buttons
+    # Enables the the FitOpt GUI Fit, Resume, Close and Results buttons (and
+    # disables the Cancel button)
     #
     def enable_process_buttons(self):
 
         self.fit_button = self.buttonWidgets['Fit']
         self.fit_button['state'] = 'normal'
+        self.buttonWidgets['Resume']['state'] = 'normal'
+        self.buttonWidgets['Cancel']['state'] = 'disabled'
         self.options_button['state'] = 'normal'
         self.close_ch_button = self.buttonWidgets['Close']
         self.close_ch_button['state'] = 'normal'
         self.results_button['state'] = 'normal'
 
+    # ---------------------------------------------------------------------------
+    #  Options button is pressed
+    #
+    def Options(self):
+        self.options_panel.set(not self.options_panel.get())
+
     # ---------------------------------------------------------------------------
     #  Results button is pressed
     #
     def Results(self):
         self.results_panel.set(not self.results_panel.get())
 
+    # ---------------------------------------------------------------------------
+    #  Close button is pressed: the frames of the movie are no longer checked
+    #
+    def Close(self):
+        self.unwatch_movie_clashes()
+        ModelessDialog.Close(self)
+
     # -----------------------------------------------------------------------------
     # Gets the cut-off level value from the Volume Viewer dialog
     # Useful when the user does not know an appropiate resolution and plays
@@ -503,15 +1404,11 @@ class FitOpt_Dialog(ModelessDialog):
     #
     def check_models(self):
 
-        fatoms = self.fit_atoms()
-        fmap = self.fit_map()
+        models = self.modelList.getvalue()
         bmap = self.map_menu.data_region()
-        if (len(fatoms) == 0 and fmap is None) or bmap is None:
+        if len(models) == 0 or bmap is None:
             self.message('Choose model and map.')
             return False
-        if fmap == bmap:
-            self.message('Chosen maps are the same.')
-            return False
         if len(self.cutoff.get()) == 0:
             self.message('Cutoff must be defined.')
             return False
@@ -521,6 +1418,12 @@ class FitOpt_Dialog(ModelessDialog):
         if float(self.resolution.get()) < 0 or float(self.resolution.get()) >= 60:
             self.message('Resolution must be less than 100.')
             return False
+        from FitOpt.multires import parse_schedule
+        try:
+            parse_schedule(self.stages.get(), self.resolution.get())
+        except ValueError as e:
+            self.message(str(e))
+            return False
         self.message("")
         return True
 
@@ -547,6 +1450,123 @@ class FitOpt_Dialog(ModelessDialog):
             return False
 
 
+# -----------------------------------------------------------------------------
+# Pairs the atoms of the fitted molecules with their coordinates in the atoms
+# read from the fitted PDB. The fitted PDB has the molecules in the same order
+# they were given to FitOpt (as different models or one after another).
+# Returns a list of (atom, (x, y, z)).
+#
+def fitted_atom_coordinates(models, atoms):
+
+    xyz = atoms['xyz'].tolist()
+    return [(a, xyz[i]) for a, i in fitted_atom_indices(models, atoms)]
+
+
+# -----------------------------------------------------------------------------
+# Pairs the atoms of the fitted molecules with their indices in the atoms read
+# from the fitted PDB (or a frame of the movie), as fitted_atom_coordinates.
+# Returns a list of (atom, index).
+#
+def fitted_atom_indices(models, atoms):
+
+    import numpy
+
+    numbers = sorted(set(atoms['model'].tolist()))
+    if len(numbers) == len(models) and len(models) > 1:
+        groups = [numpy.flatnonzero(atoms['model'] == n) for n in numbers]
+    else:
+        groups = []
+        start = 0
+        for m in models:
+            groups.append(numpy.arange(start, min(start + len(m.atoms), len(atoms))))
+            start += len(m.atoms)
+
+    pairs = []
+    for m, g in zip(models, groups):
+        sub = atoms[g]
+        keys = zip(sub['chain'].tolist(), sub['resseq'].tolist(), sub['icode'].tolist(),
+                   sub['name'].tolist(), sub['altloc'].tolist())
+        index = dict((tuple(k.strip() if isinstance(k, bytes) else k for k in key), i)
+                     for i, key in zip(g.tolist(), keys))
+        for a in m.atoms:
+            rid = a.residue.id
+            key = (rid.chainId.strip().encode(), rid.position, rid.insertionCode.strip().encode(),
+                   a.name.encode(), a.altLoc.strip().encode())
+            i = index.get(key)
+            if i is not None:
+                pairs.append((a, i))
+    return pairs
+
+
+# -----------------------------------------------------------------------------
+# Hashes the input files of a job for the Result_Cache (they are hashed once
+# while they do not change). It is run by a worker thread; errors reading the
+# files are reported when the results are looked up.
+#
+def hash_job_inputs(cache, job):
+
+    try:
+        cache.key(job)
+    except (IOError, OSError):
+        pass
+
+
+# -----------------------------------------------------------------------------
+# Computes the scores of the fitted molecules of a job before and after the
+# fitting (its fitted PDB is in the folder cwd), reusing a Map_Scorer of the
+# same map, resolution and cut-off. It is run by a worker thread: result gets
+# the Map_Scorer and the 'before' and 'after' scores, or the 'error'.
+#
+def compute_scores(job, cwd, fitted_molecule, scorer, result):
+
+    import os
+    import numpy
+    from FitOpt.pdbio import read_pdb
+    from FitOpt.scoring import Map_Scorer
+
+    try:
+        s = scorer
+        if s is None or (s.path, s.resolution, s.cutoff) != (job.map_path, float(job.resolution),
+                                                             float(job.cutoff)):
+            s = Map_Scorer.from_file(job.map_path, job.resolution, job.cutoff)
+        result['scorer'] = s
+        result['before'] = s.atom_scores(numpy.concatenate([read_pdb(path) for path in job.fitted]))
+        result['after'] = s.atom_scores(read_pdb(os.path.join(cwd, fitted_molecule)))
+    except (IOError, OSError, ValueError, ImportError) as e:
+        result['error'] = e
+
+
+# -----------------------------------------------------------------------------
+# Chimera residues of the molecules given by (molecule index, chain, number,
+# insertion code), as given by FitOpt.clashes.Clash_Report, as a dictionary
+# key -> residue (the residues not found are left out)
+#
+def chimera_residues(models, keys):
+
+    index = {}
+    residues = {}
+    for key in keys:
+        k, chain, number, icode = key
+        if k >= len(models):
+            continue
+        if k not in index:
+            index[k] = dict(((r.id.chainId.strip(), r.id.position, r.id.insertionCode.strip()), r)
+                            for r in models[k].residues)
+        r = index[k].get((chain, number, icode))
+        if r is not None:
+            residues[key] = r
+    return residues
+
+
+# -----------------------------------------------------------------------------
+# Atom name of a FitOpt.pdbio atom as a Chimera one
+#
+def atom_name(name):
+
+    name = name.strip()
+    return name.decode() if isinstance(name, bytes) else name
+
+
 # -----------------------------------------------------------------------------
 # Returns a list of molecules from the models opened in Chimera
 # to be selectables for the fitting
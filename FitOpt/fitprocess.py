@@ -0,0 +1,271 @@
+# ---------------------------------------------------------------------------------
+# Runs the FitOpt process in the background.
+#
+# The standard output of the process is read by a worker thread and stored in a
+# queue, so the caller (the Chimera dialog) can poll for new lines from the Tk
+# event loop without blocking the session while the fitting is performed.
+#
+# The process is started in its own process group, so cancelling it also
+# stops the processes it may have launched.
+#
+
+import os
+import signal
+import threading
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+
+# ---------------------------------------------------------------------------------
+# FitOpt process executed in background
+#
+class Fit_Process:
+
+    # -------------------------------------------------
+    # cmd: full command (fitopt + arguments)
+    # cwd: workspace where the process is executed
+    #
+    def __init__(self, cmd, cwd=None):
+
+        self.cmd = cmd
+        self.cwd = cwd
+        self.process = None
+        self.lines = Queue()
+        self.reader = None
+        # Set when the last line of the process has been retrieved
+        self.output_finished = False
+        # Set when the process is cancelled
+        self.cancelled = False
+
+    # ---------------------------------------------------------------------------
+    # Launches the process and the thread reading its output
+    #
+    def start(self):
+
+        from subprocess import STDOUT, PIPE, Popen
+
+        # Standard error is redirected to the standard output, so the process log
+        # shows the errors in the same order they are produced
+        self.process = Popen(self.cmd, stdout=PIPE, stderr=STDOUT, cwd=self.cwd, universal_newlines=True,
+                             preexec_fn=getattr(os, 'setsid', None))
+
+        self.reader = threading.Thread(target=self.read_output)
+        self.reader.daemon = True
+        self.reader.start()
+
+    # ---------------------------------------------------------------------------
+    # Worker thread: puts each line of the process output in the queue.
+    # None is put at the end to indicate that the output is finished.
+    #
+    def read_output(self):
+
+        stdout = self.process.stdout
+        for line in iter(stdout.readline, ''):
+            self.lines.put(line)
+        stdout.close()
+        self.process.wait()
+        self.lines.put(None)
+
+    # ---------------------------------------------------------------------------
+    # Returns the lines produced by the process since the last call without
+    # blocking. At most max_lines are returned if it is given.
+    #
+    def new_lines(self, max_lines=None):
+
+        lines = []
+        while max_lines is None or len(lines) < max_lines:
+            try:
+                line = self.lines.get_nowait()
+            except Empty:
+                break
+            if line is None:
+                self.output_finished = True
+                break
+            lines.append(line)
+        return lines
+
+    # ---------------------------------------------------------------------------
+    # Returns True when the process has finished and all its output was read
+    #
+    def finished(self):
+
+        return self.output_finished
+
+    # ---------------------------------------------------------------------------
+    # Exit code of the process (None while it is running)
+    #
+    def returncode(self):
+
+        if self.process is None:
+            return None
+        return self.process.poll()
+
+    # ---------------------------------------------------------------------------
+    # Stops the process: its process group is terminated, and killed if it is
+    # still running after grace seconds. The output is read until its end as
+    # usual, so the process is finished when finished() returns True.
+    #
+    def cancel(self, grace=5.0):
+
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.cancelled = True
+        self.signal(signal.SIGTERM)
+        timer = threading.Timer(grace, self.kill)
+        timer.daemon = True
+        timer.start()
+
+    def kill(self):
+
+        if self.process.poll() is None:
+            self.signal(getattr(signal, 'SIGKILL', signal.SIGTERM))
+
+    # ---------------------------------------------------------------------------
+    # Sends a signal to the process group (to the process where there are no
+    # process groups)
+    #
+    def signal(self, sig):
+
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(self.process.pid, sig)
+            else:
+                self.process.terminate()
+        except OSError:
+            # Already finished
+            pass
+
+    # ---------------------------------------------------------------------------
+    # Blocks until the process is finished and returns its exit code
+    #
+    def wait(self):
+
+        if self.reader is not None:
+            self.reader.join()
+        return self.process.wait()
+
+
+# ---------------------------------------------------------------------------------
+# Process launched when its inputs are prepared, with the same interface as
+# Fit_Process. The preparation (staging the PDBs, cropping and filtering the
+# map) runs in a worker thread, so polling the process from the Tk event loop
+# never blocks; the process is started by the first poll after it is done.
+# Errors of the preparation are given as an output line and exit code 1.
+#
+class Prepared_Process:
+
+    # -------------------------------------------------
+    # prepare: function returning the process to be run (not started yet).
+    #          It is called in the worker thread with the current Timer of
+    #          the thread starting the process (see FitOpt.timing).
+    #
+    def __init__(self, prepare):
+
+        self.prepare = prepare
+        self.thread = None
+        # Process prepared, and the one started
+        self.prepared = None
+        self.process = None
+        # Error of the preparation (reported once as an output line), and the
+        # lines not read yet
+        self.error = None
+        self.reported = False
+        self.pending = []
+        # Set when the process is cancelled
+        self.cancelled = False
+
+    # ---------------------------------------------------------------------------
+    # Launches the thread preparing the process
+    #
+    def start(self):
+
+        from FitOpt import timing
+        self.thread = threading.Thread(target=self.run_prepare, args=(timing.timer(),))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run_prepare(self, timer):
+
+        from FitOpt import timing
+        try:
+            with timing.using(timer):
+                self.prepared = self.prepare()
+        except Exception as e:
+            self.error = e
+
+    # ---------------------------------------------------------------------------
+    # True while the process is being prepared. When the preparation is done,
+    # the process is started (unless it has failed or it was cancelled).
+    #
+    def preparing(self):
+
+        if self.thread.is_alive():
+            return True
+        process, self.prepared = self.prepared, None
+        if process is not None and self.error is None and not self.cancelled:
+            try:
+                process.start()
+                self.process = process
+            except (IOError, OSError) as e:
+                self.error = e
+        if self.error is not None and not self.reported:
+            self.reported = True
+            self.pending.append('FitOpt could not be executed: %s\n' % self.error)
+        return False
+
+    # ---------------------------------------------------------------------------
+    # Returns the lines produced by the process since the last call without
+    # blocking (none while it is being prepared)
+    #
+    def new_lines(self, max_lines=None):
+
+        if self.preparing():
+            return []
+        lines, self.pending = self.pending, []
+        if self.process is not None:
+            lines += self.process.new_lines(max_lines)
+        return lines
+
+    # ---------------------------------------------------------------------------
+    # Returns True when the process has finished (or it was not started) and
+    # all its output was read
+    #
+    def finished(self):
+
+        if self.thread.is_alive() or self.prepared is not None or self.pending:
+            return False
+        if self.process is not None:
+            return self.process.finished()
+        return self.error is None or self.reported
+
+    def returncode(self):
+
+        if not self.finished():
+            return None
+        if self.process is not None:
+            return self.process.returncode()
+        return 1 if self.error is not None else -signal.SIGTERM
+
+    # ---------------------------------------------------------------------------
+    # Stops the process. If it is being prepared, it will not be started.
+    #
+    def cancel(self):
+
+        self.cancelled = True
+        if self.process is not None:
+            self.process.cancel()
+
+    # ---------------------------------------------------------------------------
+    # Blocks until the process is finished and returns its exit code. The
+    # output is kept to be read with new_lines.
+    #
+    def wait(self):
+
+        self.thread.join()
+        self.preparing()
+        if self.process is not None:
+            return self.process.wait()
+        return 1 if self.error is not None else -signal.SIGTERM
@@ -0,0 +1,243 @@
+# ---------------------------------------------------------------------------------
+# Queue of FitOpt jobs executed concurrently.
+#
+# Every job is a Fit_Job whose FitOpt process is run in its own workspace. At most
+# max_running processes are executed at the same time (by default, one per
+# available core); the remaining jobs wait in the queue until a running one is
+# finished.
+#
+
+import os
+
+from FitOpt.fitjob import start
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+# ---------------------------------------------------------------------------------
+# Returns the number of cores available in this machine
+#
+def available_cores():
+
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+# ---------------------------------------------------------------------------------
+# FitOpt job waiting, running or finished in the queue
+#
+class Queued_Job:
+
+    # Name of the file (in the job workspace) where the process output is saved
+    log_name = 'fitopt.log'
+
+    # -------------------------------------------------
+    # name: name shown to the user
+    # job: Fit_Job to be run (its workspace must be only used by this job)
+    #
+    def __init__(self, name, job):
+
+        self.name = name
+        self.job = job
+        self.cwd = job.cwd
+        self.state = QUEUED
+        self.process = None
+        self.returncode = None
+        # Last non empty line written by the process
+        self.last_line = ''
+        # Lines of the process output read by the last update
+        self.recent_lines = []
+        self.cancelled = False
+        # Processes that the job may run at the same time (set when it is started)
+        self.slots = 1
+
+    # ---------------------------------------------------------------------------
+    # Launches the FitOpt process of the job. A job whose models may be fitted
+    # in partition groups runs at most slots processes at the same time (by
+    # default, one per core).
+    #
+    def start(self, cache=None, slots=None):
+
+        if slots is not None and self.job.partition and len(self.job.fitted) > 1:
+            self.job.max_running = self.slots = max(1, slots)
+        if cache is not None and cache.restore(self.job):
+            self.last_line = 'results restored from cache'
+            self.returncode = 0
+            self.state = FINISHED
+            return
+
+        if not os.path.isdir(self.cwd):
+            os.makedirs(self.cwd)
+        log = os.path.join(self.cwd, self.log_name)
+        if os.path.exists(log):
+            os.remove(log)
+        self.log = open(log, 'w')
+        try:
+            self.process = start(self.job)
+        except (IOError, OSError, ValueError) as e:
+            self.log.write('FitOpt could not be executed: %s\n' % e)
+            self.log.close()
+            self.state = FAILED
+            return
+        self.state = RUNNING
+        if self.cancelled:
+            # Cancelled while it was being started
+            self.process.cancel()
+
+    # ---------------------------------------------------------------------------
+    # Reads the new output of the process. Returns True if the state of the
+    # job has changed.
+    #
+    def update(self, cache=None):
+
+        self.recent_lines = []
+        if self.state != RUNNING:
+            return False
+
+        lines = self.process.new_lines()
+        self.recent_lines = lines
+        self.log.writelines(lines)
+        for line in reversed(lines):
+            if line.strip():
+                self.last_line = line.strip()
+                break
+
+        if not self.process.finished():
+            return len(lines) > 0
+
+        self.log.close()
+        self.returncode = self.process.returncode()
+        if self.cancelled:
+            self.state = CANCELLED
+        else:
+            self.state = FINISHED if self.returncode == 0 else FAILED
+        if self.state == FINISHED and cache is not None:
+            cache.store(self.job)
+        return True
+
+    # ---------------------------------------------------------------------------
+    # Cancels the job: a queued job will not be started, and the process of a
+    # running one is stopped (the job is cancelled when it has finished)
+    #
+    def cancel(self):
+
+        if self.done():
+            return
+        self.cancelled = True
+        if self.state == QUEUED:
+            self.state = CANCELLED
+        else:
+            self.process.cancel()
+
+    # ---------------------------------------------------------------------------
+    # Returns True when the job will not change anymore
+    #
+    def done(self):
+
+        return self.state in (FINISHED, FAILED, CANCELLED)
+
+    # ---------------------------------------------------------------------------
+    # One line description of the job status
+    #
+    def status(self):
+
+        text = '%s  [%s]' % (self.name, self.state)
+        if self.state == RUNNING and self.last_line:
+            text += '  ' + self.last_line
+        elif self.state == FAILED and self.returncode is not None:
+            text += '  exit code %s' % self.returncode
+        return text
+
+
+# ---------------------------------------------------------------------------------
+# Queue of FitOpt jobs
+#
+class Job_Queue:
+
+    # -------------------------------------------------
+    # max_running: maximum number of processes running at the same time.
+    #              By default, the number of available cores.
+    # cache: Result_Cache where the results are restored from and saved
+    #
+    def __init__(self, max_running=None, cache=None):
+
+        if max_running is None:
+            max_running = available_cores()
+        self.max_running = max(1, max_running)
+        self.cache = cache
+        self.jobs = []
+
+    # ---------------------------------------------------------------------------
+    # Adds a new job to the queue and returns it
+    #
+    def submit(self, name, job):
+
+        queued = Queued_Job(name, job)
+        self.jobs.append(queued)
+        return queued
+
+    # ---------------------------------------------------------------------------
+    # Reads the output of the running jobs and launches the queued ones while
+    # there are free slots. Returns the jobs whose state has changed.
+    #
+    def update(self):
+
+        changed = [job for job in self.jobs if job.update(self.cache)]
+
+        # The jobs fitting partition groups share the processes of the queue
+        running = sum(job.slots for job in self.jobs if job.state == RUNNING)
+        active = len([job for job in self.jobs if not job.done()])
+        for job in self.jobs:
+            if running >= self.max_running:
+                break
+            if job.state == QUEUED:
+                job.start(self.cache, min(self.max_running - running, self.max_running // active))
+                changed.append(job)
+                if job.state == RUNNING:
+                    running += job.slots
+
+        return changed
+
+    # ---------------------------------------------------------------------------
+    # Cancels all the jobs which are not finished
+    #
+    def cancel(self):
+
+        for job in self.jobs:
+            job.cancel()
+
+    # ---------------------------------------------------------------------------
+    # Returns True when all the jobs of the queue are finished
+    #
+    def done(self):
+
+        for job in self.jobs:
+            if not job.done():
+                return False
+        return True
+
+    # ---------------------------------------------------------------------------
+    # Blocks until all the jobs are finished (useful out of Chimera)
+    #
+    def wait(self, interval=0.5):
+
+        import time
+        self.update()
+        while not self.done():
+            time.sleep(interval)
+            self.update()
+
+    # ---------------------------------------------------------------------------
+    # Removes the finished jobs from the queue
+    #
+    def clear_done(self):
+
+        self.jobs = [job for job in self.jobs if not job.done()]
@@ -0,0 +1,145 @@
+# ---------------------------------------------------------------------------------
+# Live preview of the movie written by fitopt while it is running.
+#
+# Trajectory_Tail follows the multi-model PDB as fitopt appends frames to it:
+# every poll only reads the bytes added since the previous one, splits the
+# complete frames (MODEL ... ENDMDL, or up to the next MODEL) and decodes the
+# coordinates of the last one (or of all the new ones). Live_Preview applies
+# the newest frame to the models shown, at most max_frame_rate times per
+# second, so the preview costs the same whatever the speed of fitopt.
+#
+
+import os
+import time
+
+from FitOpt.trajectory import frame_delimiters
+
+# Maximum number of frames shown per second
+max_frame_rate = 5.0
+
+
+# ---------------------------------------------------------------------------------
+# Reader of the frames appended to a growing PDB trajectory
+#
+class Trajectory_Tail:
+
+    # -------------------------------------------------
+    # path: trajectory file (it may not exist yet)
+    #
+    def __init__(self, path):
+
+        self.path = path
+        # Bytes of the file already split in complete frames
+        self.offset = 0
+        # Number of complete frames found
+        self.frames = 0
+        # Atoms of the first frame (FitOpt.pdbio array), read with it
+        self.topology = None
+
+    # ---------------------------------------------------------------------------
+    # Reads the frames completed since the last call. Returns a list of
+    # (frame index, (atoms, 3) coordinates), with only the last frame if
+    # last_only. With final (the trajectory is not written any more), the last
+    # frame is taken as complete even if it has no ENDMDL.
+    #
+    def poll(self, last_only=True, final=False):
+
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return []
+        if size < self.offset:
+            # The trajectory was written again from the start
+            self.offset = self.frames = 0
+            self.topology = None
+        if size == self.offset:
+            return []
+
+        f = open(self.path, 'rb')
+        f.seek(self.offset)
+        data = f.read(size - self.offset)
+        f.close()
+
+        blocks, consumed = split_frames(data, final)
+        if not blocks:
+            return []
+        self.offset += consumed
+        first = self.frames
+        self.frames += len(blocks)
+
+        from FitOpt.pdbio import parse_coordinates, parse_pdb
+        if self.topology is None:
+            s, e = blocks[0]
+            self.topology = parse_pdb(data[s:e])
+        indices = range(len(blocks))
+        if last_only:
+            indices = indices[-1:]
+        return [(first + i, parse_coordinates(data[blocks[i][0]:blocks[i][1]])) for i in indices]
+
+
+# ---------------------------------------------------------------------------------
+# Complete frames of the text of a trajectory (starting at a line start).
+# Returns their (start, end) offsets and the number of bytes consumed (up to
+# the start of the incomplete frame).
+#
+def split_frames(data, final=False):
+
+    blocks = []
+    start = None
+    consumed = 0
+    for m in frame_delimiters.finditer(data):
+        if m.group(1) == b'MODEL':
+            if start is not None:
+                blocks.append((start, m.start()))
+                consumed = m.start()
+            start = m.start()
+        else:
+            end = data.find(b'\n', m.start())
+            if end < 0:
+                break
+            if start is not None:
+                blocks.append((start, end + 1))
+                start = None
+            consumed = end + 1
+    if final and start is not None:
+        blocks.append((start, len(data)))
+        consumed = len(data)
+    return blocks, consumed
+
+
+# ---------------------------------------------------------------------------------
+# Shows the newest frame of a growing trajectory at a capped frame rate
+#
+class Live_Preview:
+
+    # -------------------------------------------------
+    # path: trajectory file
+    # show: function called with the atoms of the first frame (FitOpt.pdbio
+    #       array), the frame index and its (atoms, 3) coordinates
+    # frame_rate: maximum frames shown per second
+    #
+    def __init__(self, path, show, frame_rate=max_frame_rate):
+
+        self.tail = Trajectory_Tail(path)
+        self.show = show
+        self.interval = 1.0 / frame_rate
+        self.last_update = None
+        # Index of the frame shown (None before the first one)
+        self.frame = None
+
+    # ---------------------------------------------------------------------------
+    # Shows the newest frame if there is one and the minimum interval since the
+    # last update has passed (always with final). Returns True if a frame was shown.
+    #
+    def update(self, final=False):
+
+        now = time.time()
+        if not final and self.last_update is not None and now - self.last_update < self.interval:
+            return False
+        self.last_update = now
+        frames = self.tail.poll(last_only=True, final=final)
+        if not frames:
+            return False
+        self.frame, xyz = frames[-1]
+        self.show(self.tail.topology, self.frame, xyz)
+        return True
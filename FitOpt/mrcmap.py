@@ -0,0 +1,250 @@
+# ---------------------------------------------------------------------------------
+# Memory mapped reader (and writer) of MRC / CCP4 maps.
+#
+# Only the 1024 bytes header is read when a map is opened. The data block is
+# memory mapped, so sub-boxes of the map are views of the file which are read
+# from disk only when their values are used, and maps much bigger than the
+# available memory can be inspected.
+#
+# Map values are indexed [z, y, x] and grid positions are x, y, z, as in the
+# Chimera volumes and FitOpt.density.
+#
+#   python -m FitOpt.mrcmap map.mrc
+#
+
+import struct
+import sys
+
+import numpy
+
+# Size of the header
+header_size = 1024
+
+# Extensions of the MRC / CCP4 files
+suffixes = ('.mrc', '.map', '.ccp4', '.mrcs')
+
+# Value types of the data modes supported
+mode_types = {0: 'i1', 1: 'i2', 2: 'f4', 6: 'u2', 12: 'f2'}
+
+
+# ---------------------------------------------------------------------------------
+# MRC / CCP4 map
+#
+class Mrc_Map:
+
+    # -------------------------------------------------
+    # path: map file
+    #
+    def __init__(self, path):
+
+        self.path = path
+        f = open(path, 'rb')
+        header = f.read(header_size)
+        f.close()
+        if len(header) < header_size:
+            raise ValueError('%s is not an MRC map' % path)
+
+        self.byte_order = header_byte_order(header)
+        if self.byte_order is None:
+            raise ValueError('%s is not an MRC map' % path)
+        self.header = parse_header(header, self.byte_order)
+        h = self.header
+
+        if h['mode'] not in mode_types:
+            raise ValueError('%s: MRC mode %d is not supported' % (path, h['mode']))
+        self.dtype = numpy.dtype(mode_types[h['mode']]).newbyteorder(self.byte_order)
+
+        # Columns, rows and sections of the file are the axes given by mapc, mapr, maps
+        axes = [a - 1 for a in (h['mapc'], h['mapr'], h['maps'])]
+        if sorted(axes) != [0, 1, 2]:
+            axes = [0, 1, 2]
+        self.axes = axes
+        crs = (h['nc'], h['nr'], h['ns'])
+        self.size = tuple(crs[axes.index(a)] for a in range(3))
+
+        # Grid spacing and origin (x, y, z)
+        sampling = numpy.array([h['mx'], h['my'], h['mz']], numpy.float64)
+        sampling[sampling <= 0] = 1
+        cell = numpy.array(h['cella'], numpy.float64)
+        cell[cell <= 0] = sampling[cell <= 0]
+        self.step = cell / sampling
+        origin = numpy.array(h['origin'], numpy.float64)
+        if not origin.any():
+            start = (h['ncstart'], h['nrstart'], h['nsstart'])
+            origin = numpy.array([start[axes.index(a)] for a in range(3)]) * self.step
+        self.origin = origin
+
+        self.data_offset = header_size + h['nsymbt']
+        self.file_data = numpy.memmap(path, self.dtype, 'r', self.data_offset, (h['ns'], h['nr'], h['nc']))
+        # Array axes (sections, rows, columns) reordered to z, y, x (a view)
+        file_axes = (axes[2], axes[1], axes[0])
+        self.data = self.file_data.transpose([file_axes.index(a) for a in (2, 1, 0)])
+
+    # ---------------------------------------------------------------------------
+    # Shape of the values, (z, y, x)
+    #
+    @property
+    def shape(self):
+
+        return self.size[::-1]
+
+    # ---------------------------------------------------------------------------
+    # FitOpt.density.Grid of the map
+    #
+    def grid(self):
+
+        from FitOpt.density import Grid
+        return Grid(self.origin, self.step, self.shape)
+
+    # ---------------------------------------------------------------------------
+    # Values of the box of grid points from ijk_min to ijk_max (x, y, z, the
+    # maximum not included), clipped to the map. It is a view of the mapped file.
+    #
+    def region(self, ijk_min, ijk_max):
+
+        lo = numpy.clip(numpy.asarray(ijk_min, int), 0, self.size)
+        hi = numpy.clip(numpy.asarray(ijk_max, int), lo, self.size)
+        return self.data[lo[2]:hi[2], lo[1]:hi[1], lo[0]:hi[0]]
+
+    # ---------------------------------------------------------------------------
+    # FitOpt.density.Grid of a box of grid points (clipped as in region)
+    #
+    def region_grid(self, ijk_min, ijk_max):
+
+        from FitOpt.density import Grid
+        lo = numpy.clip(numpy.asarray(ijk_min, int), 0, self.size)
+        hi = numpy.clip(numpy.asarray(ijk_max, int), lo, self.size)
+        return Grid(self.origin + lo * self.step, self.step, (hi - lo)[::-1])
+
+    # ---------------------------------------------------------------------------
+    # Releases the mapped file
+    #
+    def close(self):
+
+        mm = getattr(self.file_data, '_mmap', None)
+        self.data = self.file_data = None
+        if mm is not None:
+            mm.close()
+
+
+# ---------------------------------------------------------------------------------
+# True if the file extension is the one of an MRC / CCP4 map
+#
+def is_mrc(path):
+
+    import os
+    return os.path.splitext(path)[1].lower() in suffixes
+
+
+# ---------------------------------------------------------------------------------
+# Byte order ('<' or '>') of an MRC header, or None if it is not valid.
+# The machine stamp is used if present, otherwise the plausible one is chosen.
+#
+def header_byte_order(header):
+
+    stamp = header[212:214]
+    if stamp in (b'\x44\x44', b'\x44\x41'):
+        return '<'
+    if stamp == b'\x11\x11':
+        return '>'
+    for order in '<>':
+        nc, nr, ns, mode = struct.unpack(order + '4i', header[:16])
+        if 0 < nc < 1 << 20 and 0 < nr < 1 << 20 and 0 < ns < 1 << 20 and 0 <= mode < 32:
+            return order
+    return None
+
+
+# ---------------------------------------------------------------------------------
+# Fields of an MRC header as a dictionary
+#
+def parse_header(header, order='<'):
+
+    i = struct.unpack(order + '256i', header)
+    f = struct.unpack(order + '256f', header)
+    return {'nc': i[0], 'nr': i[1], 'ns': i[2], 'mode': i[3],
+            'ncstart': i[4], 'nrstart': i[5], 'nsstart': i[6],
+            'mx': i[7], 'my': i[8], 'mz': i[9],
+            'cella': f[10:13], 'cellb': f[13:16],
+            'mapc': i[16], 'mapr': i[17], 'maps': i[18],
+            'dmin': f[19], 'dmax': f[20], 'dmean': f[21],
+            'ispg': i[22], 'nsymbt': max(0, i[23]),
+            'origin': f[49:52], 'rms': f[54],
+            'labels': [header[224 + 80 * k:304 + 80 * k].rstrip(b'\0 ') for k in range(min(max(0, i[55]), 10))]}
+
+
+# ---------------------------------------------------------------------------------
+# Writes float32 values (indexed [z, y, x]) on a FitOpt.density.Grid as an MRC
+# map. The values are written in slabs, so they can be a view of another
+# mapped map.
+#
+def write_mrc(path, values, grid, label='FitOpt'):
+
+    nz, ny, nx = values.shape
+    step = numpy.asarray(grid.step, numpy.float64)
+    i = numpy.zeros(256, '<i4')
+    f = i.view('<f4')
+    i[0:4] = (nx, ny, nz, 2)
+    i[7:10] = (nx, ny, nz)
+    f[10:13] = step * (nx, ny, nz)
+    f[13:16] = 90
+    i[16:19] = (1, 2, 3)
+    i[27] = 20140
+    f[49:52] = grid.origin
+    # Start indices too when the origin is on the grid (some programs ignore the origin)
+    start = numpy.asarray(grid.origin, numpy.float64) / step
+    if numpy.allclose(start, numpy.round(start), atol=1e-3):
+        i[4:7] = numpy.round(start)
+
+    # Statistics computed slab by slab
+    vmin, vmax, total, squares = numpy.inf, -numpy.inf, 0.0, 0.0
+    for z in range(nz):
+        v = numpy.asarray(values[z], numpy.float64)
+        if v.size > 0:
+            vmin, vmax = min(vmin, v.min()), max(vmax, v.max())
+            total += v.sum()
+            squares += (v * v).sum()
+    n = max(1, values.size)
+    mean = total / n
+    f[19:22] = (vmin, vmax, mean) if values.size > 0 else (0, 0, 0)
+    f[54] = numpy.sqrt(max(0.0, squares / n - mean * mean))
+
+    header = bytearray(i.tobytes())
+    header[208:212] = b'MAP '
+    header[212:216] = b'\x44\x44\x00\x00'
+    header[220:224] = struct.pack('<i', 1)
+    header[224:304] = label.encode('ascii')[:80].ljust(80, b' ')
+
+    out = open(path, 'wb')
+    out.write(bytes(header))
+    for z in range(nz):
+        out.write(numpy.ascontiguousarray(values[z], '<f4').tobytes())
+    out.close()
+
+
+# ---------------------------------------------------------------------------------
+# Opens a map given in the command line and shows its header
+#
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) != 1:
+        sys.stderr.write('Usage: python -m FitOpt.mrcmap map.mrc\n')
+        return 2
+    m = Mrc_Map(argv[0])
+    h = m.header
+    out = sys.stdout
+    out.write('size (x, y, z)   %d %d %d\n' % m.size)
+    out.write('value type       %s (mode %d)\n' % (m.dtype.name, h['mode']))
+    out.write('step             %.4g %.4g %.4g\n' % tuple(m.step))
+    out.write('origin           %.4g %.4g %.4g\n' % tuple(m.origin))
+    out.write('axes (c, r, s)   %s\n' % ' '.join('xyz'[a] for a in m.axes))
+    out.write('min, max, mean   %.4g %.4g %.4g\n' % (h['dmin'], h['dmax'], h['dmean']))
+    for label in h['labels']:
+        out.write('label            %s\n' % label.decode('ascii', 'replace'))
+    m.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,366 @@
+# ---------------------------------------------------------------------------------
+# Coarse-to-fine multi-resolution fitting.
+#
+# A multi-stage fitting runs fitopt several times. The preliminary stages fit the
+# models into the map low-pass filtered (and downsampled) to a lower resolution,
+# usually with a coarser model (CA), which is enough for the large-scale motions
+# and much faster. Every stage starts from the fitted PDB of the previous one and
+# the last stage is the fitting requested, at the map resolution and with the
+# chosen model. The cut-off level of a filtered map is the one with the same
+# fraction of the map points over it as the cut-off of the job.
+#
+# The schedule of the preliminary stages is given as resolution:model pairs.
+# Resolutions ending in x are multiples of the map resolution:
+#
+#   "3x:0 1.5x:1"   stage 1 at 3 times the resolution with the CA model,
+#                   stage 2 at 1.5 times the resolution with the 3BB2R model,
+#                   final stage at the resolution and model of the job
+#
+
+import copy
+import os
+
+import numpy
+
+from FitOpt.fitprocess import Fit_Process, Prepared_Process
+
+# Folder (inside the job workspace) of every preliminary stage
+stage_folder = 'stage%d'
+
+# Filtered maps are downsampled while their grid step is smaller than the
+# resolution divided by this value
+samples_per_resolution = 3.0
+
+# Maximum bytes of the slabs of a map filtered at a time
+slab_bytes = 64 * 1024 ** 2
+
+
+# ---------------------------------------------------------------------------------
+# Parses a stage schedule. Returns a list of (resolution, model) strings.
+#
+def parse_schedule(text, resolution):
+
+    stages = []
+    for item in text.replace(',', ' ').split():
+        if ':' not in item:
+            raise ValueError('Stage "%s" is not resolution:model' % item)
+        res, model = item.split(':', 1)
+        if res.lower().endswith('x'):
+            res = float(res[:-1]) * float(resolution)
+        else:
+            res = float(res)
+        if res <= 0:
+            raise ValueError('Stage "%s" has a resolution <= 0' % item)
+        if model not in ('0', '1', '2'):
+            raise ValueError('Stage "%s" has an unknown model (0 CA, 1 3BB2R, 2 full atom)' % item)
+        stages.append(('%.4g' % res, model))
+    return stages
+
+
+# ---------------------------------------------------------------------------------
+# Fit_Jobs of the stages of a job with a stage schedule. The preliminary stages
+# are run in subfolders of the job workspace and the last stage in the workspace.
+#
+def stage_jobs(job):
+
+    jobs = []
+    fitted = job.fitted
+    for i, (resolution, model) in enumerate(job.stages):
+        s = copy.copy(job)
+        s.fitted = fitted
+        s.resolution = resolution
+        s.model = model
+        s.stages = ()
+        s.map_resolution = job.resolution
+        s.cwd = os.path.join(job.cwd, stage_folder % (job.first_stage + i + 1))
+        jobs.append(s)
+        fitted = [s.fitted_path()]
+
+    final = copy.copy(job)
+    final.fitted = fitted
+    final.stages = ()
+    jobs.append(final)
+    return jobs
+
+
+# ---------------------------------------------------------------------------------
+# Writes an MRC map low-pass filtered from its resolution to a lower one
+# (Gaussian smoothing, as Gaussians widths add in quadrature) and downsampled
+# while the grid step is finer than needed for the lower resolution.
+# The map is filtered by slabs of z planes, read from the mapped file with the
+# planes within the kernel radius around them, so it is never read whole in
+# memory. Returns the downsampling factor.
+#
+def filter_map(map_path, map_resolution, resolution, output):
+
+    from FitOpt.density import Grid, cutoff_range
+    from FitOpt.mrcmap import Mrc_Map, write_mrc
+
+    m = Mrc_Map(map_path)
+    step, origin = m.step, m.origin
+    sigma = filter_sigma(step, map_resolution, resolution)
+    factor = downsampling_factor(step, resolution)
+    radius = 0 if sigma is None else int(numpy.ceil(cutoff_range * sigma[2]))
+    nz, ny, nx = m.shape
+    shape = tuple(-(-n // factor) for n in m.shape)
+    planes = max(1, slab_bytes // (4 * ny * nx * factor))
+
+    # The filtered planes are kept in a mapped file until the map is written
+    tmp = output + '.tmp'
+    filtered = numpy.memmap(tmp, numpy.float32, 'w+', shape=shape)
+    try:
+        for z in range(0, shape[0], planes):
+            z1 = min(z + planes, shape[0])
+            first, last = z * factor, (z1 - 1) * factor + 1
+            lo, hi = max(first - radius, 0), min(last + radius, nz)
+            block = numpy.array(m.data[lo:hi], numpy.float32)
+            smooth(block, sigma)
+            filtered[z:z1] = block[first - lo:last - lo:factor, ::factor, ::factor]
+        write_mrc(output, filtered, Grid(origin, step * factor, shape),
+                  label=filter_label(map_path, resolution))
+    finally:
+        del filtered
+        os.remove(tmp)
+        m.close()
+    return factor
+
+
+# ---------------------------------------------------------------------------------
+# Filters and downsamples the float32 values of a map in memory (as
+# filter_map, the values are smoothed in place). Returns the filtered values
+# and the downsampling factor.
+#
+def filter_values(values, step, map_resolution, resolution):
+
+    smooth(values, filter_sigma(step, map_resolution, resolution))
+    factor = downsampling_factor(step, resolution)
+    return values[::factor, ::factor, ::factor], factor
+
+
+# ---------------------------------------------------------------------------------
+# Width (x, y, z grid units) of the Gaussian filtering a map from its
+# resolution to a lower one (None if the resolution is not lower)
+#
+def filter_sigma(step, map_resolution, resolution):
+
+    from FitOpt.density import sigma_factor
+
+    r0, r1 = float(map_resolution), float(resolution)
+    if r1 <= r0:
+        return None
+    return sigma_factor * numpy.sqrt(r1 * r1 - r0 * r0) / step
+
+
+# ---------------------------------------------------------------------------------
+# Downsampling factor of a map filtered to a resolution
+#
+def downsampling_factor(step, resolution):
+
+    return max(1, int(float(resolution) / (samples_per_resolution * step.max())))
+
+
+# ---------------------------------------------------------------------------------
+# Smooths float32 values in place with a Gaussian of width sigma (x, y, z grid
+# units, nothing is done if it is None)
+#
+def smooth(values, sigma):
+
+    from FitOpt.density import convolve_axis, cutoff_range, gaussian_kernel
+
+    if sigma is None:
+        return
+    for axis in range(3):
+        radius = int(numpy.ceil(cutoff_range * sigma[axis]))
+        if radius > 0:
+            # Array axis 2 is x
+            convolve_axis(values, gaussian_kernel(sigma[axis], radius), 2 - axis)
+
+
+# ---------------------------------------------------------------------------------
+# Cut-off level of a filtered map equivalent to the cut-off of the map it was
+# filtered from: the level with the same fraction of map points above it, as
+# the smoothing lowers the density peaks. The values (indexed [z, y, x], they
+# may be mapped files) are read by slabs of z planes, and the level is found
+# with a histogram of the filtered values.
+#
+def equivalent_cutoff(values, filtered, cutoff, bins=65536):
+
+    cutoff = float(cutoff)
+    above = sum(int(numpy.count_nonzero(v >= cutoff)) for v in slabs(values))
+    if above == 0 or filtered.size == 0:
+        return cutoff
+
+    vmin = min(float(v.min()) for v in slabs(filtered))
+    vmax = max(float(v.max()) for v in slabs(filtered))
+    if above == values.size or vmax <= vmin:
+        return vmin
+    counts = numpy.zeros(bins, numpy.int64)
+    for v in slabs(filtered):
+        counts += numpy.histogram(v, bins, (vmin, vmax))[0]
+
+    # Points above the level, counted from the highest bin down
+    target = float(above) / values.size * filtered.size
+    from_top = numpy.cumsum(counts[::-1])
+    k = min(int(numpy.searchsorted(from_top, target)), bins - 1)
+    b = bins - 1 - k
+    inside = target - (from_top[k - 1] if k > 0 else 0)
+    width = (vmax - vmin) / bins
+    return vmin + width * (b + 1 - inside / max(1, counts[b]))
+
+
+# ---------------------------------------------------------------------------------
+# Float32 slabs of z planes of values indexed [z, y, x]
+#
+def slabs(values):
+
+    nz = values.shape[0]
+    planes = max(1, slab_bytes // (4 * max(1, values[:1].size)))
+    for z in range(0, nz, planes):
+        yield numpy.asarray(values[z:z + planes], numpy.float32)
+
+
+# ---------------------------------------------------------------------------------
+# Cut-off level (text) of a filtered map file equivalent to the cut-off of the
+# map file it was filtered from
+#
+def filtered_cutoff(map_path, filtered_path, cutoff):
+
+    from FitOpt.mrcmap import Mrc_Map
+
+    m, f = Mrc_Map(map_path), Mrc_Map(filtered_path)
+    try:
+        return '%.6g' % equivalent_cutoff(m.data, f.data, cutoff)
+    finally:
+        m.close()
+        f.close()
+
+
+# ---------------------------------------------------------------------------------
+# Label of a filtered map
+#
+def filter_label(map_path, resolution):
+
+    return 'FitOpt %s filtered to %s A' % (os.path.basename(map_path), resolution)
+
+
+# ---------------------------------------------------------------------------------
+# Runs the stages of a multi-stage fitting one after another, with the same
+# interface as Fit_Process. The next stage is launched when the output of the
+# previous one has been read and it has finished successfully. Every stage is
+# staged (its map cropped and filtered) in a worker thread, so the stages can
+# be polled from the Tk event loop (see fitprocess.Prepared_Process).
+#
+class Staged_Process:
+
+    # -------------------------------------------------
+    # jobs: Fit_Jobs of the stages
+    #
+    def __init__(self, jobs):
+
+        self.jobs = jobs
+        self.current = 0
+        self.process = None
+        # Lines not read yet which are not part of the output of the process
+        self.pending = []
+        # Exit code when a stage could not be launched
+        self.error = None
+        # Set when the stages are cancelled
+        self.cancelled = False
+
+    # ---------------------------------------------------------------------------
+    # Launches the first stage
+    #
+    def start(self):
+
+        self.start_stage()
+
+    def start_stage(self):
+
+        job = self.jobs[self.current]
+        # Stages done before the job was resumed are counted
+        done = job.first_stage
+        self.pending.append('\n==> FitOpt stage %d of %d: resolution %s, model %s\n\n'
+                            % (done + self.current + 1, done + len(self.jobs), job.resolution, job.model))
+        self.process = Prepared_Process(lambda: stage_process(job))
+        self.process.start()
+
+    # ---------------------------------------------------------------------------
+    # Launches the next stage if the current one has finished successfully
+    #
+    def next_stage(self):
+
+        p = self.process
+        if self.cancelled or not p.finished() or p.returncode() != 0 or self.current + 1 >= len(self.jobs):
+            return
+        self.current += 1
+        try:
+            self.start_stage()
+        except (IOError, OSError, ValueError) as e:
+            self.pending.append('FitOpt stage %d could not be executed: %s\n' % (self.current + 1, e))
+            self.error = 1
+
+    # ---------------------------------------------------------------------------
+    # Returns the lines produced since the last call without blocking
+    #
+    def new_lines(self, max_lines=None):
+
+        lines = self.pending + self.process.new_lines(max_lines)
+        self.pending = []
+        if self.error is None:
+            self.next_stage()
+        lines += self.pending
+        self.pending = []
+        return lines
+
+    # ---------------------------------------------------------------------------
+    # Returns True when the last stage (or a failed one) has finished and all
+    # its output was read
+    #
+    def finished(self):
+
+        if self.error is not None:
+            return True
+        p = self.process
+        return p.finished() and (self.cancelled or p.returncode() != 0 or self.current + 1 >= len(self.jobs))
+
+    # ---------------------------------------------------------------------------
+    # Stops the running stage, and the next ones are not started
+    #
+    def cancel(self):
+
+        self.cancelled = True
+        self.process.cancel()
+
+    # ---------------------------------------------------------------------------
+    # Exit code of the stage which failed or of the last one (None while running)
+    #
+    def returncode(self):
+
+        if self.error is not None:
+            return self.error
+        if not self.finished():
+            return None
+        return self.process.returncode()
+
+    # ---------------------------------------------------------------------------
+    # Blocks until all the stages are finished and returns the exit code.
+    # The output is kept to be read with new_lines.
+    #
+    def wait(self):
+
+        while True:
+            self.process.wait()
+            if self.finished():
+                return self.returncode()
+            self.pending = self.new_lines()
+            if self.error is not None:
+                return self.error
+
+
+# ---------------------------------------------------------------------------------
+# Stages the job of a stage and returns its Fit_Process (not started yet)
+#
+def stage_process(job):
+
+    job.stage()
+    return Fit_Process(job.command(), job.cwd)
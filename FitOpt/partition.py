@@ -0,0 +1,298 @@
+# ---------------------------------------------------------------------------------
+# Parallel fitting of spatially independent groups of models.
+#
+# The models to be fitted are grouped by proximity: two models are in the same
+# group if any of their atoms are closer than the contact distance (joined
+# transitively, with a union-find). Every group is fitted by its own fitopt
+# process, with the fixed models close to it as context, and the groups are run
+# concurrently through a Job_Queue. When all of them have finished, their fitted
+# PDBs, movies and logs are merged in the workspace of the job, so the results
+# look like the ones of a single fitopt run.
+#
+
+import copy
+import os
+
+import numpy
+
+from FitOpt.jobqueue import CANCELLED, FAILED, Job_Queue
+
+# Folder (inside the job workspace) of every group
+group_folder = 'group%d'
+
+# Minimum contact distance (A)
+min_contact_distance = 5.0
+
+
+# ---------------------------------------------------------------------------------
+# Distance (A) under which two models are fitted together: about the spread of
+# their simulated density at the map resolution
+#
+def contact_distance(resolution):
+
+    return max(min_contact_distance, float(resolution))
+
+
+# ---------------------------------------------------------------------------------
+# Coordinates of the atoms of a PDB, as a (atoms, 3) array
+#
+def pdb_coordinates(path):
+
+    from FitOpt.pdbio import parse_coordinates
+
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+    return parse_coordinates(data, numpy.float64)
+
+
+# ---------------------------------------------------------------------------------
+# True if any atoms of an indexed coordinate set (FitOpt.spatial.Cell_Index)
+# and of another one are closer than distance
+#
+def in_contact(index, xyz, distance):
+
+    if len(index) == 0 or len(xyz) == 0:
+        return False
+    # Quick rejection with the bounding boxes
+    if (index.xyz.min(axis=0) - distance > xyz.max(axis=0)).any() or \
+       (xyz.min(axis=0) - distance > index.xyz.max(axis=0)).any():
+        return False
+    return index.any_within(xyz, distance)
+
+
+# ---------------------------------------------------------------------------------
+# Groups of models which can be fitted independently.
+# Returns a list of (fitted indices, fixed indices), the fixed models of every
+# group being the ones in contact with any of its fitted models.
+#
+def partition_models(fitted, fixed, distance):
+
+    from FitOpt.spatial import Cell_Index
+
+    n = len(fitted)
+    parent = list(range(n))
+    indices = [Cell_Index(xyz, 0.5 * distance) for xyz in fitted]
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i in range(n):
+        for j in range(i + 1, n):
+            if find(i) != find(j) and in_contact(indices[i], fitted[j], distance):
+                parent[find(j)] = find(i)
+
+    groups = {}
+    for i in range(n):
+        groups.setdefault(find(i), []).append(i)
+    members = sorted(groups.values())
+
+    return [(m, [k for k in range(len(fixed)) if any(in_contact(indices[i], fixed[k], distance) for i in m)])
+            for m in members]
+
+
+# ---------------------------------------------------------------------------------
+# Groups of the models of a Fit_Job (read from their PDBs)
+#
+def job_groups(job, distance=None):
+
+    if distance is None:
+        distance = contact_distance(job.resolution)
+    return partition_models([pdb_coordinates(p) for p in job.fitted],
+                            [pdb_coordinates(p) for p in job.fixed], distance)
+
+
+# ---------------------------------------------------------------------------------
+# Fit_Jobs of the groups, run in subfolders of the job workspace
+#
+def group_jobs(job, groups):
+
+    jobs = []
+    for i, (fitted, fixed) in enumerate(groups):
+        g = copy.copy(job)
+        g.fitted = [job.fitted[k] for k in fitted]
+        g.fixed = [job.fixed[k] for k in fixed]
+        g.partition = False
+        # The groups are not checkpointed
+        g.checkpoint_interval = None
+        g.cwd = os.path.join(job.cwd, group_folder % (i + 1))
+        jobs.append(g)
+    return jobs
+
+
+# ---------------------------------------------------------------------------------
+# Runs the groups of a job concurrently, with the same interface as
+# Fit_Process. The output lines of every group are prefixed with its name.
+#
+class Partitioned_Process:
+
+    # -------------------------------------------------
+    # job: Fit_Job whose results are merged
+    # groups: groups of its models, as given by partition_models
+    # max_running: maximum number of groups running at the same time (by
+    #              default, one per core)
+    #
+    def __init__(self, job, groups, max_running=None):
+
+        self.job = job
+        self.groups = groups
+        self.queue = Job_Queue(max_running)
+        for i, g in enumerate(group_jobs(job, groups)):
+            self.queue.submit(group_folder % (i + 1), g)
+        # Exit code, set when all the groups have finished
+        self.code = None
+        self.pending = []
+
+    # ---------------------------------------------------------------------------
+    # Launches the first groups
+    #
+    def start(self):
+
+        if not os.path.isdir(self.job.cwd):
+            os.makedirs(self.job.cwd)
+        self.job.clear_results()
+        self.pending.append('FitOpt models split in %d independent groups: %s\n'
+                            % (len(self.groups), ', '.join('%d' % len(f) for f, x in self.groups)))
+        self.update()
+
+    # ---------------------------------------------------------------------------
+    # Reads the output of the groups and launches the queued ones. When all of
+    # them have finished, their results are merged.
+    #
+    def update(self):
+
+        if self.code is not None:
+            return
+        q = self.queue
+        q.update()
+        for qj in q.jobs:
+            self.pending.extend('[%s] %s' % (qj.name, line) for line in qj.recent_lines)
+        if not q.done():
+            return
+
+        failed = [qj for qj in q.jobs if qj.state in (FAILED, CANCELLED)]
+        if failed:
+            self.pending.append('FitOpt failed in %s\n' % ', '.join(qj.name for qj in failed))
+            self.code = failed[0].returncode or 1
+            return
+        try:
+            merge_results(self.job, [qj.job for qj in q.jobs], self.groups)
+        except (IOError, OSError, ValueError) as e:
+            self.pending.append('FitOpt results could not be merged: %s\n' % e)
+            self.code = 1
+            return
+        self.code = 0
+
+    def new_lines(self, max_lines=None):
+
+        self.update()
+        if max_lines is None:
+            lines, self.pending = self.pending, []
+        else:
+            lines, self.pending = self.pending[:max_lines], self.pending[max_lines:]
+        return lines
+
+    def finished(self):
+
+        return self.code is not None and not self.pending
+
+    # ---------------------------------------------------------------------------
+    # Stops the running groups and the queued ones are not started
+    #
+    def cancel(self):
+
+        self.queue.cancel()
+
+    def returncode(self):
+
+        return self.code if self.finished() else None
+
+    def wait(self, interval=0.5):
+
+        import time
+        while self.code is None:
+            time.sleep(interval)
+            self.update()
+        return self.code
+
+
+# ---------------------------------------------------------------------------------
+# Merges the results of the group jobs in the workspace of the job: the fitted
+# models (in their original order, one MODEL per model), the movies (frame by
+# frame, the groups with less frames keep their last one) and the logs
+#
+def merge_results(job, jobs, groups):
+
+    from FitOpt.pdbio import read_pdb, write_pdb
+
+    # Fitted models
+    models = [None] * len(job.fitted)
+    for g, (fitted, fixed) in zip(jobs, groups):
+        atoms = read_pdb(g.fitted_path())
+        for k, part in zip(fitted, split_models(atoms, g.fitted)):
+            part = part.copy()
+            part['model'] = k + 1
+            models[k] = part
+    write_pdb(job.fitted_path(), numpy.concatenate(models))
+
+    # Movie
+    if all(os.path.exists(g.movie_path()) for g in jobs):
+        merge_movies([g.movie_path() for g in jobs], job.movie_path())
+
+    # Log
+    from FitOpt.jobqueue import Queued_Job
+    out = open(os.path.join(job.cwd, Queued_Job.log_name), 'w')
+    for i, g in enumerate(jobs):
+        path = os.path.join(g.cwd, Queued_Job.log_name)
+        out.write('==> %s\n' % (group_folder % (i + 1)))
+        if os.path.exists(path):
+            f = open(path)
+            out.write(f.read())
+            f.close()
+    out.close()
+
+
+# ---------------------------------------------------------------------------------
+# Splits the atoms fitted by a group in its models: by model number if there is
+# one per model, otherwise by the number of atoms of every input PDB
+#
+def split_models(atoms, paths):
+
+    numbers = sorted(set(atoms['model'].tolist()))
+    if len(numbers) == len(paths):
+        return [atoms[atoms['model'] == n] for n in numbers]
+    parts = []
+    start = 0
+    for path in paths:
+        n = len(pdb_coordinates(path))
+        parts.append(atoms[start:start + n])
+        start += n
+    return parts
+
+
+# ---------------------------------------------------------------------------------
+# Writes a multi-model PDB trajectory joining the frames of several ones
+#
+def merge_movies(paths, output):
+
+    from FitOpt.trajectory import Pdb_Trajectory
+
+    movies = [Pdb_Trajectory(p, save_index=False) for p in paths]
+    try:
+        nframes = max(len(m) for m in movies)
+        out = open(output, 'wb')
+        for frame in range(nframes):
+            out.write(('MODEL     %4d\n' % (frame + 1)).encode('ascii'))
+            for m in movies:
+                if len(m) > 0:
+                    records = m.atom_records(min(frame, len(m) - 1))
+                    out.write(b'\n'.join(records) + b'\n')
+            out.write(b'ENDMDL\n')
+        out.write(b'END\n')
+        out.close()
+    finally:
+        for m in movies:
+            m.close()
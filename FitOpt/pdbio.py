@@ -0,0 +1,290 @@
+# ---------------------------------------------------------------------------------
+# PDB reader and writer working on NumPy arrays.
+#
+# The ATOM and HETATM records are read in bulk into a structured array with one
+# field per PDB column (record, serial, name, ..., xyz, occupancy, bfactor,
+# element, model). Lines are handled as rows of a byte matrix, so reading and
+# writing do not loop over the atoms in Python.
+#
+
+import numpy
+
+# Fields of the atoms array
+atom_dtype = numpy.dtype([('record', 'S6'), ('serial', 'i4'), ('name', 'S4'), ('altloc', 'S1'),
+                          ('resname', 'S3'), ('chain', 'S1'), ('resseq', 'i4'), ('icode', 'S1'),
+                          ('xyz', 'f8', (3,)), ('occupancy', 'f4'), ('bfactor', 'f4'),
+                          ('element', 'S2'), ('model', 'i4')])
+
+# Columns (start, end) of the text fields in the PDB records
+text_columns = (('record', 0, 6), ('name', 12, 16), ('altloc', 16, 17), ('resname', 17, 20),
+                ('chain', 21, 22), ('icode', 26, 27), ('element', 76, 78))
+
+# Width of the records written
+line_width = 80
+
+SPACE = ord(' ')
+NEWLINE = ord('\n')
+
+
+# ---------------------------------------------------------------------------------
+# Reads the atoms of a PDB file
+#
+def read_pdb(path):
+
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+    return parse_pdb(data)
+
+
+# ---------------------------------------------------------------------------------
+# Returns the lines of a PDB text as a (lines, 80) byte matrix padded with spaces
+#
+def line_matrix(data):
+
+    from numpy.lib.stride_tricks import as_strided
+
+    b = numpy.frombuffer(data, numpy.uint8)
+    if len(b) == 0:
+        return numpy.zeros((0, line_width), numpy.uint8)
+    breaks = numpy.flatnonzero(b == NEWLINE)
+    starts = numpy.concatenate(([0], breaks + 1))
+    ends = numpy.concatenate((breaks, [len(b)]))
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+
+    # Every line is a row of a sliding window over the text
+    padded = numpy.concatenate((b, numpy.full(line_width, SPACE, numpy.uint8)))
+    windows = as_strided(padded, shape=(len(b), line_width), strides=(1, 1))
+    lines = windows[starts]
+
+    # Blank the columns after the end of the short lines
+    lengths = ends - starts
+    short = numpy.flatnonzero(lengths < line_width)
+    if len(short) > 0:
+        rows = lines[short]
+        rows[numpy.arange(line_width)[None, :] >= lengths[short, None]] = SPACE
+        lines[short] = rows
+    # Carriage returns of DOS files
+    lines[lines == ord('\r')] = SPACE
+    return lines
+
+
+# ---------------------------------------------------------------------------------
+# Parses the ATOM and HETATM records of a PDB text.
+# Atoms after a MODEL record get its model number (0 if there are no MODEL records).
+#
+def parse_pdb(data):
+
+    lines = line_matrix(data)
+    rec = numpy.ascontiguousarray(lines[:, :6]).view('S6').ravel()
+    is_atom = (rec == b'ATOM  ') | (rec == b'HETATM')
+    is_model = rec == b'MODEL '
+
+    # Model number of every line: the one of the last MODEL record before it
+    model_numbers = integer_column(lines[is_model], 10, 14, 0)
+    model_index = numpy.cumsum(is_model)
+    models = numpy.concatenate(([0], model_numbers))[model_index]
+
+    a = lines[is_atom]
+    atoms = numpy.zeros(len(a), atom_dtype)
+    for name, start, end in text_columns:
+        atoms[name] = text_column(a, start, end)
+    atoms['serial'] = integer_column(a, 6, 11, 0)
+    atoms['resseq'] = integer_column(a, 22, 26, 0)
+    atoms['xyz'][:, 0] = float_column(a, 30, 38, 0)
+    atoms['xyz'][:, 1] = float_column(a, 38, 46, 0)
+    atoms['xyz'][:, 2] = float_column(a, 46, 54, 0)
+    atoms['occupancy'] = float_column(a, 54, 60, 1)
+    atoms['bfactor'] = float_column(a, 60, 66, 0)
+    atoms['model'] = models[is_atom]
+    return atoms
+
+
+# ---------------------------------------------------------------------------------
+# Coordinates of the ATOM and HETATM records of a PDB text, as a (atoms, 3) array
+#
+def parse_coordinates(data, dtype=numpy.float32):
+
+    lines = line_matrix(data)
+    rec = numpy.ascontiguousarray(lines[:, :6]).view('S6').ravel()
+    a = lines[(rec == b'ATOM  ') | (rec == b'HETATM')]
+    xyz = numpy.empty((len(a), 3), dtype)
+    for axis, start in enumerate((30, 38, 46)):
+        xyz[:, axis] = float_column(a, start, start + 8, 0)
+    return xyz
+
+
+# ---------------------------------------------------------------------------------
+# Columns [start, end) of a byte matrix as an array of strings
+#
+def text_column(lines, start, end):
+
+    return numpy.ascontiguousarray(lines[:, start:end]).view('S%d' % (end - start)).ravel()
+
+
+# ---------------------------------------------------------------------------------
+# Columns [start, end) of a byte matrix converted to numbers.
+# The digits are accumulated column by column for all the lines at once.
+# Blank fields get the default value.
+#
+def number_column(lines, start, end, default):
+
+    # One contiguous row per column of the field
+    cols = numpy.ascontiguousarray(lines[:, start:end].T)
+    n = len(lines)
+    value = numpy.zeros(n, numpy.int64)
+    decimals = numpy.zeros(n, numpy.int8)
+    point = numpy.zeros(n, bool)
+    neg = numpy.zeros(n, bool)
+    blank = numpy.ones(n, bool)
+    for c in cols:
+        d = c - ord('0')
+        digit = d < 10
+        value[digit] *= 10
+        value += numpy.where(digit, d, 0)
+        decimals += digit & point
+        point |= c == ord('.')
+        neg |= c == ord('-')
+        blank &= c == SPACE
+    value[neg] *= -1
+    return value, decimals, blank
+
+
+def integer_column(lines, start, end, default):
+
+    v, decimals, blank = number_column(lines, start, end, default)
+    v[blank] = default
+    return v
+
+
+def float_column(lines, start, end, default):
+
+    v, decimals, blank = number_column(lines, start, end, default)
+    f = v / numpy.power(10.0, decimals)
+    f[blank] = default
+    return f
+
+
+# ---------------------------------------------------------------------------------
+# Writes the atoms to a PDB file. If the atoms belong to several models,
+# every model is written between MODEL and ENDMDL records.
+#
+def write_pdb(path, atoms):
+
+    f = open(path, 'wb')
+    f.write(format_pdb(atoms))
+    f.close()
+
+
+# ---------------------------------------------------------------------------------
+# Returns the PDB text of the atoms
+#
+def format_pdb(atoms):
+
+    lines = atom_lines(atoms)
+    text = lines.tobytes()
+    models = numpy.unique(atoms['model'])
+    if len(models) <= 1:
+        return text + b'END\n'
+
+    # MODEL / ENDMDL around the atoms of every model, in the order of the atoms
+    w = line_width + 1
+    bounds = numpy.flatnonzero(numpy.diff(atoms['model'])) + 1
+    starts = numpy.concatenate(([0], bounds))
+    ends = numpy.concatenate((bounds, [len(atoms)]))
+    parts = []
+    for s, e in zip(starts, ends):
+        parts.append(('MODEL     %4d\n' % atoms['model'][s]).encode('ascii'))
+        parts.append(text[s * w:e * w])
+        parts.append(b'ENDMDL\n')
+    parts.append(b'END\n')
+    return b''.join(parts)
+
+
+# ---------------------------------------------------------------------------------
+# Returns the ATOM/HETATM records of the atoms as a (atoms, 81) byte matrix
+# (80 columns and the line break)
+#
+def atom_lines(atoms):
+
+    n = len(atoms)
+    lines = numpy.full((n, line_width + 1), SPACE, numpy.uint8)
+    lines[:, line_width] = NEWLINE
+
+    for name, start, end in text_columns:
+        put_text(lines, start, end, atoms[name])
+    # Element symbols are right justified
+    put_text(lines, 76, 78, numpy.char.rjust(atoms['element'], 2))
+
+    # Serial numbers of more than 5 digits are wrapped, as most programs do
+    lines[:, 6:11] = format_integer(atoms['serial'] % 100000, 5)
+    lines[:, 22:26] = format_integer(atoms['resseq'], 4)
+    xyz = atoms['xyz']
+    lines[:, 30:38] = format_fixed(xyz[:, 0], 8, 3)
+    lines[:, 38:46] = format_fixed(xyz[:, 1], 8, 3)
+    lines[:, 46:54] = format_fixed(xyz[:, 2], 8, 3)
+    lines[:, 54:60] = format_fixed(atoms['occupancy'], 6, 2)
+    lines[:, 60:66] = format_fixed(atoms['bfactor'], 6, 2)
+    return lines
+
+
+# ---------------------------------------------------------------------------------
+# Writes strings left justified in the columns [start, end) of a byte matrix
+#
+def put_text(lines, start, end, values):
+
+    width = end - start
+    b = numpy.ascontiguousarray(values, 'S%d' % width).view(numpy.uint8).reshape((-1, width))
+    lines[:, start:end] = numpy.where(b == 0, SPACE, b)
+
+
+# ---------------------------------------------------------------------------------
+# Right justified decimal digits of non negative integers, with a minus sign
+# where neg is True. Returns a (values, width) byte matrix.
+#
+def format_digits(values, neg, width, min_digits=1):
+
+    n = len(values)
+    # One contiguous row per column of the field
+    out = numpy.empty((width, n), numpy.uint8)
+    rest = numpy.array(values, numpy.int64)
+    ndigits = numpy.zeros(n, numpy.int64)
+    alive = numpy.ones(n, bool)
+    for pos in range(width - 1, -1, -1):
+        rest, digit = numpy.divmod(rest, 10)
+        out[pos] = numpy.where(alive, ord('0') + digit, SPACE)
+        ndigits += alive
+        alive = (rest > 0) | (ndigits < min_digits)
+    sign = width - 1 - ndigits
+    if alive.any() or (neg & (sign < 0)).any():
+        raise ValueError('Value does not fit in a PDB field of %d columns' % width)
+    rows = numpy.flatnonzero(neg)
+    out[sign[rows], rows] = ord('-')
+    return out.T
+
+
+# ---------------------------------------------------------------------------------
+# Integers right justified in width columns
+#
+def format_integer(values, width):
+
+    v = numpy.asarray(values, numpy.int64)
+    return format_digits(numpy.abs(v), v < 0, width)
+
+
+# ---------------------------------------------------------------------------------
+# Numbers with a fixed number of decimals ('%width.decimalsf') as a byte matrix
+#
+def format_fixed(values, width, decimals):
+
+    v = numpy.asarray(values, numpy.float64)
+    scale = 10 ** decimals
+    units = numpy.rint(numpy.abs(v) * scale).astype(numpy.int64)
+    neg = (v < 0) & (units > 0)
+    out = numpy.empty((len(v), width), numpy.uint8)
+    int_width = width - decimals - 1
+    out[:, :int_width] = format_digits(units // scale, neg, int_width)
+    out[:, int_width] = ord('.')
+    out[:, int_width + 1:] = format_digits(units % scale, numpy.zeros(len(v), bool), decimals, decimals)
+    return out
@@ -0,0 +1,202 @@
+# ---------------------------------------------------------------------------------
+# Progress of the FitOpt process.
+#
+# Progress_Parser reads the standard output of fitopt line by line and turns it
+# into progress events. Throttled_Log shows those events in a Tk Text widget,
+# coalescing all the updates received between two refreshes, so the log costs
+# the same whatever the number of iteration lines written by fitopt.
+#
+# fitopt output is made of general messages, then for every model:
+#   - a header line with the iteration columns (it contains 'NMA_time' and 'Score')
+#   - a line with the time of the model ('sec')
+#   - one line per iteration with the values of the columns
+#   - a 'Convergence' line when the model is finished
+#
+
+import time
+
+# Event kinds
+MESSAGE = 'message'
+HEADER = 'header'
+MODEL = 'model'
+ITERATION = 'iteration'
+CONVERGED = 'converged'
+
+
+# ---------------------------------------------------------------------------------
+# Event of the FitOpt process
+#
+class Progress_Event:
+
+    # -------------------------------------------------
+    # kind: MESSAGE, HEADER, MODEL, ITERATION or CONVERGED
+    # text: line of the fitopt output without the line break
+    # model: number of the model being fitted (starting at 1, 0 before the first one)
+    # iteration, score, nma_time: values of an ITERATION line (None if not given)
+    #
+    def __init__(self, kind, text, model=0, iteration=None, score=None, nma_time=None):
+
+        self.kind = kind
+        self.text = text
+        self.model = model
+        self.iteration = iteration
+        self.score = score
+        self.nma_time = nma_time
+
+
+# ---------------------------------------------------------------------------------
+# Incremental parser of the fitopt output
+#
+class Progress_Parser:
+
+    def __init__(self):
+
+        # True while the iteration lines of a model are being read
+        self.iterating = False
+        # Number of the current model
+        self.model = 0
+        # Column names of the iteration lines
+        self.columns = []
+        # Last iteration event
+        self.last_iteration = None
+
+    # ---------------------------------------------------------------------------
+    # Parses a line of the output. Returns its event, or None for empty lines.
+    #
+    def feed(self, line):
+
+        text = line.rstrip('\r\n')
+        if len(text.strip()) == 0:
+            return None
+
+        if 'NMA_time' in text and 'Score' in text:
+            self.iterating = True
+            self.columns = text.split()
+            return Progress_Event(HEADER, text, self.model)
+
+        if 'Convergence' in text:
+            self.iterating = False
+            return Progress_Event(CONVERGED, text, self.model)
+
+        if self.iterating and 'sec' in text:
+            self.model += 1
+            return Progress_Event(MODEL, text, self.model)
+
+        if self.iterating and 'NMA' not in text:
+            event = self.iteration_event(text)
+            if event is not None:
+                self.last_iteration = event
+                return event
+
+        return Progress_Event(MESSAGE, text, self.model)
+
+    # ---------------------------------------------------------------------------
+    # Builds the event of an iteration line using the column names of the header.
+    # Returns None if the line does not contain the iteration values.
+    #
+    def iteration_event(self, text):
+
+        values = text.split()
+        try:
+            iteration = int(values[0])
+        except (IndexError, ValueError):
+            return None
+
+        score = self.column_value(values, 'Score')
+        nma_time = self.column_value(values, 'NMA_time')
+        return Progress_Event(ITERATION, text, self.model, iteration, score, nma_time)
+
+    # ---------------------------------------------------------------------------
+    # Value of the named column in an iteration line (None if it is not a number)
+    #
+    def column_value(self, values, name):
+
+        if name not in self.columns:
+            return None
+        i = self.columns.index(name)
+        if i >= len(values):
+            return None
+        try:
+            return float(values[i])
+        except ValueError:
+            return None
+
+
+# ---------------------------------------------------------------------------------
+# Process log shown in a Tk Text widget and refreshed at a fixed rate.
+#
+# The lines of the general messages, headers, models and convergences are kept
+# in the log. The iteration lines of a model replace each other: only the last
+# one is shown, in the last line of the log.
+#
+class Throttled_Log:
+
+    # -------------------------------------------------
+    # text: Tk Text widget
+    # interval: minimum seconds between two refreshes of the widget
+    #
+    def __init__(self, text, interval=0.25):
+
+        self.text = text
+        self.interval = interval
+        self.last_refresh = 0
+        # Lines waiting to be added to the log
+        self.pending = []
+        # Last iteration line (shown at the end of the log)
+        self.live = None
+        # True if the widget shows an iteration line at the end of the log
+        self.live_shown = False
+        # True if there are changes not shown in the widget
+        self.changed = False
+
+    # ---------------------------------------------------------------------------
+    # Adds an event to the log. The widget is not updated until refresh is called.
+    #
+    def add(self, event):
+
+        if event is None:
+            return
+        if event.kind == ITERATION:
+            self.live = event.text
+        else:
+            # The last iteration of the previous model is kept in the log
+            if self.live is not None and event.kind in (MODEL, CONVERGED):
+                self.pending.append(self.live)
+                self.live = None
+            self.pending.append(event.text)
+        self.changed = True
+
+    # ---------------------------------------------------------------------------
+    # Adds a line of text to the log
+    #
+    def write(self, text):
+
+        self.add(Progress_Event(MESSAGE, text.rstrip('\n')))
+
+    # ---------------------------------------------------------------------------
+    # Updates the widget if the refresh interval has passed since the last
+    # update (or always if force is True).
+    #
+    def refresh(self, force=False):
+
+        if not self.changed:
+            return
+        now = time.time()
+        if not force and now - self.last_refresh < self.interval:
+            return
+        self.last_refresh = now
+        self.changed = False
+
+        T = self.text
+        if self.live_shown:
+            T.delete('live_start', 'end')
+            self.live_shown = False
+        if self.pending:
+            T.insert('end', '\n'.join(self.pending) + '\n')
+            self.pending = []
+        if self.live is not None:
+            T.mark_set('live_start', 'end-1c')
+            T.mark_gravity('live_start', 'left')
+            T.insert('end', self.live + '\n')
+            self.live_shown = True
+        T.see('end')
@@ -0,0 +1,201 @@
+# ---------------------------------------------------------------------------------
+# Persistent cache of FitOpt results.
+#
+# The results of a job (fitted PDB, movie and log) are saved in a folder named
+# after a hash of the contents of its input files (PDBs and map) and of its
+# normalized FitOpt options. Running again a job with the same inputs restores
+# the results instead of executing fitopt. The least recently used results are
+# removed when the cache is bigger than its size limit.
+#
+
+import hashlib
+import os
+import shutil
+
+
+# ---------------------------------------------------------------------------------
+# Cache of FitOpt results
+#
+class Result_Cache:
+
+    # Default folder of the cache
+    default_root = os.path.join(os.path.expanduser('~'), '.fitopt', 'results')
+    # Default size limit (bytes)
+    default_max_bytes = 4 * 1024 ** 3
+    # Files of the results that are saved (the ones missing are ignored)
+    result_names = ('fitopt_fitted.pdb', 'fitopt_movie.pdb', 'fitopt.log')
+
+    # -------------------------------------------------
+    # root: folder of the cache
+    # max_bytes: size limit of the cache
+    #
+    def __init__(self, root=None, max_bytes=None):
+
+        self.root = self.default_root if root is None else root
+        self.max_bytes = self.default_max_bytes if max_bytes is None else max_bytes
+        # Hashes of the files already read: path -> (size, mtime, hash)
+        self.file_hashes = {}
+
+    # ---------------------------------------------------------------------------
+    # Hash of the contents of a file. It is only computed again if the file
+    # size or modification time change.
+    #
+    def file_hash(self, path):
+
+        st = os.stat(path)
+        cached = self.file_hashes.get(path)
+        if cached is not None and cached[:2] == (st.st_size, st.st_mtime):
+            return cached[2]
+
+        h = hashlib.sha1()
+        f = open(path, 'rb')
+        chunk = f.read(1 << 20)
+        while chunk:
+            h.update(chunk)
+            chunk = f.read(1 << 20)
+        f.close()
+        digest = h.hexdigest()
+        self.file_hashes[path] = (st.st_size, st.st_mtime, digest)
+        return digest
+
+    # ---------------------------------------------------------------------------
+    # Key of the results of a Fit_Job
+    #
+    def key(self, job):
+
+        h = hashlib.sha1()
+        for label, paths in (('fitted', job.fitted), ('fixed', job.fixed), ('map', [job.map_path])):
+            h.update(label.encode('ascii'))
+            for path in paths:
+                h.update(self.file_hash(path).encode('ascii'))
+        h.update('\0'.join(job_options(job)).encode('utf-8'))
+        return h.hexdigest()
+
+    # ---------------------------------------------------------------------------
+    # Folder of the results with the given key
+    #
+    def entry_path(self, key):
+
+        return os.path.join(self.root, key)
+
+    # ---------------------------------------------------------------------------
+    # Copies the cached results of the job to its workspace.
+    # Returns True if the results were in the cache.
+    #
+    def restore(self, job):
+
+        entry = self.entry_path(self.key(job))
+        if not os.path.isdir(entry):
+            return False
+        if not os.path.isdir(job.cwd):
+            os.makedirs(job.cwd)
+        job.clear_results()
+        for name in os.listdir(entry):
+            target = os.path.join(job.cwd, name)
+            if os.path.exists(target):
+                os.remove(target)
+            link_or_copy(os.path.join(entry, name), target)
+        # Mark the entry as recently used
+        os.utime(entry, None)
+        return True
+
+    # ---------------------------------------------------------------------------
+    # Saves the results of a finished job
+    #
+    def store(self, job):
+
+        entry = self.entry_path(self.key(job))
+        if os.path.isdir(entry):
+            os.utime(entry, None)
+            return
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+        # Results are copied in a temporary folder which is renamed at the end,
+        # so an entry is never seen half written
+        tmp = '%s.tmp%d' % (entry, os.getpid())
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for name in self.result_names:
+            path = os.path.join(job.cwd, name)
+            if os.path.exists(path):
+                link_or_copy(path, os.path.join(tmp, name))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Stored at the same time by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    # ---------------------------------------------------------------------------
+    # Removes the least recently used entries until the cache size is under
+    # its limit
+    #
+    def evict(self):
+
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path) or '.tmp' in name:
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+            total += size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    # ---------------------------------------------------------------------------
+    # Removes all the cached results
+    #
+    def clear(self):
+
+        if os.path.isdir(self.root):
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+# ---------------------------------------------------------------------------------
+# Normalized options of a Fit_Job which change its results, as a list of texts
+#
+def job_options(job):
+
+    options = [normalized(v) for v in (job.resolution, job.cutoff, job.model, job.modes,
+                                      job.fixing, job.rediag)] + job.adv_commands
+    if job.crop:
+        # The cropped map depends on the margin
+        options.append('crop %s' % normalized(job.crop_margin))
+    if job.partition:
+        options.append('partition')
+    for resolution, model in job.stages:
+        options.append('stage %s %s' % (normalized(resolution), model))
+    return options
+
+
+# ---------------------------------------------------------------------------------
+# Normalized text of a FitOpt option, so "10", "10.0" and " 10" get the same key
+#
+def normalized(value):
+
+    value = str(value).strip()
+    try:
+        return repr(float(value))
+    except ValueError:
+        return value
+
+
+# ---------------------------------------------------------------------------------
+# Hard links a file (instant and without using disk space) or copies it when
+# links are not possible (different file systems)
+#
+def link_or_copy(source, target):
+
+    try:
+        os.link(source, target)
+    except (OSError, AttributeError):
+        shutil.copy2(source, target)
@@ -0,0 +1,183 @@
+# ---------------------------------------------------------------------------------
+# Scores of the fit of atomic models into a density map.
+#
+# The two fitting criteria of FitOpt are computed over the map points above the
+# cut-off level:
+#
+#   ccc         linear cross-correlation (normalized scalar product) of the map
+#               and the simulated density of the model at the map resolution
+#   laplacian   cross-correlation of the Laplacian filtered maps, which
+#               enhances the contrast of the map features
+#
+# The norms of the masked target map are computed once per map, resolution
+# and cut-off, reading the map by slabs, and only the box of the map around the
+# model is simulated and compared for every conformation: the mask and the
+# targets are computed in that box, so a memory mapped map is never read
+# whole in memory.
+#
+
+import numpy
+
+from FitOpt.density import Grid, atom_weights, box_slices, simulate_box
+
+# Fitting criteria
+LINEAR = 'ccc'
+LAPLACIAN = 'laplacian'
+
+
+# ---------------------------------------------------------------------------------
+# Scores of models fitted into a map
+#
+class Map_Scorer:
+
+    # Maximum bytes of the slabs of the map read to compute its norms
+    slab_bytes = 16 * 1024 ** 2
+
+    # -------------------------------------------------
+    # values: map values, indexed [z, y, x]
+    # grid: FitOpt.density.Grid of the map
+    # resolution: resolution of the simulated maps
+    # cutoff: map points below this level are not considered
+    #
+    def __init__(self, values, grid, resolution, cutoff):
+
+        self.grid = grid
+        # File of the map (if it was read with from_file)
+        self.path = None
+        self.resolution = float(resolution)
+        self.cutoff = float(cutoff)
+
+        # Map values (memory mapped if the map was read with FitOpt.mrcmap)
+        self.values = values
+        self.target_norm = self.target_norms()
+
+    # ---------------------------------------------------------------------------
+    # Norms of the targets of every criterion over the whole map, computed by
+    # slabs of z planes
+    #
+    def target_norms(self):
+
+        nz, ny, nx = self.values.shape
+        planes = max(1, self.slab_bytes // (4 * ny * nx))
+        squares = dict((c, 0.0) for c in (LINEAR, LAPLACIAN))
+        for z in range(0, nz, planes):
+            mask, targets = self.targets((slice(z, min(z + planes, nz)), slice(0, ny), slice(0, nx)))
+            for c, t in targets.items():
+                squares[c] += float(numpy.dot(t.ravel(), t.ravel()))
+        return dict((c, numpy.sqrt(v)) for c, v in squares.items())
+
+    # ---------------------------------------------------------------------------
+    # Mask of the map points over the cut-off, and target of every criterion
+    # (map values and their Laplacian on the mask, zero out of it), in a region
+    # of the map given as (z, y, x) slices. The Laplacian is computed with the
+    # neighbor planes of the region, so it is the one of the whole map.
+    #
+    def targets(self, region):
+
+        shape = self.values.shape
+        outer = tuple(slice(max(r.start - 1, 0), min(r.stop + 1, n)) for r, n in zip(region, shape))
+        inner = tuple(slice(r.start - o.start, r.stop - o.start) for r, o in zip(region, outer))
+        values = numpy.asarray(self.values[outer], numpy.float32)
+        lap = laplacian(values)[inner]
+        values = values[inner]
+        mask = values >= self.cutoff
+        return mask, {LINEAR: numpy.where(mask, values, 0).astype(numpy.float32),
+                      LAPLACIAN: numpy.where(mask, lap, 0).astype(numpy.float32)}
+
+    # ---------------------------------------------------------------------------
+    # Scorer of a map file
+    #
+    @classmethod
+    def from_file(cls, path, resolution, cutoff):
+
+        values, grid = open_map(path)
+        scorer = cls(values, grid, resolution, cutoff)
+        scorer.path = path
+        return scorer
+
+    # ---------------------------------------------------------------------------
+    # Score of a simulated map of the whole grid
+    #
+    def score_map(self, simulated, criterion=LINEAR):
+
+        return self.score_box(simulated, numpy.zeros(3, int), criterion)
+
+    # ---------------------------------------------------------------------------
+    # Score of a simulated map which is zero out of a box starting at the grid
+    # indices lo (x, y, z)
+    #
+    def score_box(self, box, lo, criterion=LINEAR):
+
+        if criterion == LAPLACIAN:
+            box = laplacian(box)
+        elif criterion != LINEAR:
+            raise ValueError('Unknown fitting criterion %s' % criterion)
+
+        mask, targets = self.targets(box_slices(box, lo))
+        target = targets[criterion]
+        s = numpy.where(mask, box, 0)
+        norm = numpy.sqrt(numpy.vdot(s, s)) * self.target_norm[criterion]
+        if norm == 0:
+            return 0.0
+        return float(numpy.vdot(target, s) / norm)
+
+    # ---------------------------------------------------------------------------
+    # Score of a conformation
+    # xyz: (atoms, 3) coordinates, weights: atom weights (1 if None)
+    #
+    def score(self, xyz, weights=None, criterion=LINEAR):
+
+        box, lo = simulate_box(xyz, self.grid, self.resolution, weights)
+        if box is None:
+            return 0.0
+        return self.score_box(box, lo, criterion)
+
+    # ---------------------------------------------------------------------------
+    # Scores of several conformations of the same atoms, as an array
+    #
+    def scores(self, conformations, weights=None, criterion=LINEAR):
+
+        return numpy.array([self.score(xyz, weights, criterion) for xyz in conformations])
+
+    # ---------------------------------------------------------------------------
+    # Scores of the atoms read with FitOpt.pdbio with both criteria
+    #
+    def atom_scores(self, atoms):
+
+        box, lo = simulate_box(atoms['xyz'], self.grid, self.resolution, atom_weights(atoms))
+        if box is None:
+            return {LINEAR: 0.0, LAPLACIAN: 0.0}
+        return dict((c, self.score_box(box, lo, c)) for c in (LINEAR, LAPLACIAN))
+
+
+# ---------------------------------------------------------------------------------
+# Discrete Laplacian (6 neighbors, zero out of the array) as a float32 array
+#
+def laplacian(a):
+
+    a = numpy.asarray(a, numpy.float32)
+    out = -6 * a
+    out[1:] += a[:-1]
+    out[:-1] += a[1:]
+    out[:, 1:] += a[:, :-1]
+    out[:, :-1] += a[:, 1:]
+    out[:, :, 1:] += a[:, :, :-1]
+    out[:, :, :-1] += a[:, :, 1:]
+    return out
+
+
+# ---------------------------------------------------------------------------------
+# Reads a map file: MRC / CCP4 maps with FitOpt.mrcmap, other formats with the
+# Chimera VolumeData module.
+# Returns its values, indexed [z, y, x], and its FitOpt.density.Grid.
+#
+def open_map(path):
+
+    from FitOpt.mrcmap import Mrc_Map, is_mrc
+    if is_mrc(path):
+        m = Mrc_Map(path)
+        return m.data, m.grid()
+
+    from VolumeData import open_file
+    data = open_file(path)[0]
+    return data.matrix(), Grid.from_data(data)
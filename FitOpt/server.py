@@ -0,0 +1,812 @@
+# ---------------------------------------------------------------------------------
+# Local FitOpt server.
+#
+# A fitting starts by reading the map and preparing it (cropping it around the
+# models and low-pass filtering it to the fitting resolution), which for big
+# maps takes much longer than launching fitopt. The server is a long running
+# process which keeps the maps and the prepared maps in memory (Map_Cache, the
+# least recently used ones are released when they exceed a memory budget), so
+# fitting again against the same map only links the prepared map in the
+# workspace of the job.
+#
+# The jobs are run by a fixed number of worker threads of the server, and
+# clients (the Chimera dialog, the command line) talk to it through a Unix
+# socket with one JSON object per line:
+#
+#   {"op": "submit", "job": {...}, "name": "..."}   ->  {"ok": true, "id": 1}
+#   {"op": "poll", "id": 1, "start": 0}             ->  {"ok": true, "lines": [...],
+#                                                        "finished": false, ...}
+#   {"op": "cancel", "id": 1}, {"op": "status"}, {"op": "forget", "id": 1},
+#   {"op": "shutdown"}
+#
+#   python -m FitOpt.server start [--workers 4] [--memory 8]
+#   python -m FitOpt.fitjob --server --map map.mrc ... fitted.pdb
+#   python -m FitOpt.server status
+#   python -m FitOpt.server stop
+#
+
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import numpy
+
+# Default socket of the server
+default_socket = os.path.join(os.path.expanduser('~'), '.fitopt', 'server.sock')
+
+
+# ---------------------------------------------------------------------------------
+# Error of a request to the server (or the server is not running)
+#
+class Server_Error(IOError):
+    pass
+
+
+# ---------------------------------------------------------------------------------
+# Map values kept in memory: the values of a whole map, or of a cropped or
+# filtered map prepared for a job
+#
+class Map_Entry:
+
+    # -------------------------------------------------
+    # values: values indexed [z, y, x]
+    # grid: their FitOpt.density.Grid
+    # label: label of the MRC file
+    #
+    def __init__(self, values, grid, label):
+
+        self.values = values
+        self.grid = grid
+        self.label = label
+        # MRC file with the values (written when it is first staged), and the
+        # lock of its writing
+        self.path = None
+        self.lock = threading.Lock()
+
+
+# ---------------------------------------------------------------------------------
+# Maps and prepared maps kept in memory
+#
+class Map_Cache:
+
+    # Default folder of the prepared map files
+    default_folder = os.path.join(os.path.expanduser('~'), '.fitopt', 'maps')
+    # Default memory budget (bytes)
+    default_max_bytes = 8 * 1024 ** 3
+
+    # -------------------------------------------------
+    # folder: folder where the prepared maps are written (and then linked in
+    #         the job workspaces)
+    # max_bytes: memory budget of the map values
+    #
+    def __init__(self, folder=None, max_bytes=None):
+
+        self.folder = self.default_folder if folder is None else folder
+        self.max_bytes = self.default_max_bytes if max_bytes is None else max_bytes
+        # Entries from the least to the most recently used
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Jobs are staged by several worker threads. The lock only guards the
+        # entries: the maps are read and prepared without it, so the jobs whose
+        # maps are in memory are not blocked meanwhile.
+        self.lock = threading.RLock()
+        # Events of the entries being made, set when they are done
+        self.loading = {}
+
+    # ---------------------------------------------------------------------------
+    # Entry with the given key. If it is not in memory, make is called to get
+    # its values, grid and label. Threads asking for an entry which is being
+    # made by another thread wait for it.
+    #
+    def entry(self, key, make):
+
+        while True:
+            with self.lock:
+                e = self.entries.pop(key, None)
+                if e is not None:
+                    self.hits += 1
+                    self.entries[key] = e
+                    return e
+                loading = self.loading.get(key)
+                if loading is None:
+                    loading = self.loading[key] = threading.Event()
+                    break
+            # Made by another thread (if it fails, it is made again)
+            loading.wait()
+
+        try:
+            e = Map_Entry(*make())
+        except:
+            with self.lock:
+                del self.loading[key]
+            loading.set()
+            raise
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = e
+            self.bytes += e.values.nbytes
+            self.evict()
+            del self.loading[key]
+        loading.set()
+        return e
+
+    # ---------------------------------------------------------------------------
+    # Entry of the values of a whole MRC map. It is read again if the file
+    # changes.
+    #
+    def map_entry(self, path):
+
+        from FitOpt.mrcmap import Mrc_Map
+
+        def read():
+            m = Mrc_Map(path)
+            try:
+                return numpy.array(m.data, order='C'), m.grid(), os.path.basename(path)
+            finally:
+                m.close()
+
+        return self.entry(file_key(path), read)
+
+    # ---------------------------------------------------------------------------
+    # Stages in the workspace of a Fit_Job the cropped and filtered maps it
+    # needs, as Fit_Job.stage_cropped_map and stage_filtered_map do, but
+    # preparing them from the values in memory
+    #
+    def stage_maps(self, job):
+
+        from FitOpt import cropping
+        from FitOpt.density import Grid
+        from FitOpt.mrcmap import is_mrc
+        from FitOpt.multires import equivalent_cutoff, filter_label, filter_values
+        from FitOpt.resultcache import normalized
+
+        job.cropped_map = job.filtered_map = job.map_cutoff = None
+        filtering = job.filtering()
+        if not (job.crop or filtering) or not is_mrc(job.map_path):
+            return
+
+        source = self.map_entry(job.map_path)
+        key = file_key(job.map_path)
+        box = None
+        if job.crop:
+            margin = job.crop_margin
+            if margin is None:
+                margin = cropping.crop_margin(job.resolution)
+            box = cropping.crop_box(source.grid, cropping.model_bounds(job.fitted + job.fixed), margin)
+
+        if box is not None:
+            (i0, j0, k0), (i1, j1, k1) = box
+            full = source
+
+            def crop():
+                g = full.grid
+                return (numpy.array(full.values[k0:k1, j0:j1, i0:i1], order='C'),
+                        Grid(g.origin + numpy.array(box[0]) * g.step, g.step, (k1 - k0, j1 - j0, i1 - i0)),
+                        cropping.crop_label(job.map_path))
+
+            key += ('crop',) + box
+            source = self.entry(key, crop)
+
+        if filtering:
+            cropped = source
+            name = job.cropped_map_name if box is not None else job.map_path
+
+            def filtered():
+                values, factor = filter_values(numpy.array(cropped.values, numpy.float32), cropped.grid.step,
+                                               job.map_resolution, job.resolution)
+                grid = Grid(cropped.grid.origin, cropped.grid.step * factor, values.shape)
+                return numpy.ascontiguousarray(values), grid, filter_label(name, job.resolution)
+
+            key += ('filter', normalized(job.map_resolution), normalized(job.resolution))
+            entry = self.entry(key, filtered)
+            job.filtered_map = self.stage_file(entry, key, os.path.join(job.cwd, job.filtered_map_name))
+            job.map_cutoff = '%.6g' % equivalent_cutoff(cropped.values, entry.values, job.cutoff)
+        elif box is not None:
+            job.cropped_map = self.stage_file(source, key, os.path.join(job.cwd, job.cropped_map_name))
+
+    # ---------------------------------------------------------------------------
+    # Links (or copies) the MRC file of an entry to a path of a workspace,
+    # writing it the first time. Returns the path.
+    #
+    def stage_file(self, entry, key, path):
+
+        from FitOpt.mrcmap import write_mrc
+        from FitOpt.resultcache import link_or_copy
+
+        with entry.lock:
+            if entry.path is None or not os.path.exists(entry.path):
+                if not os.path.isdir(self.folder):
+                    os.makedirs(self.folder, 0o700)
+                name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+                entry.path = os.path.join(self.folder, name + '.mrc')
+                # Written with another name and renamed, so it is never seen half written
+                tmp = entry.path + '.tmp'
+                write_mrc(tmp, entry.values, entry.grid, label=entry.label)
+                os.rename(tmp, entry.path)
+            if os.path.exists(path):
+                os.remove(path)
+            link_or_copy(entry.path, path)
+        return path
+
+    # ---------------------------------------------------------------------------
+    # Releases the least recently used entries (and removes their files) until
+    # the values in memory are under the memory budget. The last entry used is
+    # always kept.
+    #
+    def evict(self):
+
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            key, e = self.entries.popitem(last=False)
+            self.bytes -= e.values.nbytes
+            remove_file(e.path)
+
+    # ---------------------------------------------------------------------------
+    # Releases all the entries and removes the prepared map files (the ones
+    # left by a previous server too)
+    #
+    def clear(self):
+
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            if os.path.isdir(self.folder):
+                for name in os.listdir(self.folder):
+                    if name.endswith('.mrc') or name.endswith('.mrc.tmp'):
+                        remove_file(os.path.join(self.folder, name))
+
+    # ---------------------------------------------------------------------------
+    # Usage of the cache as a dictionary
+    #
+    def stats(self):
+
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+# ---------------------------------------------------------------------------------
+# Key of the contents of a file: path, size and modification time
+#
+def file_key(path):
+
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_size, st.st_mtime)
+
+
+def remove_file(path):
+
+    if path is not None and os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# ---------------------------------------------------------------------------------
+# Options of a Fit_Job as a dictionary that can be sent to the server
+#
+def job_spec(job):
+
+    return {'fitted': job.fitted, 'fixed': job.fixed, 'map_path': job.map_path,
+            'resolution': job.resolution, 'cutoff': job.cutoff, 'model': job.model, 'modes': job.modes,
+            'fixing': job.fixing, 'rediag': job.rediag, 'adv_commands': job.adv_commands,
+            'cwd': job.cwd, 'fitopt': job.fitopt, 'crop': job.crop, 'crop_margin': job.crop_margin,
+            'stages': [list(s) for s in job.stages], 'map_resolution': job.map_resolution,
+            'partition': job.partition, 'checkpoint_interval': job.checkpoint_interval,
+            'first_stage': job.first_stage, 'resumed': job.resumed}
+
+
+# ---------------------------------------------------------------------------------
+# Fit_Job of a dictionary made by job_spec
+#
+def job_from_spec(spec, map_cache=None):
+
+    from FitOpt.fitjob import Fit_Job
+
+    options = dict((str(k), v) for k, v in spec.items())
+    options['stages'] = [tuple(s) for s in options.get('stages', ())]
+    state = dict((name, options.pop(name)) for name in ('checkpoint_interval', 'first_stage', 'resumed')
+                 if name in options)
+    job = Fit_Job(map_cache=map_cache, **options)
+    job.__dict__.update(state)
+    return job
+
+
+# ---------------------------------------------------------------------------------
+# Job of the server, with the output read from its process
+#
+class Server_Job:
+
+    def __init__(self, id, queued):
+
+        self.id = id
+        self.queued = queued
+        self.lines = []
+        # Set by the worker after the last output line has been added
+        self.done = False
+
+
+# ---------------------------------------------------------------------------------
+# Server running the FitOpt jobs sent through a Unix socket
+#
+class Fit_Server:
+
+    # -------------------------------------------------
+    # path: Unix socket of the server
+    # workers: number of jobs run at the same time (by default, one per core)
+    # map_cache: Map_Cache of the maps used by the jobs
+    # cache: Result_Cache where the results are restored from and saved
+    # interval: seconds between reads of the output of the running processes
+    #
+    def __init__(self, path=None, workers=None, map_cache=None, cache=None, interval=0.1):
+
+        from FitOpt.jobqueue import available_cores
+
+        self.path = default_socket if path is None else path
+        self.workers = max(1, available_cores() if workers is None else workers)
+        self.maps = Map_Cache() if map_cache is None else map_cache
+        self.cache = cache
+        self.interval = interval
+        self.jobs = OrderedDict()
+        self.next_id = 1
+        self.lock = threading.Lock()
+        # Jobs waiting for a worker (None stops a worker)
+        self.pending = Queue()
+        # Processes of the running jobs (the partition groups of a job share
+        # the workers)
+        self.slots = 0
+        self.server = None
+        self.stopping = False
+
+    # ---------------------------------------------------------------------------
+    # Serves the requests until a shutdown request is received
+    #
+    def serve(self):
+
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder, 0o700)
+        if os.path.exists(self.path):
+            if server_running(self.path):
+                raise Server_Error('A FitOpt server is already running on %s' % self.path)
+            # Left by a server which was killed
+            os.remove(self.path)
+
+        self.maps.clear()
+        # Only the user can connect to the socket: the jobs sent run as the user
+        # of the server (no worker threads run yet, so the umask can be changed)
+        umask = os.umask(0o177)
+        try:
+            self.server = Socket_Server(self.path, Request_Handler)
+        finally:
+            os.umask(umask)
+        self.server.fit_server = self
+        threads = [threading.Thread(target=self.work) for i in range(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            self.server.serve_forever(0.5)
+        finally:
+            for t in threads:
+                self.pending.put(None)
+            self.server.server_close()
+            remove_file(self.path)
+            self.maps.clear()
+
+    # ---------------------------------------------------------------------------
+    # Worker thread: runs the pending jobs one after another
+    #
+    def work(self):
+
+        from FitOpt.jobqueue import FAILED
+
+        while True:
+            sj = self.pending.get()
+            if sj is None:
+                break
+            try:
+                self.run_job(sj)
+            except Exception as e:
+                sj.lines.append('FitOpt server error: %s\n' % e)
+                sj.queued.state = FAILED
+                sj.queued.returncode = 1
+            sj.done = True
+
+    # ---------------------------------------------------------------------------
+    # Stages and runs a job (its maps are prepared with the Map_Cache), adding
+    # the output of its process to the job lines. The partition groups of the
+    # job run in the workers not used by the other jobs.
+    #
+    def run_job(self, sj):
+
+        from FitOpt.jobqueue import FAILED, FINISHED
+
+        q = sj.queued
+        if q.done():
+            # Cancelled before it was started
+            return
+        with self.lock:
+            active = len([j for j in self.jobs.values() if not j.queued.done()])
+            slots = max(1, min(self.workers - self.slots, self.workers // max(1, active)))
+            self.slots += slots
+        try:
+            q.start(self.cache, slots)
+            if q.state == FINISHED:
+                sj.lines.append('FitOpt results restored from cache\n')
+            elif q.state == FAILED:
+                sj.lines.append('FitOpt could not be executed (see %s)\n' % os.path.join(q.cwd, q.log_name))
+            while not q.done():
+                q.update(self.cache)
+                sj.lines.extend(q.recent_lines)
+                if not q.recent_lines:
+                    time.sleep(self.interval)
+        finally:
+            with self.lock:
+                self.slots -= slots
+
+    # ---------------------------------------------------------------------------
+    # Answer to a request (a dictionary)
+    #
+    def handle(self, request):
+
+        op = request.get('op')
+        if op == 'submit':
+            return {'id': self.submit(request['job'], request.get('name'))}
+        if op == 'poll':
+            return self.poll(request['id'], request.get('start', 0))
+        if op == 'cancel':
+            with self.lock:
+                sj = self.jobs.get(request['id'])
+            if sj is not None:
+                sj.queued.cancel()
+            return {}
+        if op == 'status':
+            with self.lock:
+                jobs = [{'id': sj.id, 'status': sj.queued.status()} for sj in self.jobs.values()]
+            return {'jobs': jobs, 'workers': self.workers, 'maps': self.maps.stats()}
+        if op == 'forget':
+            with self.lock:
+                self.jobs.pop(request['id'], None)
+            return {}
+        if op == 'shutdown':
+            # Stopped once the answer is sent (see Request_Handler)
+            self.stopping = True
+            return {}
+        raise ValueError('Unknown request %s' % op)
+
+    # ---------------------------------------------------------------------------
+    # Adds a job (given by job_spec) to the pending ones. Returns its id.
+    #
+    def submit(self, spec, name=None):
+
+        from FitOpt.jobqueue import Queued_Job
+
+        job = job_from_spec(spec, self.maps)
+        with self.lock:
+            id = self.next_id
+            self.next_id += 1
+            sj = Server_Job(id, Queued_Job(name or 'job %d' % id, job))
+            self.jobs[id] = sj
+        self.pending.put(sj)
+        return id
+
+    # ---------------------------------------------------------------------------
+    # Output lines of a job from a given one, and its state
+    #
+    def poll(self, id, start=0):
+
+        with self.lock:
+            sj = self.jobs.get(id)
+        if sj is None:
+            raise ValueError('There is no job %s' % id)
+        done = sj.done
+        lines = sj.lines[start:]
+        q = sj.queued
+        return {'lines': lines, 'state': q.state, 'finished': done and start + len(lines) == len(sj.lines),
+                'returncode': q.returncode if done else None}
+
+
+# ---------------------------------------------------------------------------------
+# Socket server handling every connection in its own thread
+#
+class Socket_Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+# ---------------------------------------------------------------------------------
+# Connection of a client: one JSON request per line, answered with one line
+#
+class Request_Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+
+        server = self.server.fit_server
+        for line in iter(self.rfile.readline, b''):
+            try:
+                response = server.handle(json.loads(line.decode('utf-8')))
+                response['ok'] = True
+            except (ValueError, KeyError, TypeError, IOError, OSError) as e:
+                response = {'ok': False, 'error': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            if server.stopping:
+                # serve_forever can not be stopped from its own thread
+                threading.Thread(target=self.server.shutdown).start()
+                break
+
+
+# ---------------------------------------------------------------------------------
+# Connection to the server
+#
+class Server_Client:
+
+    # -------------------------------------------------
+    # path: Unix socket of the server
+    #
+    def __init__(self, path=None):
+
+        self.path = default_socket if path is None else path
+        self.socket = None
+        self.file = None
+
+    # ---------------------------------------------------------------------------
+    # Sends a request and returns the answer (a dictionary). Raises Server_Error
+    # if the server is not running or the request fails.
+    #
+    def request(self, op, **fields):
+
+        fields['op'] = op
+        try:
+            if self.socket is None:
+                self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.socket.connect(self.path)
+                self.file = self.socket.makefile('rb')
+            self.socket.sendall((json.dumps(fields) + '\n').encode('utf-8'))
+            line = self.file.readline()
+        except socket.error as e:
+            self.close()
+            raise Server_Error('FitOpt server on %s: %s' % (self.path, e))
+        if not line:
+            self.close()
+            raise Server_Error('The FitOpt server on %s closed the connection' % self.path)
+        response = json.loads(line.decode('utf-8'))
+        if not response.get('ok'):
+            raise Server_Error(response.get('error', 'FitOpt server request failed'))
+        return response
+
+    def close(self):
+
+        if self.file is not None:
+            self.file.close()
+        if self.socket is not None:
+            self.socket.close()
+        self.socket = self.file = None
+
+
+# ---------------------------------------------------------------------------------
+# True if a server answers on the socket
+#
+def server_running(path=None):
+
+    client = Server_Client(path)
+    try:
+        client.request('status')
+    except (IOError, OSError):
+        return False
+    finally:
+        client.close()
+    return True
+
+
+# ---------------------------------------------------------------------------------
+# Fit_Job run by the server, with the same interface as Fit_Process
+#
+class Remote_Process:
+
+    # -------------------------------------------------
+    # job: Fit_Job (its paths must be absolute)
+    # client: Server_Client (a new connection to the default server if None)
+    # name: name of the job shown by the server status
+    #
+    def __init__(self, job, client=None, name=None, interval=0.1):
+
+        self.job = job
+        self.client = Server_Client() if client is None else client
+        self.name = name
+        self.interval = interval
+        self.id = None
+        # Number of output lines received and lines not read yet
+        self.received = 0
+        self.pending = []
+        self.output_finished = False
+        self.code = None
+
+    # ---------------------------------------------------------------------------
+    # Sends the job to the server
+    #
+    def start(self):
+
+        self.id = self.client.request('submit', job=job_spec(self.job), name=self.name)['id']
+
+    # ---------------------------------------------------------------------------
+    # Output lines received since the last poll. If the server can not be
+    # reached (it was stopped or it has crashed), the job is finished with an
+    # error line and exit code 1, so the caller sees a failed fitting.
+    #
+    def receive(self):
+
+        if self.output_finished:
+            return []
+        try:
+            r = self.client.request('poll', id=self.id, start=self.received)
+        except Server_Error as e:
+            self.output_finished = True
+            self.code = 1
+            self.client.close()
+            return ['FitOpt server error: %s\n' % e]
+        self.received += len(r['lines'])
+        if r['finished']:
+            self.output_finished = True
+            self.code = r['returncode']
+            try:
+                self.client.request('forget', id=self.id)
+            except Server_Error:
+                # The output is already read
+                pass
+        return r['lines']
+
+    # ---------------------------------------------------------------------------
+    # Returns the lines produced by the process since the last call.
+    # At most max_lines are returned if it is given.
+    #
+    def new_lines(self, max_lines=None):
+
+        lines = self.pending + self.receive()
+        if max_lines is not None:
+            lines, self.pending = lines[:max_lines], lines[max_lines:]
+        else:
+            self.pending = []
+        return lines
+
+    # ---------------------------------------------------------------------------
+    # Returns True when the job has finished and all its output was read
+    #
+    def finished(self):
+
+        return self.output_finished and not self.pending
+
+    # ---------------------------------------------------------------------------
+    # Asks the server to stop the job
+    #
+    def cancel(self):
+
+        if self.id is not None and not self.output_finished:
+            try:
+                self.client.request('cancel', id=self.id)
+            except Server_Error:
+                # The server is gone: the next poll finishes the job
+                pass
+
+    # ---------------------------------------------------------------------------
+    # Exit code of the job (None while it is running)
+    #
+    def returncode(self):
+
+        return self.code
+
+    # ---------------------------------------------------------------------------
+    # Blocks until the job is finished and returns its exit code. The output
+    # is kept to be read with new_lines.
+    #
+    def wait(self):
+
+        while not self.output_finished:
+            lines = self.receive()
+            self.pending.extend(lines)
+            if not lines:
+                time.sleep(self.interval)
+        return self.code
+
+
+# ---------------------------------------------------------------------------------
+# Sends a job to the server and returns the started Remote_Process
+#
+def start_remote(job, path=None, name=None):
+
+    process = Remote_Process(job, Server_Client(path), name)
+    process.start()
+    return process
+
+
+# ---------------------------------------------------------------------------------
+# Command line arguments parser
+#
+def argument_parser():
+
+    import argparse
+    p = argparse.ArgumentParser(prog='python -m FitOpt.server',
+                                description='Local FitOpt server keeping the maps in memory.')
+    p.add_argument('--socket', default=None, help='Unix socket of the server (default %s)' % default_socket)
+    sub = p.add_subparsers(dest='command', metavar='command')
+    s = sub.add_parser('start', help='run the server until it is stopped')
+    s.add_argument('--workers', type=int, default=None, help='jobs run at the same time (default one per core)')
+    s.add_argument('--memory', type=float, default=None, metavar='GB',
+                   help='memory budget of the maps (default %g)' % (Map_Cache.default_max_bytes / 1024.0 ** 3))
+    s.add_argument('--folder', default=None, help='folder of the prepared maps (default %s)'
+                   % Map_Cache.default_folder)
+    s.add_argument('--cache', default=None, metavar='FOLDER',
+                   help='restore/save the results in this result cache')
+    s.add_argument('--cache-size', type=float, default=None, metavar='GB', help='size limit of the result cache')
+    sub.add_parser('status', help='show the jobs and the maps in memory')
+    sub.add_parser('stop', help='stop the server')
+    return p
+
+
+# ---------------------------------------------------------------------------------
+# Console entry point
+#
+def main(argv=None):
+
+    p = argument_parser()
+    args = p.parse_args(argv)
+    out = sys.stdout
+
+    if args.command == 'start':
+        cache = None
+        if args.cache is not None:
+            from FitOpt.resultcache import Result_Cache
+            max_bytes = None if args.cache_size is None else int(args.cache_size * 1024 ** 3)
+            cache = Result_Cache(args.cache, max_bytes)
+        maps = Map_Cache(args.folder, None if args.memory is None else int(args.memory * 1024 ** 3))
+        server = Fit_Server(args.socket, args.workers, maps, cache)
+        out.write('FitOpt server on %s (%d workers)\n' % (server.path, server.workers))
+        out.flush()
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.command not in ('status', 'stop'):
+        p.print_usage(sys.stderr)
+        return 2
+    client = Server_Client(args.socket)
+    try:
+        if args.command == 'stop':
+            client.request('shutdown')
+            return 0
+        r = client.request('status')
+    except Server_Error as e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+    finally:
+        client.close()
+    m = r['maps']
+    out.write('%d workers, %d maps in memory (%.1f of %.1f MB), %d hits, %d misses\n'
+              % (r['workers'], m['entries'], m['bytes'] / 1024.0 ** 2, m['max_bytes'] / 1024.0 ** 2,
+                 m['hits'], m['misses']))
+    for j in r['jobs']:
+        out.write('%4d  %s\n' % (j['id'], j['status']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,283 @@
+# ---------------------------------------------------------------------------------
+# Spatial index of atom coordinates (cell list).
+#
+# Space is divided in cubic cells and the atoms are kept sorted by the key of
+# their cell, so the atoms of a column of cells along z are contiguous and are
+# found by binary search. Cut-off queries only compare the atoms of the
+# neighbor cells, so they take near-linear time, and they are vectorized over
+# all the atoms at once (in chunks of bounded size). Moving atoms only re-sorts
+# the ones which change of cell, so the index can be refreshed every fitting
+# iteration.
+#
+#   index = Cell_Index(xyz, 0.5 * cutoff)
+#   pairs = index.pairs(cutoff)
+#   near, distance = index.nearest(other_xyz, cutoff)
+#   index.update(moved, new_xyz)
+#
+
+import numpy
+
+# Cell keys: cell coordinates (shifted to be positive) packed in 21 bits each
+key_bits = 21
+key_shift = 1 << (key_bits - 1)
+
+# Maximum number of candidate pairs compared at once
+max_candidates = 1 << 22
+
+
+# ---------------------------------------------------------------------------------
+# Cell list of a set of points
+#
+class Cell_Index:
+
+    # -------------------------------------------------
+    # xyz: (points, 3) coordinates
+    # cell_size: edge of the cells. Queries compare the points of the cells
+    #            within the cut-off distance, so cells of about half of it
+    #            give less candidate pairs.
+    #
+    def __init__(self, xyz, cell_size):
+
+        self.xyz = numpy.array(xyz, numpy.float64).reshape((-1, 3))
+        self.cell_size = float(cell_size)
+        keys = self.cell_keys(self.xyz)
+        self.order = numpy.argsort(keys, kind='mergesort')
+        self.sorted_keys = keys[self.order]
+        # Coordinates in the sorted order, so the points compared are close in
+        # memory, one array per axis (faster to gather than rows of 3)
+        self.sorted_xyz = sorted_axes(self.xyz, self.order)
+
+    def __len__(self):
+
+        return len(self.xyz)
+
+    # ---------------------------------------------------------------------------
+    # Cell coordinates and keys of points
+    #
+    def cells(self, xyz):
+
+        return numpy.floor(numpy.asarray(xyz, numpy.float64) / self.cell_size).astype(numpy.int64)
+
+    def cell_keys(self, xyz):
+
+        return pack_keys(self.cells(xyz))
+
+    # ---------------------------------------------------------------------------
+    # Moves some points. Only the points which change of cell are removed from
+    # the sorted order and inserted again at their new place.
+    # indices: indices of the points, xyz: their new coordinates
+    #
+    def update(self, indices, xyz):
+
+        indices = numpy.asarray(indices, numpy.int64)
+        xyz = numpy.asarray(xyz, numpy.float64).reshape((-1, 3))
+        old = self.cell_keys(self.xyz[indices])
+        new = self.cell_keys(xyz)
+        self.xyz[indices] = xyz
+
+        moved = old != new
+        if moved.any():
+            mi, mkeys = indices[moved], new[moved]
+            # Positions of the moved points in the sorted order
+            rank = numpy.empty(len(self.order), numpy.int64)
+            rank[self.order] = numpy.arange(len(self.order))
+            keep = numpy.ones(len(self.order), bool)
+            keep[rank[mi]] = False
+            order, keys = self.order[keep], self.sorted_keys[keep]
+
+            s = numpy.argsort(mkeys, kind='mergesort')
+            mi, mkeys = mi[s], mkeys[s]
+            at = numpy.searchsorted(keys, mkeys, side='right')
+            self.order = numpy.insert(order, at, mi)
+            self.sorted_keys = numpy.insert(keys, at, mkeys)
+            self.sorted_xyz = sorted_axes(self.xyz, self.order)
+        else:
+            rank = numpy.empty(len(self.order), numpy.int64)
+            rank[self.order] = numpy.arange(len(self.order))
+            self.sorted_xyz[:, rank[indices]] = xyz.T
+
+    # ---------------------------------------------------------------------------
+    # Replaces all the coordinates (same number of points)
+    #
+    def set_coordinates(self, xyz):
+
+        self.update(numpy.arange(len(self.xyz)), xyz)
+
+    # ---------------------------------------------------------------------------
+    # Pairs of indexed points (i < j) closer than cutoff, as a (pairs, 2) array
+    #
+    def pairs(self, cutoff):
+
+        parts = []
+        for qi, ai in self.candidates(self.sorted_keys, cutoff, half=True):
+            close = squared_distances(self.sorted_xyz, qi, self.sorted_xyz, ai) <= cutoff * cutoff
+            i, j = self.order[qi[close]], self.order[ai[close]]
+            parts.append(numpy.column_stack((numpy.minimum(i, j), numpy.maximum(i, j))))
+        if not parts:
+            return numpy.zeros((0, 2), numpy.int64)
+        return numpy.concatenate(parts)
+
+    # ---------------------------------------------------------------------------
+    # Pairs (query point, indexed point) closer than cutoff, as a (pairs, 2) array
+    #
+    def neighbors(self, points, cutoff):
+
+        parts = []
+        for qi, ai, d2 in self.query_candidates(points, cutoff):
+            close = d2 <= cutoff * cutoff
+            parts.append(numpy.column_stack((qi[close], ai[close])))
+        if not parts:
+            return numpy.zeros((0, 2), numpy.int64)
+        return numpy.concatenate(parts)
+
+    # ---------------------------------------------------------------------------
+    # True if any query point is closer than cutoff to an indexed point
+    #
+    def any_within(self, points, cutoff):
+
+        for qi, ai, d2 in self.query_candidates(points, cutoff):
+            if (d2 <= cutoff * cutoff).any():
+                return True
+        return False
+
+    # ---------------------------------------------------------------------------
+    # Nearest indexed point of every query point, searched up to max_distance.
+    # Returns their indices (-1 if there is none) and distances (inf if none).
+    #
+    def nearest(self, points, max_distance):
+
+        points = numpy.asarray(points, numpy.float64).reshape((-1, 3))
+        best = numpy.full(len(points), numpy.inf)
+        index = numpy.full(len(points), -1, numpy.int64)
+        for qi, ai, d2 in self.query_candidates(points, max_distance):
+            # Closest candidate of every query point in the chunk
+            s = numpy.lexsort((d2, qi))
+            qi, ai, d2 = qi[s], ai[s], d2[s]
+            first = numpy.concatenate(([True], qi[1:] != qi[:-1]))
+            qi, ai, d2 = qi[first], ai[first], d2[first]
+            better = d2 < best[qi]
+            best[qi[better]] = d2[better]
+            index[qi[better]] = ai[better]
+        dist = numpy.sqrt(best)
+        far = dist > max_distance
+        index[far] = -1
+        dist[far] = numpy.inf
+        return index, dist
+
+    # ---------------------------------------------------------------------------
+    # Candidate pairs (query point, indexed point, squared distance) of points
+    # which are not indexed, in chunks
+    #
+    def query_candidates(self, points, cutoff):
+
+        points = numpy.asarray(points, numpy.float64).reshape((-1, 3))
+        if len(points) == 0 or len(self.xyz) == 0:
+            return
+        keys = self.cell_keys(points)
+        qorder = numpy.argsort(keys, kind='mergesort')
+        qxyz = sorted_axes(points, qorder)
+        for qi, ai in self.candidates(keys[qorder], cutoff):
+            yield qorder[qi], self.order[ai], squared_distances(qxyz, qi, self.sorted_xyz, ai)
+
+    # ---------------------------------------------------------------------------
+    # Candidate pairs between query points (given by their sorted cell keys)
+    # and the indexed points of the cells around them, as positions in the
+    # sorted orders, in chunks of at most max_candidates pairs.
+    # The cells along z have consecutive keys, so the points of the cells of a
+    # z column are a range of the sorted points, found by binary search.
+    # With half, the query points are the indexed ones and every pair of points
+    # is given once.
+    #
+    def candidates(self, qkeys, cutoff, half=False):
+
+        reach = int(numpy.ceil(cutoff / self.cell_size))
+        r = numpy.arange(-reach, reach + 1)
+        columns = [(dx, dy) for dx in r for dy in r]
+        if half:
+            # Half of the neighbor columns, plus the own column (pairs i < j)
+            columns = [c for c in columns if c >= (0, 0)]
+
+        keys = self.sorted_keys
+        for dx, dy in columns:
+            ckeys = qkeys + pack_offsets(((dx, dy, 0),))[0]
+            lo = numpy.searchsorted(keys, ckeys - reach, side='left')
+            hi = numpy.searchsorted(keys, ckeys + reach, side='right')
+            own = half and dx == 0 and dy == 0
+            if own:
+                lo = numpy.maximum(lo, numpy.arange(len(qkeys)) + 1)
+            sizes = numpy.maximum(hi - lo, 0)
+            for chunk in chunks(sizes, max_candidates):
+                n = sizes[chunk]
+                q = numpy.arange(chunk.start, chunk.stop)
+                yield numpy.repeat(q, n), range_indices(lo[chunk], n)
+
+
+# ---------------------------------------------------------------------------------
+# Packs (n, 3) cell coordinates in int64 keys
+#
+def pack_keys(cells):
+
+    c = cells + key_shift
+    return (c[:, 0] << (2 * key_bits)) | (c[:, 1] << key_bits) | c[:, 2]
+
+
+# ---------------------------------------------------------------------------------
+# Packed key difference of (n, 3) cell offsets (key of cell + offset is the
+# key of the cell plus this value)
+#
+def pack_offsets(offsets):
+
+    o = numpy.asarray(offsets, numpy.int64)
+    return (o[:, 0] << (2 * key_bits)) + (o[:, 1] << key_bits) + o[:, 2]
+
+
+# ---------------------------------------------------------------------------------
+# Coordinates of points in a given order as a (3, points) array
+#
+def sorted_axes(xyz, order):
+
+    return numpy.ascontiguousarray(xyz[order].T)
+
+
+# ---------------------------------------------------------------------------------
+# Squared distances between the points i of a (3, n) array of coordinates and
+# the points j of another one
+#
+def squared_distances(axes1, i, axes2, j):
+
+    d2 = numpy.zeros(len(i))
+    for a in range(3):
+        d = axes2[a][j]
+        d -= axes1[a][i]
+        d *= d
+        d2 += d
+    return d2
+
+
+# ---------------------------------------------------------------------------------
+# Concatenated index ranges start[k] ... start[k] + count[k] - 1
+#
+def range_indices(start, count):
+
+    total = int(count.sum())
+    return numpy.arange(total) + numpy.repeat(start - (numpy.cumsum(count) - count), count)
+
+
+# ---------------------------------------------------------------------------------
+# Splits a sequence of sizes in consecutive chunks of total size up to
+# max_size (a single item may exceed it). Returns slices.
+#
+def chunks(sizes, max_size):
+
+    if len(sizes) == 0:
+        return []
+    ends = numpy.cumsum(sizes)
+    result = []
+    start = 0
+    while start < len(sizes):
+        base = ends[start - 1] if start > 0 else 0
+        end = int(numpy.searchsorted(ends, base + max_size, side='right'))
+        end = max(end, start + 1)
+        result.append(slice(start, end))
+        start = end
+    return result
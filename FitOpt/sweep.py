@@ -0,0 +1,408 @@
+# ---------------------------------------------------------------------------------
+# Parameter sweeps with early elimination of the poor configurations.
+#
+# A sweep runs a job with several configurations of the FitOpt options (modes,
+# fixed degrees of freedom, rediagonalization and model), taken from a grid of
+# values or as a random sample of it. The configurations are run in parallel
+# through a Job_Queue, every one in its own workspace, and the scores written
+# by fitopt are followed as they are produced.
+#
+# Poor configurations are stopped early, as in asynchronous successive halving:
+# the rungs are at min_iterations, min_iterations * eta, min_iterations * eta^2 ...
+# iterations, and a configuration reaching a rung is cancelled unless its score
+# is in the best 1 / eta of the scores of the configurations which reached that
+# rung before it. So only about 1 / eta of the configurations pass every rung
+# and the sweep costs a few full fittings.
+#
+#   python -m FitOpt.sweep --modes 0.02,0.05,0.1 --fixings 0,0.5,0.75,0.9 \
+#       --rediags 0,0.1,0.5,0.9 -- --map map.mrc --resolution 10 --cutoff 0.02 \
+#       --workdir sweep fitted.pdb
+#
+
+import copy
+import itertools
+import json
+import os
+import sys
+
+from FitOpt.jobqueue import FINISHED, Job_Queue
+
+# Fit_Job options which are swept, and their names in the fitopt command line
+parameters = ('modes', 'fixing', 'rediag', 'model')
+parameter_flags = {'modes': '-n', 'fixing': '-r', 'rediag': '--rediag', 'model': '-m'}
+
+# Successive halving: fraction of configurations kept at every rung is 1 / eta
+default_eta = 3
+default_min_iterations = 10
+
+# Folder (inside the sweep workspace) of every configuration
+config_folder = 'config%d'
+# File with the results of the sweep (in the sweep workspace)
+results_name = 'fitopt_sweep.json'
+
+
+# ---------------------------------------------------------------------------------
+# All the configurations of a grid of values.
+# values: dictionary parameter -> list of values (the parameters missing keep
+# the value of the job). Returns a list of dictionaries parameter -> value.
+#
+def parameter_grid(values):
+
+    names = [p for p in parameters if p in values]
+    return [dict(zip(names, combination)) for combination in itertools.product(*[values[p] for p in names])]
+
+
+# ---------------------------------------------------------------------------------
+# Random sample of count configurations of a grid of values (all of them if
+# the grid is smaller)
+#
+def sample_configurations(values, count, seed=None):
+
+    import random
+    grid = parameter_grid(values)
+    if count >= len(grid):
+        return grid
+    return random.Random(seed).sample(grid, count)
+
+
+# ---------------------------------------------------------------------------------
+# Text of the options of a configuration, as fitopt arguments
+#
+def options_text(options):
+
+    return ' '.join('%s %s' % (parameter_flags[p], options[p]) for p in parameters if p in options)
+
+
+# ---------------------------------------------------------------------------------
+# Configuration of a sweep and the scores of its fitting
+#
+class Sweep_Config:
+
+    # -------------------------------------------------
+    # name: name of the configuration (its folder)
+    # options: values of the swept parameters
+    # queued: jobqueue.Queued_Job running its fitting
+    #
+    def __init__(self, name, options, queued):
+
+        from FitOpt.progress import Progress_Parser
+
+        self.name = name
+        self.options = options
+        self.queued = queued
+        self.parser = Progress_Parser()
+        # Score of every iteration (None where fitopt gives no score)
+        self.scores = []
+        # Next rung to reach
+        self.rung = 0
+        # Rung where it was stopped (None if it was not stopped)
+        self.stopped_at = None
+
+    # ---------------------------------------------------------------------------
+    # Records the iterations of some output lines
+    #
+    def feed(self, lines):
+
+        from FitOpt.progress import ITERATION
+        for line in lines:
+            e = self.parser.feed(line)
+            if e is not None and e.kind == ITERATION:
+                self.scores.append(e.score)
+
+    # ---------------------------------------------------------------------------
+    # Records the iterations of the log of a fitting whose output was not read
+    # (its results were restored from the result cache)
+    #
+    def feed_log(self):
+
+        path = os.path.join(self.queued.cwd, self.queued.log_name)
+        if os.path.exists(path):
+            f = open(path)
+            self.feed(f)
+            f.close()
+
+    # ---------------------------------------------------------------------------
+    # Last score (None if there is none)
+    #
+    def score(self):
+
+        scores = [s for s in self.scores if s is not None]
+        return scores[-1] if scores else None
+
+    # ---------------------------------------------------------------------------
+    # Dictionary with the results of the configuration
+    #
+    def result(self):
+
+        return {'name': self.name, 'options': self.options, 'state': self.queued.state,
+                'iterations': len(self.scores), 'score': self.score(), 'stopped_at': self.stopped_at,
+                'cwd': self.queued.cwd}
+
+
+# ---------------------------------------------------------------------------------
+# Sweep of the configurations of a job
+#
+class Parameter_Sweep:
+
+    # -------------------------------------------------
+    # job: Fit_Job with the options which are not swept. The configurations
+    #      are run in subfolders of its workspace.
+    # configurations: list of dictionaries parameter -> value
+    # max_running: maximum number of configurations running at the same time
+    #              (by default, the number of available cores)
+    # eta, min_iterations: rungs of the successive halving
+    # cache: Result_Cache where the results are restored from and saved
+    # report: function called with a line of text when a configuration is
+    #         stopped or finished (None to report nothing)
+    #
+    def __init__(self, job, configurations, max_running=None, eta=default_eta,
+                 min_iterations=default_min_iterations, cache=None, report=None):
+
+        self.job = job
+        self.eta = max(2, int(eta))
+        self.min_iterations = max(1, int(min_iterations))
+        self.report = report
+        self.queue = Job_Queue(max_running, cache)
+        self.configs = []
+        for i, options in enumerate(configurations):
+            j = copy.copy(job)
+            for p, v in options.items():
+                setattr(j, p, str(v))
+            j.cwd = os.path.join(job.cwd, config_folder % (i + 1))
+            # Stopped configurations are not resumed
+            j.checkpoint_interval = None
+            name = config_folder % (i + 1)
+            self.configs.append(Sweep_Config(name, dict((p, str(v)) for p, v in options.items()),
+                                             self.queue.submit(name, j)))
+        # Scores of the configurations which reached every rung
+        self.rung_scores = []
+
+    # ---------------------------------------------------------------------------
+    # Number of iterations of a rung
+    #
+    def rung_iterations(self, rung):
+
+        return self.min_iterations * self.eta ** rung
+
+    # ---------------------------------------------------------------------------
+    # Reads the output of the running configurations, stops the ones falling
+    # behind and launches the queued ones. Returns the configurations whose
+    # state has changed.
+    #
+    def update(self):
+
+        changed = set(self.queue.update())
+        for c in self.configs:
+            c.feed(c.queued.recent_lines)
+            if c.queued in changed and c.queued.state == FINISHED and not c.scores:
+                c.feed_log()
+            while c.stopped_at is None and len(c.scores) >= self.rung_iterations(c.rung):
+                self.judge(c)
+        changed = [c for c in self.configs if c.queued in changed]
+        if self.report is not None:
+            for c in changed:
+                if c.queued.done() and c.stopped_at is None:
+                    self.report('%s %s: %s, %d iterations, score %s\n'
+                                % (c.name, options_text(c.options), c.queued.state, len(c.scores),
+                                   score_text(c.score())))
+        return changed
+
+    # ---------------------------------------------------------------------------
+    # Compares the score of a configuration at its next rung with the ones of
+    # the configurations which reached it before: it is stopped unless it is in
+    # the best 1 / eta of them (the first eta - 1 ones always continue).
+    # Configurations which have already finished are only recorded.
+    #
+    def judge(self, c):
+
+        rung = c.rung
+        c.rung += 1
+        score = c.scores[self.rung_iterations(rung) - 1]
+        if score is None:
+            return
+        while len(self.rung_scores) <= rung:
+            self.rung_scores.append([])
+        scores = self.rung_scores[rung]
+        scores.append(score)
+        if len(scores) < self.eta:
+            return
+        keep = -(-len(scores) // self.eta)
+        threshold = sorted(scores, reverse=True)[keep - 1]
+        if score >= threshold or c.queued.done():
+            return
+
+        c.stopped_at = rung
+        c.queued.cancel()
+        if self.report is not None:
+            self.report('%s %s: stopped at %d iterations, score %s < %s\n'
+                        % (c.name, options_text(c.options), len(c.scores), score_text(score),
+                           score_text(threshold)))
+
+    # ---------------------------------------------------------------------------
+    # Returns True when all the configurations are finished or stopped
+    #
+    def done(self):
+
+        return self.queue.done()
+
+    # ---------------------------------------------------------------------------
+    # Blocks until the sweep is finished
+    #
+    def wait(self, interval=0.5):
+
+        import time
+        self.update()
+        while not self.done():
+            time.sleep(interval)
+            self.update()
+
+    # ---------------------------------------------------------------------------
+    # Results of the configurations, the finished ones first from the best to
+    # the worst final score, then the stopped and failed ones
+    #
+    def results(self):
+
+        def order(c):
+            finished = c.queued.state == FINISHED and c.score() is not None
+            return (0, -c.score()) if finished else (1, -len(c.scores))
+        return [c.result() for c in sorted(self.configs, key=order)]
+
+    # ---------------------------------------------------------------------------
+    # Best finished configuration (None if no configuration has finished)
+    #
+    def best(self):
+
+        results = self.results()
+        if results and results[0]['state'] == FINISHED and results[0]['score'] is not None:
+            return results[0]
+        return None
+
+    # ---------------------------------------------------------------------------
+    # Writes the results in the sweep workspace. Returns the path.
+    #
+    def save(self):
+
+        path = os.path.join(self.job.cwd, results_name)
+        f = open(path, 'w')
+        json.dump({'eta': self.eta, 'min_iterations': self.min_iterations, 'configurations': self.results()},
+                  f, indent=1)
+        f.close()
+        return path
+
+
+def score_text(score):
+
+    return '-' if score is None else '%.5g' % score
+
+
+# ---------------------------------------------------------------------------------
+# Values of a parameter given in the command line as a comma separated list
+#
+def value_list(text):
+
+    return [v for v in text.replace(' ', ',').split(',') if v]
+
+
+# ---------------------------------------------------------------------------------
+# Command line arguments parser of the sweep options (the job is given with
+# the arguments of FitOpt.fitjob)
+#
+def argument_parser():
+
+    import argparse
+    p = argparse.ArgumentParser(prog='python -m FitOpt.sweep',
+                                usage='%(prog)s [sweep options] -- fitjob arguments',
+                                description='Sweep of FitOpt options with early elimination of the poor '
+                                            'configurations. The job is given with the arguments of '
+                                            'python -m FitOpt.fitjob (its -n, -r, --rediag and -m are the '
+                                            'values of the parameters which are not swept).')
+    p.add_argument('--modes', type=value_list, default=None, metavar='LIST',
+                   help='fractions or numbers of modes, e.g. 0.02,0.05,0.1')
+    p.add_argument('--fixings', type=value_list, default=None, metavar='LIST',
+                   help='fractions of fixed degrees of freedom, e.g. 0,0.5,0.75,0.9')
+    p.add_argument('--rediags', type=value_list, default=None, metavar='LIST',
+                   help='rediagonalization thresholds, e.g. 0,0.1,0.5,0.9')
+    p.add_argument('--models', type=value_list, default=None, metavar='LIST',
+                   help='coarse-grained models (0 CA, 1 3BB2R, 2 full atom), e.g. 0,2')
+    p.add_argument('--samples', type=int, default=0, metavar='N',
+                   help='run a random sample of N configurations (default all the grid)')
+    p.add_argument('--seed', type=int, default=None, help='seed of the random sample')
+    p.add_argument('--parallel', type=int, default=None, metavar='N',
+                   help='configurations run at the same time (default one per core)')
+    p.add_argument('--eta', type=int, default=default_eta,
+                   help='1 / fraction of configurations kept at every rung (default %d)' % default_eta)
+    p.add_argument('--min-iterations', type=int, default=default_min_iterations, metavar='N',
+                   help='iterations of the first rung (default %d)' % default_min_iterations)
+    p.add_argument('--dry-run', action='store_true', help='only print the configurations')
+    return p
+
+
+# ---------------------------------------------------------------------------------
+# Console entry point
+#
+def main(argv=None):
+
+    from FitOpt import fitjob
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if '--' in argv:
+        k = argv.index('--')
+        argv, job_argv = argv[:k], argv[k + 1:]
+    else:
+        job_argv = []
+    args = argument_parser().parse_args(argv)
+    job_args = fitjob.argument_parser().parse_args(job_argv)
+    job = fitjob.job_from_arguments(job_args)
+
+    values = {}
+    for p, given in (('modes', args.modes), ('fixing', args.fixings), ('rediag', args.rediags),
+                     ('model', args.models)):
+        if given:
+            values[p] = given
+    if args.samples > 0:
+        configurations = sample_configurations(values, args.samples, args.seed)
+    else:
+        configurations = parameter_grid(values)
+
+    out = sys.stdout
+    if args.dry_run:
+        for i, options in enumerate(configurations):
+            out.write('%s %s\n' % (config_folder % (i + 1), options_text(options)))
+        return 0
+
+    cache = None
+    if job_args.cache is not None:
+        from FitOpt.resultcache import Result_Cache
+        max_bytes = None if job_args.cache_size is None else int(job_args.cache_size * 1024 ** 3)
+        cache = Result_Cache(job_args.cache, max_bytes)
+
+    def report(text):
+        out.write(text)
+        out.flush()
+
+    out.write('Sweep of %d configurations in %s\n' % (len(configurations), job.cwd))
+    sweep = Parameter_Sweep(job, configurations, args.parallel, args.eta, args.min_iterations, cache, report)
+    try:
+        sweep.wait()
+    except KeyboardInterrupt:
+        sweep.queue.cancel()
+        sweep.wait()
+    path = sweep.save()
+
+    out.write('\n%-10s %-40s %-10s %10s %10s\n' % ('', 'options', 'state', 'iterations', 'score'))
+    for r in sweep.results():
+        state = 'stopped' if r['stopped_at'] is not None else r['state']
+        out.write('%-10s %-40s %-10s %10d %10s\n' % (r['name'], options_text(r['options']), state,
+                                                    r['iterations'], score_text(r['score'])))
+    best = sweep.best()
+    if best is None:
+        out.write('\nNo configuration has finished. Results saved in %s\n' % path)
+        return 1
+    out.write('\nBest configuration: %s (%s), results in %s\nResults saved in %s\n'
+              % (options_text(best['options']), best['name'], best['cwd'], path))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,11 @@
+# Tests of the FitOpt modules which do not need Chimera nor the fitopt binary.
+# They use the bundled structure adpEM0001.pdb:
+#
+#   python -m pytest FitOpt/test
+#   python -m unittest discover -s FitOpt/test -t .
+#
+
+import os
+
+# Bundled test structure
+test_pdb = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'adpEM0001.pdb')
@@ -0,0 +1,137 @@
+# ---------------------------------------------------------------------------------
+# Tests of FitOpt.checkpoint: writing the checkpoint of a running job from its
+# movie, and resuming only the same job from it
+#
+
+import copy
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from FitOpt.checkpoint import Checkpoint_Writer, checkpoint_path, load_checkpoint, resume_job
+from FitOpt.fitjob import Fit_Job
+from FitOpt.pdbio import format_pdb, read_pdb
+from FitOpt.test import test_pdb
+
+
+class Checkpoint_Test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.folder = tempfile.mkdtemp()
+        self.map_path = os.path.join(self.folder, 'map.mrc')
+        f = open(self.map_path, 'wb')
+        f.write(b'map')
+        f.close()
+        self.job = Fit_Job([test_pdb], [], self.map_path, 10, 0.02, cwd=os.path.join(self.folder, 'job'),
+                           stages=[('20', '0')])
+        os.makedirs(self.job.cwd)
+        self.atoms = read_pdb(test_pdb)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.folder)
+
+    # ---------------------------------------------------------------------------
+    # Writes a movie of the job (final stage) whose frames move the atoms
+    # along x, and the output lines of its iterations
+    #
+    def write_movie(self, frames):
+
+        f = open(self.job.movie_path(), 'wb')
+        for k in range(frames):
+            atoms = self.atoms.copy()
+            atoms['xyz'][:, 0] += k + 1
+            f.write(('MODEL     %4d\n' % (k + 1)).encode('ascii') + format_pdb(atoms) + b'ENDMDL\n')
+        f.close()
+        return (['  Iter   NMA_time     Score\n', '  Model 1 time 0.1 sec\n'] +
+                ['%6d %10.3f %9.5f\n' % (k + 1, 0.01, 0.5 + 0.01 * k) for k in range(frames)])
+
+    def checkpoint(self, job, frames, stage=1):
+
+        writer = Checkpoint_Writer(job, 0)
+        writer.set_stage(stage, job)
+        writer.feed(self.write_movie(frames))
+        writer.update(force=True)
+        return writer
+
+    # ---------------------------------------------------------------------------
+    # The checkpoint has the newest frame of the movie and the iterations
+    #
+    def test_write(self):
+
+        self.checkpoint(self.job, 3)
+        c = load_checkpoint(self.job.cwd, self.job)
+        self.assertIsNotNone(c)
+        self.assertEqual((c['stage'], c['iterations']), (1, 3))
+        self.assertEqual([s[3] for s in c['scores']], [0.5, 0.51, 0.52])
+        xyz = read_pdb(c['coordinates'][0])['xyz']
+        numpy.testing.assert_allclose(xyz[:, 0], self.atoms['xyz'][:, 0] + 3, atol=1e-3)
+
+    # ---------------------------------------------------------------------------
+    # The resumed job starts from the checkpoint coordinates, skips the stages
+    # done and keeps the iterations. Its own checkpoints are of the same job.
+    #
+    def test_resume(self):
+
+        self.checkpoint(self.job, 2)
+        r = resume_job(self.job)
+        self.assertIsNotNone(r)
+        self.assertEqual(r.fitted, load_checkpoint(self.job.cwd)['coordinates'])
+        self.assertEqual((r.stages, r.first_stage), ([], 1))
+        self.assertEqual(self.job.fitted, [test_pdb])
+
+        writer = self.checkpoint(r, 4, stage=1)
+        self.assertEqual(writer.iterations, 6)
+        c = load_checkpoint(self.job.cwd, self.job)
+        self.assertIsNotNone(c)
+        self.assertEqual(c['iterations'], 6)
+
+    # ---------------------------------------------------------------------------
+    # Jobs with other options, models or map do not resume the checkpoint
+    #
+    def test_other_jobs(self):
+
+        self.checkpoint(self.job, 2)
+        other = [copy.copy(self.job) for k in range(4)]
+        other[0].modes = '0.1'
+        other[1].stages = [('15', '0')]
+        other[2].fitted = [self.job.movie_path()]
+        other[3].map_path = os.path.join(self.folder, 'missing.mrc')
+        for job in other:
+            self.assertIsNone(resume_job(job))
+        self.assertIsNotNone(resume_job(self.job))
+
+        # The map has changed
+        f = open(self.map_path, 'ab')
+        f.write(b' changed')
+        f.close()
+        self.assertIsNone(resume_job(self.job))
+
+    # ---------------------------------------------------------------------------
+    # Checkpoints without the identity of their job (older format) or with
+    # missing coordinates are ignored
+    #
+    def test_invalid(self):
+
+        self.assertIsNone(resume_job(self.job))
+        self.checkpoint(self.job, 2)
+        path = checkpoint_path(self.job.cwd)
+        f = open(path)
+        c = json.load(f)
+        f.close()
+        for change in ({'format': 1}, {'coordinates': [os.path.join(self.folder, 'missing.pdb')]}):
+            d = dict(c)
+            d.update(change)
+            f = open(path, 'w')
+            json.dump(d, f)
+            f.close()
+            self.assertIsNone(resume_job(self.job))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# ---------------------------------------------------------------------------------
+# Tests of FitOpt.pdbio: reading the test structure and writing it back
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from FitOpt.pdbio import atom_dtype, format_pdb, parse_pdb, read_pdb, write_pdb
+from FitOpt.test import test_pdb
+
+
+class Pdbio_Test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.atoms = read_pdb(test_pdb)
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.folder)
+
+    # ---------------------------------------------------------------------------
+    # The atoms read are the ATOM/HETATM records of the file
+    #
+    def test_read(self):
+
+        f = open(test_pdb, 'rb')
+        records = [line for line in f if line.startswith((b'ATOM', b'HETATM'))]
+        f.close()
+        self.assertEqual(self.atoms.dtype, atom_dtype)
+        self.assertEqual(len(self.atoms), len(records))
+        first = records[0]
+        self.assertEqual(self.atoms['name'][0], first[12:16])
+        self.assertEqual(self.atoms['resseq'][0], int(first[22:26]))
+        numpy.testing.assert_allclose(self.atoms['xyz'][0], [float(first[30:38]), float(first[38:46]),
+                                                             float(first[46:54])])
+
+    # ---------------------------------------------------------------------------
+    # Writing and reading again gives the same atoms
+    #
+    def test_round_trip(self):
+
+        path = os.path.join(self.folder, 'copy.pdb')
+        write_pdb(path, self.atoms)
+        again = read_pdb(path)
+        self.assertEqual(len(again), len(self.atoms))
+        for field in atom_dtype.names:
+            if field == 'xyz':
+                numpy.testing.assert_allclose(again['xyz'], self.atoms['xyz'], atol=5e-4)
+            elif field in ('occupancy', 'bfactor'):
+                numpy.testing.assert_allclose(again[field], self.atoms[field], atol=5e-3)
+            else:
+                self.assertTrue((again[field] == self.atoms[field]).all(), field)
+
+    # ---------------------------------------------------------------------------
+    # Moved coordinates are written with 3 decimals
+    #
+    def test_moved_coordinates(self):
+
+        atoms = self.atoms.copy()
+        atoms['xyz'] += numpy.array([100.1234, -50.5, 0.0004])
+        again = parse_pdb(format_pdb(atoms))
+        numpy.testing.assert_allclose(again['xyz'], atoms['xyz'], atol=5e-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
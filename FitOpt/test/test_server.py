@@ -0,0 +1,172 @@
+# ---------------------------------------------------------------------------------
+# Tests of the Map_Cache of FitOpt.server: concurrent requests of the maps and
+# staging the maps of a job from memory as from the files
+#
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy
+
+from FitOpt.density import Grid, simulate_map
+from FitOpt.fitjob import Fit_Job
+from FitOpt.mrcmap import Mrc_Map, write_mrc
+from FitOpt.pdbio import read_pdb, write_pdb
+from FitOpt.server import Map_Cache
+from FitOpt.test import test_pdb
+
+
+# Entry values of a given size made by make_entry
+def entry_values(size):
+
+    return numpy.zeros((size, size, size), numpy.float32), Grid((0, 0, 0), 1, (size,) * 3), 'test'
+
+
+class Map_Cache_Test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.folder = tempfile.mkdtemp()
+        self.cache = Map_Cache(os.path.join(self.folder, 'maps'))
+
+    def tearDown(self):
+
+        shutil.rmtree(self.folder)
+
+    # ---------------------------------------------------------------------------
+    # Threads asking for the same entry wait for the one making it, which is
+    # made only once
+    #
+    def test_same_key_made_once(self):
+
+        calls = []
+        release = threading.Event()
+
+        def make():
+            calls.append(1)
+            release.wait(5)
+            return entry_values(4)
+
+        entries = []
+        threads = [threading.Thread(target=lambda: entries.append(self.cache.entry('a', make)))
+                   for k in range(4)]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(entries), 4)
+        self.assertTrue(all(e is entries[0] for e in entries))
+        stats = self.cache.stats()
+        self.assertEqual((stats['misses'], stats['hits']), (1, 3))
+
+    # ---------------------------------------------------------------------------
+    # An entry being made does not block the requests of other entries
+    #
+    def test_other_keys_not_blocked(self):
+
+        release = threading.Event()
+
+        def slow():
+            release.wait(5)
+            return entry_values(4)
+
+        t = threading.Thread(target=self.cache.entry, args=('slow', slow))
+        t.start()
+        time.sleep(0.05)
+        self.cache.entry('fast', lambda: entry_values(4))
+        t0 = time.time()
+        self.assertIsNotNone(self.cache.entry('fast', lambda: self.fail('made again')))
+        self.assertLess(time.time() - t0, 1.0)
+        self.assertTrue(t.is_alive())
+        release.set()
+        t.join(5)
+        self.assertEqual(self.cache.stats()['entries'], 2)
+
+    # ---------------------------------------------------------------------------
+    # If making an entry fails, the error is raised in its thread and the
+    # threads waiting for it make it again
+    #
+    def test_failed_make(self):
+
+        release = threading.Event()
+        errors = []
+
+        def failing():
+            release.wait(5)
+            raise IOError('unreadable')
+
+        def first():
+            try:
+                self.cache.entry('a', failing)
+            except IOError as e:
+                errors.append(e)
+
+        t = threading.Thread(target=first)
+        t.start()
+        time.sleep(0.05)
+        waiting = []
+        w = threading.Thread(target=lambda: waiting.append(self.cache.entry('a', lambda: entry_values(2))))
+        w.start()
+        time.sleep(0.05)
+        release.set()
+        t.join(5)
+        w.join(5)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(waiting[0].values.shape, (2, 2, 2))
+        self.assertEqual(self.cache.loading, {})
+
+    # ---------------------------------------------------------------------------
+    # The least recently used entries are released over the memory budget
+    #
+    def test_evict(self):
+
+        self.cache.max_bytes = 2 * 4 * 8 ** 3
+        for key in ('a', 'b'):
+            self.cache.entry(key, lambda: entry_values(8))
+        self.cache.entry('a', lambda: self.fail('made again'))
+        self.cache.entry('c', lambda: entry_values(8))
+        self.assertEqual(list(self.cache.entries), ['a', 'c'])
+        self.assertEqual(self.cache.stats()['bytes'], 2 * 4 * 8 ** 3)
+
+    # ---------------------------------------------------------------------------
+    # The cropped map staged from memory is the one cropped from the file
+    #
+    def test_stage_cropped_map(self):
+
+        atoms = read_pdb(test_pdb)
+        xyz = atoms['xyz']
+        step = 2.0
+        origin = xyz.min(axis=0) - 20
+        size = numpy.ceil((xyz.max(axis=0) + 20 - origin) / step).astype(int)
+        grid = Grid(origin, step, size[::-1])
+        map_path = os.path.join(self.folder, 'map.mrc')
+        write_mrc(map_path, simulate_map(xyz, grid, 10.0), grid)
+
+        # Only a quarter of the atoms is fitted, so the map is cropped
+        fitted = os.path.join(self.folder, 'quarter.pdb')
+        write_pdb(fitted, atoms[:len(atoms) // 4])
+
+        jobs = [Fit_Job([fitted], [], map_path, 10, 0.01, cwd=os.path.join(self.folder, name), crop=True)
+                for name in ('files', 'memory')]
+        jobs[1].map_cache = self.cache
+        values = []
+        for job in jobs:
+            job.stage()
+            self.assertIsNotNone(job.cropped_map)
+            m = Mrc_Map(job.cropped_map)
+            values.append((numpy.array(m.data), m.grid().origin))
+            m.close()
+        self.assertLess(values[0][0].size, numpy.prod(size))
+        numpy.testing.assert_array_equal(values[0][0], values[1][0])
+        numpy.testing.assert_allclose(values[0][1], values[1][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
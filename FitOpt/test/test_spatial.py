@@ -0,0 +1,84 @@
+# ---------------------------------------------------------------------------------
+# Tests of FitOpt.spatial.Cell_Index against brute force distances on the atoms
+# of the test structure
+#
+
+import unittest
+
+import numpy
+
+from FitOpt.pdbio import read_pdb
+from FitOpt.spatial import Cell_Index
+from FitOpt.test import test_pdb
+
+
+# Pairs (i, j) of points of a and b closer than cutoff, by brute force
+def close_pairs(a, b, cutoff):
+
+    d2 = ((a[:, None, :] - b[None, :, :]) ** 2).sum(axis=2)
+    i, j = numpy.nonzero(d2 <= cutoff * cutoff)
+    return set(zip(i.tolist(), j.tolist()))
+
+
+class Cell_Index_Test(unittest.TestCase):
+
+    cutoff = 4.0
+
+    def setUp(self):
+
+        xyz = read_pdb(test_pdb)['xyz']
+        # Half of the atoms are indexed, the other half are the query points
+        self.xyz = xyz[::2][:1500]
+        self.points = xyz[1::2][:1500] + 0.3
+        self.index = Cell_Index(self.xyz, 0.5 * self.cutoff)
+
+    def test_pairs(self):
+
+        expected = set((i, j) for i, j in close_pairs(self.xyz, self.xyz, self.cutoff) if i < j)
+        pairs = self.index.pairs(self.cutoff)
+        self.assertEqual(len(pairs), len(expected))
+        self.assertEqual(set(map(tuple, pairs.tolist())), expected)
+
+    def test_neighbors(self):
+
+        expected = close_pairs(self.points, self.xyz, self.cutoff)
+        pairs = self.index.neighbors(self.points, self.cutoff)
+        self.assertEqual(len(pairs), len(expected))
+        self.assertEqual(set(map(tuple, pairs.tolist())), expected)
+
+    def test_any_within(self):
+
+        self.assertTrue(self.index.any_within(self.points, self.cutoff))
+        far = self.xyz.max(axis=0) + 100
+        self.assertFalse(self.index.any_within(far[None, :], self.cutoff))
+
+    def test_nearest(self):
+
+        index, dist = self.index.nearest(self.points, self.cutoff)
+        d = numpy.sqrt(((self.points[:, None, :] - self.xyz[None, :, :]) ** 2).sum(axis=2))
+        best = d.min(axis=1)
+        found = best <= self.cutoff
+        numpy.testing.assert_allclose(dist[found], best[found])
+        numpy.testing.assert_allclose(d[numpy.flatnonzero(found), index[found]], best[found])
+        self.assertTrue((index[~found] == -1).all())
+        self.assertTrue(numpy.isinf(dist[~found]).all())
+
+    # ---------------------------------------------------------------------------
+    # Moving some points (some of them to other cells) gives the same results
+    # as indexing the moved coordinates again
+    #
+    def test_update(self):
+
+        moved = numpy.arange(0, len(self.xyz), 7)
+        xyz = self.xyz.copy()
+        xyz[moved] += numpy.random.RandomState(0).uniform(-3, 3, (len(moved), 3))
+        self.index.update(moved, xyz[moved])
+        fresh = Cell_Index(xyz, 0.5 * self.cutoff)
+        self.assertEqual(set(map(tuple, self.index.pairs(self.cutoff).tolist())),
+                         set(map(tuple, fresh.pairs(self.cutoff).tolist())))
+        self.assertEqual(set(map(tuple, self.index.neighbors(self.points, self.cutoff).tolist())),
+                         close_pairs(self.points, xyz, self.cutoff))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# ---------------------------------------------------------------------------------
+# Tests of the successive halving of FitOpt.sweep.Parameter_Sweep. The scores
+# are given to the configurations directly, or through the logs of results
+# restored from the result cache, so fitopt is not run.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from FitOpt.fitjob import Fit_Job
+from FitOpt.jobqueue import CANCELLED, FINISHED, QUEUED, Queued_Job
+from FitOpt.resultcache import Result_Cache
+from FitOpt.sweep import Parameter_Sweep, parameter_grid
+from FitOpt.test import test_pdb
+
+
+# Log of fitopt with an iteration line per score
+def fitopt_log(scores):
+
+    lines = ['  Iter   NMA_time     Score\n', '  Model 1 time 0.1 sec\n']
+    lines += ['%6d %10.3f %9.5f\n' % (k + 1, 0.01, s) for k, s in enumerate(scores)]
+    return ''.join(lines + ['  Convergence\n'])
+
+
+class Sweep_Test(unittest.TestCase):
+
+    def setUp(self):
+
+        self.folder = tempfile.mkdtemp()
+        map_path = os.path.join(self.folder, 'map.mrc')
+        f = open(map_path, 'wb')
+        f.write(b'map')
+        f.close()
+        self.job = Fit_Job([test_pdb], [], map_path, 10, 0.02, cwd=os.path.join(self.folder, 'sweep'),
+                           fitopt=os.path.join(self.folder, 'missing_fitopt'))
+
+    def tearDown(self):
+
+        shutil.rmtree(self.folder)
+
+    def sweep(self, count, eta=3, min_iterations=2, cache=None):
+
+        configs = parameter_grid({'modes': ['0.0%d' % (k + 1) for k in range(count)]})
+        return Parameter_Sweep(self.job, configs, eta=eta, min_iterations=min_iterations, cache=cache)
+
+    # ---------------------------------------------------------------------------
+    # Scores a configuration at its next rung and judges it
+    #
+    def reach_rung(self, s, c, score):
+
+        n = s.rung_iterations(c.rung)
+        c.scores += [0.0] * (n - len(c.scores) - 1) + [score]
+        s.judge(c)
+
+    def test_rungs(self):
+
+        s = self.sweep(2, eta=3, min_iterations=10)
+        self.assertEqual([s.rung_iterations(r) for r in range(3)], [10, 30, 90])
+
+    # ---------------------------------------------------------------------------
+    # The first eta - 1 configurations reaching a rung continue. Then only the
+    # best ceil(n / eta) of the n scores of the rung continue.
+    #
+    def test_threshold(self):
+
+        s = self.sweep(7)
+        c = s.configs
+        for k, score in enumerate((0.5, 0.6)):
+            self.reach_rung(s, c[k], score)
+            self.assertIsNone(c[k].stopped_at)
+        # 3 scores: the best 1 continues
+        self.reach_rung(s, c[2], 0.55)
+        self.assertEqual(c[2].stopped_at, 0)
+        self.assertEqual(c[2].queued.state, CANCELLED)
+        # 4 scores: the best 2 continue (0.6 and 0.58)
+        self.reach_rung(s, c[3], 0.58)
+        self.assertIsNone(c[3].stopped_at)
+        self.assertEqual(c[3].queued.state, QUEUED)
+        # 5 scores: the best 2 (0.6, 0.58) continue, so 0.57 is stopped
+        self.reach_rung(s, c[4], 0.57)
+        self.assertEqual(c[4].stopped_at, 0)
+        # 6 scores: the best 2 continue, a tie with the threshold is kept
+        self.reach_rung(s, c[5], 0.58)
+        self.assertIsNone(c[5].stopped_at)
+        self.assertEqual(sorted(s.rung_scores[0]), [0.5, 0.55, 0.57, 0.58, 0.58, 0.6])
+        # The next rung is judged with the configurations which reached it
+        self.reach_rung(s, c[1], 0.7)
+        self.reach_rung(s, c[3], 0.65)
+        self.reach_rung(s, c[5], 0.6)
+        self.assertEqual(c[5].stopped_at, 1)
+        self.assertIsNone(c[1].stopped_at)
+        self.assertIsNone(c[3].stopped_at)
+
+    # ---------------------------------------------------------------------------
+    # Iterations without a score are not judged nor recorded in the rung
+    #
+    def test_none_scores(self):
+
+        s = self.sweep(4)
+        for c in s.configs[:2]:
+            self.reach_rung(s, c, 0.9)
+        c = s.configs[2]
+        self.reach_rung(s, c, None)
+        self.assertIsNone(c.stopped_at)
+        self.assertEqual(c.rung, 1)
+        self.assertEqual(s.rung_scores[0], [0.9, 0.9])
+        self.assertIsNone(s.configs[3].score())
+        s.configs[3].scores = [None, 0.1, None]
+        self.assertEqual(s.configs[3].score(), 0.1)
+
+    # ---------------------------------------------------------------------------
+    # Configurations which have already finished are recorded in the rung but
+    # never stopped
+    #
+    def test_finished_not_stopped(self):
+
+        s = self.sweep(3)
+        for c in s.configs[:2]:
+            self.reach_rung(s, c, 0.9)
+        c = s.configs[2]
+        c.queued.state = FINISHED
+        self.reach_rung(s, c, 0.1)
+        self.assertIsNone(c.stopped_at)
+        self.assertEqual(c.queued.state, FINISHED)
+        self.assertEqual(s.rung_scores[0], [0.9, 0.9, 0.1])
+
+    # ---------------------------------------------------------------------------
+    # Configurations restored from the result cache are finished at once. Their
+    # scores are read from their logs and judged in every rung they reach, and
+    # they are not stopped.
+    #
+    def test_restored_from_cache(self):
+
+        cache = Result_Cache(os.path.join(self.folder, 'cache'))
+        s = self.sweep(3, eta=2, min_iterations=2, cache=cache)
+        final = []
+        for k, c in enumerate(s.configs):
+            job = c.queued.job
+            os.makedirs(job.cwd)
+            scores = [0.1 * (k + 1) + 0.01 * i for i in range(5)]
+            final.append(scores[-1])
+            for name, text in ((Queued_Job.log_name, fitopt_log(scores)), (job.fitted_name, 'END\n')):
+                f = open(os.path.join(job.cwd, name), 'w')
+                f.write(text)
+                f.close()
+            cache.store(job)
+            shutil.rmtree(job.cwd)
+
+        s = self.sweep(3, eta=2, min_iterations=2, cache=cache)
+        s.update()
+        self.assertTrue(s.done())
+        for c, score in zip(s.configs, final):
+            self.assertEqual(c.queued.state, FINISHED)
+            self.assertEqual(len(c.scores), 5)
+            self.assertAlmostEqual(c.score(), score)
+            self.assertIsNone(c.stopped_at)
+            # Rungs at 2 and 4 iterations
+            self.assertEqual(c.rung, 2)
+        self.assertEqual([len(r) for r in s.rung_scores], [3, 3])
+        self.assertEqual([r['name'] for r in s.results()], ['config3', 'config2', 'config1'])
+        self.assertEqual(s.best()['name'], 'config3')
+
+
+if __name__ == '__main__':
+    unittest.main()
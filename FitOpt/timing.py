@@ -0,0 +1,252 @@
+# ---------------------------------------------------------------------------------
+# Timing spans of the FitOpt plugin.
+#
+# The code of the plugin marks its steps with spans of the current Timer:
+#
+#   with timing.span('stage'):
+#       ...
+#
+# By default the current Timer is disabled and its spans are a shared object
+# which does nothing, so the instrumentation costs one call per span. When a
+# Timer is enabled (set_timer), the spans are recorded, together with the
+# iterations of fitopt parsed from its output (Progress_Parser events), and
+# can be saved as a Chrome trace (chrome://tracing, Perfetto) and summarized.
+# Every thread has its own current Timer, so the workers preparing a job
+# record their spans in the Timer of the job.
+#
+
+import json
+import os
+import threading
+import time
+
+# Threads of the trace: the plugin, the fitopt process and the worker threads
+# of the plugin
+PLUGIN_THREAD = 0
+FITOPT_THREAD = 1
+WORKER_THREAD = 2
+thread_names = {PLUGIN_THREAD: 'FitOpt plugin', FITOPT_THREAD: 'fitopt', WORKER_THREAD: 'FitOpt worker'}
+
+
+# ---------------------------------------------------------------------------------
+# Recorder of timing spans
+#
+class Timer:
+
+    # -------------------------------------------------
+    # enabled: record the spans (if False, spans do nothing)
+    #
+    def __init__(self, enabled=True):
+
+        self.enabled = enabled
+        self.origin = time.time()
+        # Recorded spans: (name, begin, end, thread, arguments)
+        self.spans = []
+        # Time of the last fitopt progress event (start of the next iteration)
+        self.last_progress = None
+
+    # ---------------------------------------------------------------------------
+    # Span starting now. It ends with its end method or at the end of a with
+    # block.
+    #
+    def span(self, name, **args):
+
+        if not self.enabled:
+            return null_span
+        return Span(self, name, args)
+
+    # ---------------------------------------------------------------------------
+    # Records a span with given begin and end times (seconds, time.time())
+    #
+    def add(self, name, begin, end, args=None, thread=PLUGIN_THREAD):
+
+        if self.enabled:
+            self.spans.append((name, begin, end, thread, args))
+
+    # ---------------------------------------------------------------------------
+    # Records a fitopt progress event (FitOpt.progress.Progress_Event, or None).
+    # Every iteration is a span from the previous event, with its score and
+    # NMA time.
+    #
+    def progress(self, event):
+
+        if not self.enabled or event is None:
+            return
+        from FitOpt.progress import ITERATION
+        now = time.time()
+        if event.kind == ITERATION and self.last_progress is not None:
+            self.add('iteration', self.last_progress, now,
+                     {'model': event.model, 'iteration': event.iteration,
+                      'score': event.score, 'nma_time': event.nma_time}, FITOPT_THREAD)
+        self.last_progress = now
+
+    # ---------------------------------------------------------------------------
+    # Number of spans and total seconds of every span name, in order of first
+    # appearance, as a list of (name, count, seconds)
+    #
+    def totals(self):
+
+        names = []
+        totals = {}
+        for name, begin, end, thread, args in self.spans:
+            if name not in totals:
+                names.append(name)
+                totals[name] = [0, 0.0]
+            totals[name][0] += 1
+            totals[name][1] += end - begin
+        return [(name, totals[name][0], totals[name][1]) for name in names]
+
+    # ---------------------------------------------------------------------------
+    # Text with the total time of every span name (and the NMA time reported
+    # by fitopt in its iterations)
+    #
+    def summary(self):
+
+        parts = []
+        for name, count, seconds in self.totals():
+            text = '%s %.2f s' % (name, seconds)
+            if count > 1:
+                text += ' (%d)' % count
+            parts.append(text)
+        nma = [args['nma_time'] for name, b, e, t, args in self.spans
+               if name == 'iteration' and args['nma_time'] is not None]
+        if nma:
+            parts.append('NMA %.2f s' % sum(nma))
+        return ', '.join(parts)
+
+    # ---------------------------------------------------------------------------
+    # Chrome trace of the spans (trace event format, times in microseconds)
+    #
+    def trace(self):
+
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': t, 'args': {'name': n}}
+                  for t, n in thread_names.items()]
+        for name, begin, end, thread, args in self.spans:
+            e = {'name': name, 'cat': 'fitopt', 'ph': 'X', 'pid': pid, 'tid': thread,
+                 'ts': round(1e6 * (begin - self.origin), 1), 'dur': round(1e6 * (end - begin), 1)}
+            if args:
+                e['args'] = args
+            events.append(e)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'start': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.origin))}}
+
+    # ---------------------------------------------------------------------------
+    # Writes the Chrome trace in a JSON file
+    #
+    def save(self, path):
+
+        f = open(path, 'w')
+        json.dump(self.trace(), f)
+        f.close()
+
+
+# ---------------------------------------------------------------------------------
+# Span of an enabled Timer
+#
+class Span:
+
+    def __init__(self, timer, name, args):
+
+        self.timer = timer
+        self.name = name
+        self.args = args or None
+        self.begin = time.time()
+        self.ended = False
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.end()
+        return False
+
+    # ---------------------------------------------------------------------------
+    # Records the span (only the first time it is called)
+    #
+    def end(self):
+
+        if not self.ended:
+            self.ended = True
+            thread = PLUGIN_THREAD if threading.current_thread().name == 'MainThread' else WORKER_THREAD
+            self.timer.add(self.name, self.begin, time.time(), self.args, thread)
+
+
+# ---------------------------------------------------------------------------------
+# Span of a disabled Timer
+#
+class Null_Span:
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        return False
+
+    def end(self):
+
+        pass
+
+
+null_span = Null_Span()
+
+# Timer used by span() in every thread (a disabled one when none is set)
+disabled_timer = Timer(enabled=False)
+local = threading.local()
+
+
+# ---------------------------------------------------------------------------------
+# Current Timer of this thread, and setting it (None sets the disabled one)
+#
+def timer():
+
+    return getattr(local, 'timer', disabled_timer)
+
+
+def set_timer(t):
+
+    local.timer = disabled_timer if t is None else t
+
+
+# ---------------------------------------------------------------------------------
+# Span of the current Timer
+#
+def span(name, **args):
+
+    return timer().span(name, **args)
+
+
+# ---------------------------------------------------------------------------------
+# Context setting a Timer as the current one during a with block. The previous
+# one is set again at its end, so the Timer only records the spans of the code
+# run in the block (and not the ones of other jobs started meanwhile).
+#
+#   with timing.using(timer):
+#       ...
+#
+def using(t):
+
+    return Timer_Context(t)
+
+
+class Timer_Context:
+
+    def __init__(self, timer):
+
+        self.timer = timer
+        self.previous = None
+
+    def __enter__(self):
+
+        self.previous = timer()
+        set_timer(self.timer)
+        return self.timer
+
+    def __exit__(self, *exc):
+
+        set_timer(self.previous)
+        return False
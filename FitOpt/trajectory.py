@@ -0,0 +1,392 @@
+# ---------------------------------------------------------------------------------
+# Lazy reader of the trajectory (movie) written by FitOpt.
+#
+# The multi-model PDB is memory mapped and the offsets of its frames (MODEL ...
+# ENDMDL blocks) are found in one pass. The index is saved beside the PDB, so it
+# is only built again when the trajectory changes. The frames are decoded when
+# they are requested, so opening a trajectory is fast and the memory used only
+# depends on the frames being viewed.
+#
+# The trajectory can also be converted to a compact binary format (.fitraj):
+#
+#   header      magic, number of atoms, number of frames, offsets of the
+#               topology and of the frame index
+#   topology    ATOM/HETATM records of the first frame (written once)
+#   frames      float32 x, y, z coordinates of every atom, frame after frame
+#   index       uint64 offset of every frame
+#
+#   python -m FitOpt.trajectory fitopt_movie.pdb [fitopt_movie.fitraj]
+#
+
+import mmap
+import os
+import re
+import struct
+import sys
+
+# Beginning of the lines delimiting the frames
+frame_delimiters = re.compile(b'^(MODEL|ENDMDL)', re.MULTILINE)
+
+
+# ---------------------------------------------------------------------------------
+# Multi-model PDB trajectory
+#
+class Pdb_Trajectory:
+
+    # Extension of the file with the index of the frames
+    index_suffix = '.idx'
+    # Header of the index file: magic, trajectory size and modification time, frames
+    index_header = struct.Struct('<4sqdq')
+    index_magic = b'FOI1'
+
+    # -------------------------------------------------
+    # path: trajectory file
+    # save_index: save the index beside the trajectory when it is built
+    #
+    def __init__(self, path, save_index=True):
+
+        self.path = path
+        self.file = open(path, 'rb')
+        st = os.fstat(self.file.fileno())
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        if self.size > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b''
+
+        self.offsets = self.read_index()
+        if self.offsets is None:
+            self.offsets = self.build_index()
+            if save_index:
+                self.write_index()
+
+    # ---------------------------------------------------------------------------
+    # Finds the start and end offsets of every frame.
+    # A PDB without MODEL records is a trajectory with one frame.
+    #
+    def build_index(self):
+
+        offsets = []
+        start = None
+        for m in frame_delimiters.finditer(self.data):
+            if m.group(1) == b'MODEL':
+                if start is not None:
+                    offsets.append((start, m.start()))
+                start = m.start()
+            elif start is not None:
+                end = self.data.find(b'\n', m.start())
+                offsets.append((start, self.size if end < 0 else end + 1))
+                start = None
+        if start is not None:
+            offsets.append((start, self.size))
+        if not offsets and self.size > 0:
+            offsets.append((0, self.size))
+        return offsets
+
+    # ---------------------------------------------------------------------------
+    # Path of the index file
+    #
+    def index_path(self):
+
+        return self.path + self.index_suffix
+
+    # ---------------------------------------------------------------------------
+    # Reads the saved index. Returns None if it does not exist or if it does
+    # not correspond to the current trajectory.
+    #
+    def read_index(self):
+
+        h = self.index_header
+        try:
+            f = open(self.index_path(), 'rb')
+        except IOError:
+            return None
+        try:
+            header = f.read(h.size)
+            if len(header) < h.size:
+                return None
+            magic, size, mtime, n = h.unpack(header)
+            if magic != self.index_magic or size != self.size or mtime != self.mtime:
+                return None
+            values = struct.unpack('<%dq' % (2 * n), f.read(16 * n))
+        except struct.error:
+            return None
+        finally:
+            f.close()
+        return list(zip(values[0::2], values[1::2]))
+
+    # ---------------------------------------------------------------------------
+    # Saves the index beside the trajectory (silently skipped if the folder is
+    # not writable)
+    #
+    def write_index(self):
+
+        values = [v for se in self.offsets for v in se]
+        try:
+            f = open(self.index_path(), 'wb')
+            f.write(self.index_header.pack(self.index_magic, self.size, self.mtime, len(self.offsets)))
+            f.write(struct.pack('<%dq' % len(values), *values))
+            f.close()
+        except IOError:
+            pass
+
+    # ---------------------------------------------------------------------------
+    # Number of frames
+    #
+    def __len__(self):
+
+        return len(self.offsets)
+
+    # ---------------------------------------------------------------------------
+    # Text of a frame (starting at 0)
+    #
+    def frame_bytes(self, frame):
+
+        start, end = self.offsets[frame]
+        return self.data[start:end]
+
+    # ---------------------------------------------------------------------------
+    # ATOM and HETATM records of a frame
+    #
+    def atom_records(self, frame):
+
+        return [line for line in self.frame_bytes(frame).split(b'\n')
+                if line.startswith(b'ATOM') or line.startswith(b'HETATM')]
+
+    # ---------------------------------------------------------------------------
+    # Coordinates of the atoms of a frame, as a (atoms, 3) float32 array
+    #
+    def coordinates(self, frame):
+
+        from FitOpt.pdbio import parse_coordinates
+        return parse_coordinates(self.frame_bytes(frame))
+
+    # ---------------------------------------------------------------------------
+    # Releases the file
+    #
+    def close(self):
+
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+
+# ---------------------------------------------------------------------------------
+# Binary trajectory (.fitraj)
+#
+class Binary_Trajectory:
+
+    # Extension of the binary trajectories
+    suffix = '.fitraj'
+    # Header: magic, atoms, frames, topology offset, topology size, index offset
+    header = struct.Struct('<8sqqqqq')
+    magic = b'FITRAJ01'
+
+    # -------------------------------------------------
+    # path: binary trajectory file
+    #
+    def __init__(self, path):
+
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        h = self.header
+        if len(self.data) < h.size:
+            raise ValueError('%s is not a FitOpt binary trajectory' % path)
+        magic, natoms, nframes, toff, tsize, ioff = h.unpack(self.data[:h.size])
+        if magic != self.magic:
+            raise ValueError('%s is not a FitOpt binary trajectory' % path)
+        self.natoms = natoms
+        self.topology = self.data[toff:toff + tsize].split(b'\n') if tsize > 0 else []
+
+        from numpy import frombuffer, uint64
+        self.offsets = frombuffer(self.data, uint64, nframes, ioff)
+
+    def __len__(self):
+
+        return len(self.offsets)
+
+    # ---------------------------------------------------------------------------
+    # ATOM and HETATM records of the topology (the coordinates are the ones of
+    # the first frame)
+    #
+    def atom_records(self, frame=0):
+
+        return self.topology
+
+    # ---------------------------------------------------------------------------
+    # Coordinates of the atoms of a frame, as a (atoms, 3) float32 array.
+    # The array is a read-only view of the mapped file.
+    #
+    def coordinates(self, frame):
+
+        from numpy import frombuffer, float32
+        xyz = frombuffer(self.data, float32, 3 * self.natoms, int(self.offsets[frame]))
+        return xyz.reshape((self.natoms, 3))
+
+    # ---------------------------------------------------------------------------
+    # Releases the mapped file. If coordinate arrays of the frames are still in
+    # use, the mapping is released when they are deleted.
+    #
+    def close(self):
+
+        self.offsets = ()
+        try:
+            self.data.close()
+        except BufferError:
+            pass
+        self.file.close()
+
+
+# ---------------------------------------------------------------------------------
+# Writes a binary trajectory.
+# topology: ATOM/HETATM records (bytes), frames: iterable of (atoms, 3) arrays
+#
+def write_binary_trajectory(path, topology, frames):
+
+    from numpy import asarray, array, float32, uint64
+
+    B = Binary_Trajectory
+    natoms = len(topology)
+    f = open(path, 'wb')
+    f.write(b'\0' * B.header.size)
+    toff = f.tell()
+    tdata = b'\n'.join(topology)
+    f.write(tdata)
+
+    offsets = []
+    for xyz in frames:
+        xyz = asarray(xyz, float32)
+        if xyz.shape != (natoms, 3):
+            f.close()
+            os.remove(path)
+            raise ValueError('Frame %d has %d atoms, topology has %d'
+                             % (len(offsets) + 1, len(xyz), natoms))
+        # Frames are aligned to 4 bytes to be read in place as float32
+        pad = (-f.tell()) % 4
+        f.write(b'\0' * pad)
+        offsets.append(f.tell())
+        f.write(xyz.tobytes())
+
+    pad = (-f.tell()) % 8
+    f.write(b'\0' * pad)
+    ioff = f.tell()
+    f.write(array(offsets, uint64).tobytes())
+    f.seek(0)
+    f.write(B.header.pack(B.magic, natoms, len(offsets), toff, len(tdata), ioff))
+    f.close()
+
+
+# ---------------------------------------------------------------------------------
+# Converts a multi-model PDB trajectory to the binary format.
+# Returns the path of the binary trajectory.
+#
+def convert_pdb_trajectory(pdb_path, path=None):
+
+    if path is None:
+        path = binary_path(pdb_path)
+    t = Pdb_Trajectory(pdb_path)
+    try:
+        topology = t.atom_records(0) if len(t) > 0 else []
+        frames = (t.coordinates(i) for i in range(len(t)))
+        write_binary_trajectory(path, topology, frames)
+    finally:
+        t.close()
+    return path
+
+
+# ---------------------------------------------------------------------------------
+# Path of the binary trajectory corresponding to a PDB trajectory
+#
+def binary_path(pdb_path):
+
+    return os.path.splitext(pdb_path)[0] + Binary_Trajectory.suffix
+
+
+# ---------------------------------------------------------------------------------
+# Opens a trajectory. For a PDB trajectory, its binary version is used
+# instead if it exists and it is newer than the PDB.
+#
+def open_trajectory(path):
+
+    if path.endswith(Binary_Trajectory.suffix):
+        return Binary_Trajectory(path)
+    bpath = binary_path(path)
+    if os.path.exists(bpath) and os.path.getmtime(bpath) >= os.path.getmtime(path):
+        return Binary_Trajectory(bpath)
+    return Pdb_Trajectory(path)
+
+
+# ---------------------------------------------------------------------------------
+# Ensemble given to the Chimera Movie dialog.
+# The molecule is created from the first frame, and the coordinates of the
+# other frames are decoded when the Movie dialog shows them.
+#
+class Trajectory_Ensemble:
+
+    # -------------------------------------------------
+    # trajectory: Pdb_Trajectory or Binary_Trajectory
+    #
+    def __init__(self, trajectory, name=None):
+
+        self.trajectory = trajectory
+        self.name = os.path.basename(trajectory.path) if name is None else name
+        # Chimera frames start at 1
+        self.startFrame = 1
+        self.endFrame = len(trajectory)
+        self.molecule = None
+
+    def __len__(self):
+
+        return len(self.trajectory)
+
+    # ---------------------------------------------------------------------------
+    # Coordinates of a frame (starting at 1) as a list of Chimera points
+    #
+    def __getitem__(self, frame):
+
+        from chimera import Point
+        return [Point(*xyz) for xyz in self.trajectory.coordinates(frame - 1).tolist()]
+
+    # ---------------------------------------------------------------------------
+    # Opens in Chimera the molecule of the first frame
+    #
+    def addMolecule(self, **kw):
+
+        if self.molecule is not None:
+            return self.molecule
+
+        import tempfile
+        import chimera
+        fd, path = tempfile.mkstemp(suffix='.pdb')
+        f = os.fdopen(fd, 'wb')
+        f.write(b'\n'.join(self.trajectory.atom_records(0)) + b'\nEND\n')
+        f.close()
+        try:
+            self.molecule = chimera.openModels.open(path, type='PDB')[0]
+        finally:
+            os.remove(path)
+        self.molecule.name = self.name
+        return self.molecule
+
+
+# ---------------------------------------------------------------------------------
+# Converts a PDB trajectory given in the command line to the binary format
+#
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) not in (1, 2):
+        sys.stderr.write('Usage: python -m FitOpt.trajectory movie.pdb [movie.fitraj]\n')
+        return 2
+    path = convert_pdb_trajectory(*argv)
+    sys.stdout.write('%s (%d bytes) -> %s (%d bytes)\n'
+                     % (argv[0], os.path.getsize(argv[0]), path, os.path.getsize(path)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())